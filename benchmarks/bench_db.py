@@ -0,0 +1,86 @@
+"""Benchmark the database statements run for every notification.
+
+Compares the plain statements with server side prepared statements (see
+the ``prepared_statements`` database setting) for load_events and
+mark_as_sent and, optionally, new_ticket_number.
+
+The database from the mailgen configuration is used. All changes are
+made in a transaction that is rolled back at the end. The only exception
+are the ticket numbers drawn with --tickets, as the ticket sequence is
+not transactional, so only use that option on test databases.
+
+Usage:
+    python3 benchmarks/bench_db.py [-c CONFIG] [-n ITERATIONS] [-e EVENTS] [--tickets]
+
+ * SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+import argparse
+from timeit import default_timer as timer
+
+from psycopg2.extras import RealDictConnection
+
+from intelmqmail.cb import read_configuration
+from intelmqmail.db import open_db_connection, enable_prepared_statements, \
+    load_events, mark_as_sent, new_ticket_number
+
+
+# the columns of the fallback format of intelmqmail.notification
+COLUMNS = ["source.asn", "source.ip", "time.source", "source.port",
+           "destination.ip", "destination.port", "destination.fqdn",
+           "protocol.transport"]
+
+
+def run(label, iterations, func):
+    start = timer()
+    for i in range(iterations):
+        func(i)
+    time_spent = timer() - start
+    print(f"{label:40s} {iterations / time_spent:10.1f}/s"
+          f" {1000 * time_spent / iterations:8.3f} ms per call")
+
+
+def benchmark(config, prepared, iterations, num_events, tickets):
+    conn = open_db_connection(config, connection_factory=RealDictConnection)
+    try:
+        if prepared:
+            enable_prepared_statements(conn)
+        variant = "prepared" if prepared else "plain"
+        cur = conn.cursor()
+        cur.execute("SET TIME ZONE 'UTC';")
+        cur.execute("SELECT id FROM events ORDER BY id DESC LIMIT %s", (num_events,))
+        event_ids = [row["id"] for row in cur.fetchall()]
+        cur.execute("SELECT id FROM directives WHERE events_id = ANY (%s)", (event_ids,))
+        directive_ids = [row["id"] for row in cur.fetchall()]
+
+        run(f"load_events ({len(event_ids)} events, {variant})", iterations,
+            lambda i: load_events(cur, event_ids, COLUMNS))
+        run(f"mark_as_sent ({len(directive_ids)} directives, {variant})", iterations,
+            lambda i: mark_as_sent(cur, directive_ids, f"BENCH{int(prepared)}-{i:08d}", "now"))
+        if tickets:
+            run(f"new_ticket_number ({variant})", iterations,
+                lambda i: new_ticket_number(cur))
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('-c', '--config',
+                        help='Alternative system configuration file')
+    parser.add_argument('-n', '--iterations', default=1000, type=int,
+                        help='Number of calls per statement')
+    parser.add_argument('-e', '--events', default=100, type=int,
+                        help='Number of events to load per call')
+    parser.add_argument('--tickets', action='store_true',
+                        help='Also draw ticket numbers (not rolled back!)')
+    args = parser.parse_args()
+
+    config = read_configuration(conf_file_path=args.config)
+    for prepared in (False, True):
+        benchmark(config, prepared, args.iterations, args.events, args.tickets)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+-- Benchmark the extraction of directives from inserted events.
+--
+-- Compares the former PL/pgSQL implementation of
+-- json_object_as_text_array with the installed one and measures the cost
+-- of the directive trigger for inserting 10000 events (set another
+-- number with -v events=N). The trigger cost is the difference between
+-- the insert into events and the insert into a copy of the table without
+-- triggers. Run it before and after an update of the functions or the
+-- trigger (see sql/updates.md) to compare both versions.
+--
+-- Everything is rolled back at the end, but the id sequences of events
+-- and directives advance, so only use this on test databases.
+--
+-- Usage:
+--     psql -f benchmarks/bench_directive_trigger.sql intelmq-events
+--
+-- SPDX-License-Identifier: AGPL-3.0-or-later
+
+\if :{?events}
+\else
+    \set events 10000
+\endif
+
+BEGIN;
+
+CREATE FUNCTION pg_temp.json_object_as_text_array_plpgsql(obj JSONB)
+RETURNS TEXT[][]
+AS $$
+DECLARE
+    arr TEXT[][] = '{}'::TEXT[][];
+    k TEXT;
+    v TEXT;
+BEGIN
+    FOR k, v IN
+        SELECT * FROM jsonb_each_text(obj) ORDER BY key
+    LOOP
+        arr := arr || ARRAY[ARRAY[k, v]];
+    END LOOP;
+    RETURN arr;
+END
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+-- events with two directives each, similar to those of the rules bot
+CREATE TEMPORARY TABLE bench_extra AS
+SELECT jsonb_build_object('certbund', jsonb_build_object('source_directives', jsonb_build_array(
+           jsonb_build_object('medium', 'email',
+                              'recipient_address', 'abuse' || i % 500 || '@example.com',
+                              'template_name', 'bench_template',
+                              'notification_format', 'bench',
+                              'event_data_format', 'csv_bench',
+                              'aggregate_identifier',
+                              jsonb_build_object('source.asn', 64496 + i % 100,
+                                                 'time.observation', '2024-01-01 00:00:00',
+                                                 'feed.name', 'bench'),
+                              'notification_interval', 86400),
+           jsonb_build_object('medium', 'email',
+                              'recipient_address', 'cert@example.com',
+                              'template_name', 'bench_template',
+                              'notification_format', 'bench',
+                              'event_data_format', 'csv_bench',
+                              'aggregate_identifier', jsonb_build_object('feed.name', 'bench'),
+                              'notification_interval', 0)))) AS extra
+  FROM generate_series(1, :events) AS i;
+
+CREATE TEMPORARY TABLE bench_identifiers AS
+SELECT directive -> 'aggregate_identifier' AS identifier
+  FROM bench_extra, jsonb_array_elements(extra -> 'certbund' -> 'source_directives') AS directive;
+
+\echo 'Both implementations must return the same values (expected: 0):'
+SELECT count(*) AS differences
+  FROM bench_identifiers
+ WHERE pg_temp.json_object_as_text_array_plpgsql(identifier)
+       IS DISTINCT FROM json_object_as_text_array(identifier);
+
+\timing on
+
+\echo 'json_object_as_text_array, PL/pgSQL:'
+SELECT count(pg_temp.json_object_as_text_array_plpgsql(identifier)) FROM bench_identifiers;
+
+\echo 'json_object_as_text_array, installed:'
+SELECT count(json_object_as_text_array(identifier)) FROM bench_identifiers;
+
+CREATE TEMPORARY TABLE bench_events (LIKE events INCLUDING DEFAULTS);
+
+\echo 'Inserting the events without triggers:'
+INSERT INTO bench_events (extra) SELECT extra FROM bench_extra;
+
+\echo 'Inserting the events with the directive trigger:'
+INSERT INTO events (extra) SELECT extra FROM bench_extra;
+
+\timing off
+
+ROLLBACK;
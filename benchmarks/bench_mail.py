@@ -0,0 +1,229 @@
+"""Benchmark creating signed mails.
+
+Measures create_mail with a gpgme context for CSV event data of
+different sizes, once with the CSV data in the body of the mail and once
+as an attachment, and reports the mails per second and the median and
+99th percentile of the time per mail.
+
+With --processes, the mails with attachments are also created with a
+SigningPool of that many processes, once finishing each mail right away
+and once with a look-ahead like the one of send_notifications: the data
+of the next mails is submitted for signing before the oldest mail is
+finished, so that signing overlaps with the rendering of the mails.
+Sending a mail can be simulated with --send-delay, which waits that
+many milliseconds after each finished mail like for the reply of the
+SMTP server, during which the pool can go on signing with look-ahead.
+The gain depends on the number of CPU cores and the send delay, on a
+single core without a send delay there is none.
+
+The key of the tests (tests/keys/test1.sec) is imported into a temporary
+GnuPG home directory, so no configuration is needed. The signature cache
+is disabled, otherwise all but the first mail would not be signed.
+
+The results can be saved as a baseline with --save-baseline. With
+--baseline, the results are compared with a saved baseline and the
+script exits with status 1 if the mails per second of any case are
+lower than in the baseline by more than the tolerance. Baselines are
+only comparable on the same machine.
+
+Usage:
+    python3 benchmarks/bench_mail.py [-n ITERATIONS] [--rows ROWS ...]
+        [--processes PROCESSES] [--send-delay MS] [--save-baseline FILE] [--baseline FILE] [--tolerance FRACTION]
+
+ * SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+import argparse
+import collections
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from timeit import default_timer as timer
+
+import gpg
+
+from intelmqmail.mail import create_mail, finish_mail, signature_cache, SigningPool
+
+
+KEY_FILE = os.path.join(os.path.dirname(__file__), os.pardir, "tests", "keys", "test1.sec")
+FINGERPRINT = "5F503EFAC8C89323D54C252591B8CD7E15925678"
+
+BODY = """Dear Sir or Madam,
+
+please find below a list of affected systems on your network(s).
+
+Kind regards
+"""
+
+
+def csv_data(rows):
+    lines = ['"source.asn","source.ip","time.source","source.port","classification.identifier"']
+    for i in range(rows):
+        lines.append(f'"64496","192.0.2.{i % 256}","2024-01-01 00:{i // 60 % 60:02d}:{i % 60:02d}",'
+                     f'"{1024 + i % 60000}","open-service"')
+    return "\n".join(lines) + "\n"
+
+
+def signing_context(gnupg_home):
+    ctx = gpg.Context(home_dir=gnupg_home)
+    with open(KEY_FILE, "rb") as f:
+        ctx.key_import(f)
+    ctx.signers = [ctx.get_key(FINGERPRINT)]
+    return ctx
+
+
+def run(label, iterations, func, finish=None):
+    """Call func iterations times and report the time per call.
+
+    If given, finish is called afterwards and its time is added to the
+    last call.
+    """
+    times = []
+    for i in range(iterations):
+        start = timer()
+        func()
+        times.append(timer() - start)
+    if finish is not None:
+        start = timer()
+        finish()
+        times[-1] += timer() - start
+    quantiles = statistics.quantiles(times, n=100, method="inclusive")
+    result = {
+        "mails_per_second": iterations / sum(times),
+        "p50_ms": 1000 * quantiles[49],
+        "p99_ms": 1000 * quantiles[98],
+    }
+    print(f"{label:30s} {result['mails_per_second']:10.1f} mails/s"
+          f" p50 {result['p50_ms']:8.3f} ms p99 {result['p99_ms']:8.3f} ms")
+    return result
+
+
+def benchmark(ctx, iterations, row_counts):
+    results = {}
+    for rows in row_counts:
+        csv = csv_data(rows)
+        label = f"{rows} rows, inline"
+        results[label] = run(label, iterations, lambda: create_mail(
+            "sender@example.com", "recipient@example.com", "Benchmark",
+            BODY + "\n" + csv, [], ctx))
+        label = f"{rows} rows, attachment"
+        results[label] = run(label, iterations, lambda: create_mail(
+            "sender@example.com", "recipient@example.com", "Benchmark",
+            BODY, [((csv,), dict(subtype="csv", filename="events.csv"))], ctx))
+    return results
+
+
+def pool_benchmark(gnupg_home, iterations, row_counts, processes, send_delay):
+    results = {}
+
+    def send(msg):
+        finish_mail(msg)
+        time.sleep(send_delay / 1000)
+
+    with SigningPool(gnupg_home, FINGERPRINT, processes) as pool:
+        for rows in row_counts:
+            csv = csv_data(rows)
+
+            def create():
+                return create_mail(
+                    "sender@example.com", "recipient@example.com", "Benchmark",
+                    BODY, [((csv,), dict(subtype="csv", filename="events.csv"))], pool)
+
+            label = f"{rows} rows, pool"
+            results[label] = run(label, iterations, lambda: send(create()))
+
+            pending = collections.deque()
+
+            def create_ahead():
+                pending.append(create())
+                if len(pending) > processes:
+                    send(pending.popleft())
+
+            def finish():
+                while pending:
+                    send(pending.popleft())
+
+            label = f"{rows} rows, pool look-ahead"
+            results[label] = run(label, iterations, create_ahead, finish)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print the regressions against the baseline and return their number."""
+    regressions = 0
+    for label, result in results.items():
+        if label not in baseline:
+            continue
+        expected = baseline[label]["mails_per_second"]
+        if result["mails_per_second"] < expected * (1 - tolerance):
+            print(f"Regression for {label}: {result['mails_per_second']:.1f} mails/s,"
+                  f" baseline {expected:.1f} mails/s")
+            regressions += 1
+    return regressions
+
+
+def iterations(value):
+    # the 99th percentile needs at least two times
+    number = int(value)
+    if number < 2:
+        raise argparse.ArgumentTypeError(f"at least 2 iterations are needed, got {number}")
+    return number
+
+
+def stop_gpg_agent(gnupg_home):
+    # gpg starts an agent for the temporary home, which would keep running
+    try:
+        subprocess.run(["gpgconf", "--homedir", gnupg_home, "--kill", "gpg-agent"],
+                       check=False)
+    except FileNotFoundError:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('-n', '--iterations', default=100, type=iterations,
+                        help='Number of mails per case, at least 2')
+    parser.add_argument('--rows', default=[1, 100, 10000], type=int, nargs='+',
+                        help='Numbers of CSV rows')
+    parser.add_argument('--processes', type=int,
+                        help='Also sign with a SigningPool of that many processes')
+    parser.add_argument('--send-delay', default=0, type=float, metavar='MS',
+                        help='Milliseconds to wait after each mail signed by the pool'
+                        ' (default: 0)')
+    parser.add_argument('--save-baseline', metavar='FILE',
+                        help='Save the results as a baseline')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='Compare the results with a saved baseline')
+    parser.add_argument('--tolerance', default=0.2, type=float,
+                        help='Allowed fraction by which the mails per second may be lower'
+                        ' than in the baseline (default: 0.2)')
+    args = parser.parse_args()
+
+    signature_cache.maxsize = 0
+    gnupg_home = tempfile.mkdtemp(prefix='tmp.gpghome')
+    try:
+        results = benchmark(signing_context(gnupg_home), args.iterations, args.rows)
+        if args.processes:
+            results.update(pool_benchmark(gnupg_home, args.iterations, args.rows,
+                                          args.processes, args.send_delay))
+    finally:
+        stop_gpg_agent(gnupg_home)
+        shutil.rmtree(gnupg_home, ignore_errors=True)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=4)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Benchmark creating mails with a MailFactory.
+
+Compares the time per mail of the create_mail function with that of
+MailFactory.create_mail, for a mail with a small CSV attachment and for
+a mail without attachments. The mails are not signed, so that the time
+spent on the parts that MailFactory prepares once is not hidden by the
+time needed for the signatures, and no GnuPG setup is needed.
+
+Usage:
+    python3 benchmarks/bench_mail_factory.py [-n ITERATIONS]
+
+ * SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+import argparse
+from timeit import default_timer as timer
+
+from intelmqmail.mail import MailFactory, create_mail
+
+
+SENDER = "CERT Notifications <notifications@cert.example>"
+
+BODY = """Dear Sir or Madam,
+
+please find attached a list of affected systems on your network(s).
+
+Kind regards
+"""
+
+CSV = ('"source.asn","source.ip","time.source"\n'
+       '"64496","192.0.2.1","2024-01-01 00:00:00"\n')
+
+
+def run(iterations, func):
+    """Return the average time per call of func in microseconds."""
+    start = timer()
+    for i in range(iterations):
+        # serialize the mail, because the factory also saves work there
+        func().as_bytes()
+    return 1e6 * (timer() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('-n', '--iterations', default=5000, type=int,
+                        help='Number of mails per case')
+    args = parser.parse_args()
+
+    factory = MailFactory(SENDER)
+    for label, attachments in [("attachment", [((CSV,), dict(subtype="csv", filename="events.csv"))]),
+                               ("no attachment", [])]:
+        function_time = run(args.iterations, lambda: create_mail(
+            SENDER, "abuse@example.com", "Affected systems", BODY, attachments, None))
+        factory_time = run(args.iterations, lambda: factory.create_mail(
+            "abuse@example.com", "Affected systems", BODY, attachments, None))
+        print(f"{label:15s} create_mail {function_time:8.1f} us/mail"
+              f"  MailFactory {factory_time:8.1f} us/mail"
+              f"  speedup {function_time / factory_time:5.2f}x")
+
+
+if __name__ == '__main__':
+    main()
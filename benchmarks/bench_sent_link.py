@@ -0,0 +1,95 @@
+"""Benchmark recording the sent state in directives.sent_id and directive_sent.
+
+Compares the default, which updates directives.sent_id, with the
+insert-only link table of the ``sent_link_table`` database setting for
+mark_as_sent and the query for the pending directives. For mark_as_sent,
+the growth of the tables including their indexes is shown as well, as a
+measure of the bloat caused by the updates.
+
+The database from the mailgen configuration is used, and the tables
+directive_sent and directive_pending and their triggers have to exist
+(see sql/updates.md). All changes are made
+in a transaction that is rolled back at the end. Rolled back rows still
+take up space until the next VACUUM, so only use this on test databases.
+
+Usage:
+    python3 benchmarks/bench_sent_link.py [-c CONFIG] [-n ITERATIONS] [-d DIRECTIVES]
+
+ * SPDX-License-Identifier: AGPL-3.0-or-later
+"""
+
+import argparse
+from timeit import default_timer as timer
+
+from psycopg2.extras import RealDictConnection
+
+from intelmqmail.cb import read_configuration
+from intelmqmail.db import open_db_connection, enable_sent_link_table, \
+    get_pending_notifications, mark_as_sent
+
+
+def run(label, iterations, func):
+    start = timer()
+    for i in range(iterations):
+        func(i)
+    time_spent = timer() - start
+    print(f"{label:45s} {iterations / time_spent:10.1f}/s"
+          f" {1000 * time_spent / iterations:8.3f} ms per call")
+
+
+def table_sizes(cur):
+    cur.execute("SELECT pg_total_relation_size('directives') AS directives,"
+                "       pg_total_relation_size('directive_sent') AS directive_sent")
+    return cur.fetchone()
+
+
+def mark_directives(cur, directive_ids, variant, i):
+    # The savepoint allows marking the same directives again in the next
+    # iteration, which would violate the primary key of directive_sent.
+    cur.execute("SAVEPOINT bench;")
+    mark_as_sent(cur, directive_ids, f"BENCH{variant[0].upper()}-{i:08d}", "now")
+    cur.execute("ROLLBACK TO SAVEPOINT bench;")
+
+
+def benchmark(config, link_table, iterations, num_directives):
+    conn = open_db_connection(config, connection_factory=RealDictConnection)
+    try:
+        if link_table:
+            enable_sent_link_table(conn)
+        variant = "link table" if link_table else "sent_id"
+        cur = conn.cursor()
+        cur.execute("SET TIME ZONE 'UTC';")
+        cur.execute("SELECT id FROM directives ORDER BY id DESC LIMIT %s", (num_directives,))
+        directive_ids = [row["id"] for row in cur.fetchall()]
+
+        run(f"get_pending_notifications ({variant})", max(1, iterations // 100),
+            lambda i: get_pending_notifications(cur, lock=False))
+
+        before = table_sizes(cur)
+        run(f"mark_as_sent ({len(directive_ids)} directives, {variant})", iterations,
+            lambda i: mark_directives(cur, directive_ids, variant, i))
+        after = table_sizes(cur)
+        for table in ("directives", "directive_sent"):
+            print(f"    {table} grew by {(after[table] - before[table]) // 1024} kB")
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('-c', '--config',
+                        help='Alternative system configuration file')
+    parser.add_argument('-n', '--iterations', default=1000, type=int,
+                        help='Number of mark_as_sent calls')
+    parser.add_argument('-d', '--directives', default=10, type=int,
+                        help='Number of directives to mark per call')
+    args = parser.parse_args()
+
+    config = read_configuration(conf_file_path=args.config)
+    for link_table in (False, True):
+        benchmark(config, link_table, args.iterations, args.directives)
+
+
+if __name__ == '__main__':
+    main()
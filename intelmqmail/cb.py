@@ -32,23 +32,30 @@ Requires at least Python 3.2 because of DictWriter.writeheader()
 
 import smtplib
 import argparse
+import collections
+import contextlib
+import itertools
 import json
 import locale
 import logging
 import os
+import socket
 import sys
 from typing import Dict, Union, List
 
-import gpg
 from psycopg2.extras import RealDictConnection
 from psycopg2.extensions import connection as psycopg2_connection
 
 
-from intelmqmail.db import open_db_connection, get_pending_notifications
+from intelmqmail.db import open_db_connection, open_replica_connection, \
+    open_db_pool, enable_prepared_statements, enable_sent_link_table, \
+    enable_lease_claims, get_pending_notifications, claim_pending_notifications, release_claims, \
+    lock_pending_groups, expand_queued_directives, TicketAllocator
+from intelmqmail.mail import get_signer, close_signers, MailFactory, SigningPool
 from intelmqmail.script import load_scripts
-from intelmqmail.notification import Directive, SendContext, ScriptContext, \
-    Postponed
-from intelmqmail.templates import Template
+from intelmqmail.notification import Directive, SendContext, SentBuffer, \
+    ScriptContext, Postponed
+from intelmqmail.templates import Template, template_from_string
 from intelmqmail.tableformat import TableFormat
 
 from typing import Optional
@@ -88,6 +95,7 @@ https://github.com/Intevation/intelmq-mailgen/blob/master/docs/concept.rst
 USAGE = """
     {appname}
     {appname} --all
+    {appname} --count-only
 
 """.format(appname=APPNAME)
 
@@ -141,10 +149,14 @@ def load_script_entry_points(config):
 
 def create_notifications(cur, directive, config, scripts, gpgme_ctx, template: Optional[Template] = None,
                          templates: Optional[Dict[str, Template]] = None,
-                         default_format_spec: Optional[TableFormat] = None):
+                         default_format_spec: Optional[TableFormat] = None, read_cur=None,
+                         ticket_allocator: Optional[TicketAllocator] = None, render_lazily: bool = False,
+                         mail_factory: Optional[MailFactory] = None):
     script_context = ScriptContext(config, cur, gpgme_ctx,
                                    Directive(**directive), log, template=template, templates=templates,
-                                   default_format_spec=default_format_spec)
+                                   default_format_spec=default_format_spec, read_cursor=read_cur,
+                                   ticket_allocator=ticket_allocator, render_lazily=render_lazily,
+                                   mail_factory=mail_factory)
     for script in scripts:
         log.debug("Calling script %r", script.filename)
         try:
@@ -163,7 +175,8 @@ def create_notifications(cur, directive, config, scripts, gpgme_ctx, template: O
 def send_notifications(config, directives, cur, scripts, template: Optional[Template] = None,
                        templates: Optional[Dict[str, Template]] = None,
                        dry_run: bool = False, get_preview: bool = False,
-                       default_format_spec: Optional[TableFormat] = None) -> Union[int, List[str]]:
+                       default_format_spec: Optional[TableFormat] = None,
+                       read_cur=None, count_only: bool = False) -> Union[int, List[str]]:
     """
     Create and send notification mails for all items in directives.
 
@@ -174,6 +187,10 @@ def send_notifications(config, directives, cur, scripts, template: Optional[Temp
     caller should also catch exceptions thrown by this method and always
     commit the transaction.
 
+    When signing with a SigningPool, the notifications of as many further
+    directives as the pool has processes are created before the mails of
+    a directive are sent, so that their mails are signed in the meantime.
+
     :param config script configuration
     :param directives a list of aggregated_directives
     :param cur database cursor to use when loading event information
@@ -181,6 +198,9 @@ def send_notifications(config, directives, cur, scripts, template: Optional[Temp
     :param templates
     :param dry_run if true, don't send the mail, rollback database changes
     :param get_preview return content of first email
+    :param read_cur optional cursor on a read-only replica used for loading events
+    :param count_only if true, only count the notifications like a dry run.
+        Notifications created lazily, like those of mail_format_as_csv, are not rendered.
 
     :returns: number of sent mails, or if get_preview is True a list of notifications
     """
@@ -190,63 +210,78 @@ def send_notifications(config, directives, cur, scripts, template: Optional[Temp
     gpgme_ctx = None
 
     if config["openpgp"]["always_sign"]:
-        gpgme_ctx = gpg.Context(home_dir=config["openpgp"]["gnupg_home"])
-        signing_key = gpgme_ctx.get_key(config["openpgp"]["signing_key"])
-        gpgme_ctx.signers = [signing_key]
+        gpgme_ctx = get_signer(config["openpgp"]["gnupg_home"],
+                               config["openpgp"]["signing_key"],
+                               config["openpgp"].get("signing_processes", 0)).context()
+
+    ticket_allocator = None
+    ticket_block_size = config['database'].get('ticket_block_size', 1)
+    if ticket_block_size > 1 and not get_preview:
+        ticket_allocator = TicketAllocator(ticket_block_size)
+
+    # the same for all mails of this run
+    mail_factory = MailFactory(config.get("sender"))
+
+    sent_buffer = None
+    mark_as_sent_batch_size = config['database'].get('mark_as_sent_batch_size', 1)
+    dry_run = dry_run or count_only
+    if mark_as_sent_batch_size > 1 and not (dry_run or get_preview):
+        sent_buffer = SentBuffer(cur, mark_as_sent_batch_size)
 
     if get_preview:
         preview_notifications = []
 
-    for directive in directives:
-        # When processing a directive, we set a savepoint in the
-        # database so that we can roll back to it if errors happen
-        # and still retain and later commit the changes made for
-        # directives processed earlier. For this to work, we have to
-        # be careful when handling exceptions. Any exception that
-        # could be an error, particularly exceptions that indicate a
-        # problem with the database transaction must lead to a
-        # "ROLLBACK TO SAVEPOINT". Otherwise, if the transaction has
-        # encountered an error, no statements other than rollbacks
-        # will be accepted by the database and we would lose the
-        # changes we want to commit.
-        #
-        # Among the changes we want to commit are the information
-        # about the sent notifications and the ticket numbers,
-        # including the daily reset of the ticket numbers. Not
-        # committing this could lead to notifications being sent
-        # twice and the same ticket numbers being reused for
-        # different notifications.
+    # With a SigningPool, the notifications of up to that many further
+    # directives are created, which submits the data of their mails for
+    # signing, before waiting for the signatures of the mails to send.
+    lookahead = 0
+    if isinstance(gpgme_ctx, SigningPool) and not count_only:
+        lookahead = gpgme_ctx.processes
+
+    # directives whose notifications have been created but not sent yet,
+    # with the rendered notifications
+    prepared = collections.deque()
+
+    # When processing a directive, we set a savepoint in the database
+    # so that we can roll back to it if errors happen and still retain
+    # and later commit the changes made for directives processed
+    # earlier. For this to work, we have to be careful when handling
+    # exceptions. Any exception that could be an error, particularly
+    # exceptions that indicate a problem with the database transaction
+    # must lead to a "ROLLBACK TO SAVEPOINT". Otherwise, if the
+    # transaction has encountered an error, no statements other than
+    # rollbacks will be accepted by the database and we would lose the
+    # changes we want to commit.
+    #
+    # Among the changes we want to commit are the information about the
+    # sent notifications and the ticket numbers, including the daily
+    # reset of the ticket numbers. Not committing this could lead to
+    # notifications being sent twice and the same ticket numbers being
+    # reused for different notifications.
+    #
+    # Creating the notifications of a directive and sending them have
+    # their own savepoints, which are released before the next one is
+    # set. So with the look-ahead, the notifications of later directives
+    # can be created before the earlier ones are sent without nesting
+    # the savepoints, and the directives are still marked as sent in
+    # their order.
+
+    @contextlib.contextmanager
+    def directive_savepoint(directive):
+        nonlocal errors
         cur.execute("SAVEPOINT sendmail;")
+        if sent_buffer is not None:
+            sent_buffer.savepoint()
+        if ticket_allocator is not None:
+            ticket_allocator.savepoint()
         try:
-            notifications = create_notifications(cur, directive, config,
-                                                 scripts, gpgme_ctx, template=template, templates=templates,
-                                                 default_format_spec=default_format_spec)
-
-            if not notifications:
-                log.warning("No emails for sending were generated for %r!",
-                            directive)
-                # A directive which is neither postponed, nor sent is an error. Previously this threw an exception with traceback
-                # See https://github.com/Intevation/intelmq-mailgen/issues/48
-                errors += 1
-            elif notifications is Postponed:
-                postponed += 1
-            else:
-                with smtplib.SMTP(host=config["smtp"]["host"],
-                                  port=config["smtp"]["port"]) as smtp:
-                    context = SendContext(cur, smtp)
-                    for notification in notifications:
-                        if get_preview:
-                            preview_notifications.append(str(notification.email))
-                        elif dry_run:
-                            log.debug("Skip sending notification (to %r%s with subject %r) because of dry run.",
-                                      notification.email.get('To'),
-                                      f' with envelope to "{", ".join(notification.envelope_tos)}"' if notification.envelope_tos else '',
-                                      notification.email.get('Subject'))
-                        else:
-                            notification.send(context)
-                        sent_mails += 1
+            yield
         except BaseException as exc:
             cur.execute("ROLLBACK TO SAVEPOINT sendmail;")
+            if sent_buffer is not None:
+                sent_buffer.rollback_to_savepoint()
+            if ticket_allocator is not None:
+                ticket_allocator.rollback_to_savepoint()
             # if it's a "normal" exception, assume that it's a
             # problem with the directive or the scripts that process
             # it. Simply try the next directives. If it's a not a
@@ -259,18 +294,160 @@ def send_notifications(config, directives, cur, scripts, template: Optional[Temp
                               directive)
                 errors += 1
             else:
+                # the caller commits the transaction anyway, so the
+                # notifications sent so far have to be marked as sent
+                if sent_buffer is not None:
+                    sent_buffer.flush()
                 raise
         finally:
             if dry_run or get_preview:
                 cur.execute("ROLLBACK TO SAVEPOINT sendmail;")
+                if ticket_allocator is not None:
+                    ticket_allocator.rollback_to_savepoint()
             else:
                 cur.execute("RELEASE SAVEPOINT sendmail;")
+                if sent_buffer is not None and sent_buffer.is_full():
+                    sent_buffer.flush()
+
+    def prepare(directive):
+        nonlocal sent_mails, postponed, errors
+        with directive_savepoint(directive):
+            notifications = create_notifications(cur, directive, config,
+                                                 scripts, gpgme_ctx, template=template, templates=templates,
+                                                 default_format_spec=default_format_spec, read_cur=read_cur,
+                                                 ticket_allocator=ticket_allocator, render_lazily=count_only,
+                                                 mail_factory=mail_factory)
+
+            if not notifications:
+                log.warning("No emails for sending were generated for %r!",
+                            directive)
+                # A directive which is neither postponed, nor sent is an error. Previously this threw an exception with traceback
+                # See https://github.com/Intevation/intelmq-mailgen/issues/48
+                errors += 1
+            elif notifications is Postponed:
+                postponed += 1
+            elif count_only:
+                sent_mails += len(notifications)
+            else:
+                prepared.append((directive, list(itertools.chain.from_iterable(
+                    n.rendered() for n in notifications))))
+
+    def send(directive, notifications):
+        nonlocal sent_mails
+        with directive_savepoint(directive):
+            with smtplib.SMTP(host=config["smtp"]["host"],
+                              port=config["smtp"]["port"]) as smtp:
+                context = SendContext(cur, smtp, sent_buffer=sent_buffer)
+                for notification in notifications:
+                    if get_preview:
+                        preview_notifications.append(str(notification.email))
+                    elif dry_run:
+                        log.debug("Skip sending notification (to %r%s with subject %r) because of dry run.",
+                                  notification.email.get('To'),
+                                  f' with envelope to "{", ".join(notification.envelope_tos)}"' if notification.envelope_tos else '',
+                                  notification.email.get('Subject'))
+                    else:
+                        notification.send(context)
+                    sent_mails += 1
+
+    for directive in directives:
+        prepare(directive)
+        while len(prepared) > lookahead:
+            send(*prepared.popleft())
+    while prepared:
+        send(*prepared.popleft())
+    if sent_buffer is not None:
+        sent_buffer.flush()
     if get_preview:
         return preview_notifications
     return (sent_mails, postponed, errors)
 
 
-def generate_notifications_interactively(config, cur, directives, scripts, dry_run: bool = False, batch_size: int = 10):
+def send_notifications_in_chunks(config, cur, scripts, chunk_size: int,
+                                 template: Optional[Template] = None,
+                                 templates: Optional[Dict[str, Template]] = None,
+                                 dry_run: bool = False,
+                                 default_format_spec: Optional[TableFormat] = None,
+                                 read_cur=None, additional_directive_where: Optional[str] = None,
+                                 worker: Optional[str] = None, lease_seconds: Optional[int] = None,
+                                 advisory_locks: bool = False):
+    """
+    Process all pending directives in chunks with one transaction each.
+
+    The pending directives are locked and sent chunk_size groups at a
+    time, and the transaction is committed after each chunk. This keeps
+    the time the rows are locked short and makes the sent notifications
+    durable early. Directives which are postponed or fail are not tried
+    again in later chunks of the same run.
+
+    If worker is given, the directives of a chunk are claimed for the
+    worker for lease_seconds with claim_pending_notifications instead of
+    being locked, so that several workers can run concurrently. The
+    claims of the directives that were not sent are released after the
+    chunk. With advisory_locks, the groups of a chunk are locked with
+    lock_pending_groups instead of locking each directive.
+
+    :returns: None if the first chunk could not be locked, otherwise a
+        tuple (number of groups, sent mails, postponed, errors)
+    """
+    groups = sent_mails = postponed = errors = 0
+    after = None
+    while True:
+        chunk_end = None
+        if worker is not None:
+            directives = claim_pending_notifications(cur, worker, lease_seconds,
+                                                     additional_directive_where=additional_directive_where,
+                                                     limit=chunk_size, after=after)
+            if not dry_run:
+                # make the claims visible to the other workers
+                cur.connection.commit()
+        elif advisory_locks:
+            locked_groups = lock_pending_groups(cur, additional_directive_where=additional_directive_where,
+                                                limit=chunk_size, after=after)
+            if not locked_groups:
+                break
+            directives = get_pending_notifications(cur, additional_directive_where=additional_directive_where,
+                                                   lock=False,
+                                                   group_hashes=[group["group_hash"] for group in locked_groups])
+            # Some of the groups may have been sent by another process
+            # in the meantime, so continue after the locked groups.
+            chunk_end = locked_groups[-1]
+        else:
+            directives = get_pending_notifications(cur,
+                                                   additional_directive_where=additional_directive_where,
+                                                   limit=chunk_size, after=after)
+        if directives is None:
+            if after is None:
+                return None
+            # Another process has locked some of the directives in the
+            # meantime. Leave them, and the rest, to that process.
+            break
+        if not directives and chunk_end is None:
+            break
+        log.debug("Processing chunk of %d groups of directives", len(directives))
+        groups += len(directives)
+        chunk_sent, chunk_postponed, chunk_errors = send_notifications(
+            config, directives, cur, scripts, template, templates, dry_run=dry_run,
+            default_format_spec=default_format_spec, read_cur=read_cur)
+        sent_mails += chunk_sent
+        postponed += chunk_postponed
+        errors += chunk_errors
+        if worker is not None and not dry_run:
+            release_claims(cur, worker, [directive_id for directive in directives
+                                         for directive_id in directive["directive_ids"]])
+        if dry_run:
+            cur.connection.rollback()
+        else:
+            cur.connection.commit()
+        if read_cur is not None:
+            # start a new snapshot on the replica for the next chunk
+            read_cur.connection.rollback()
+        after = chunk_end if chunk_end is not None else directives[-1]
+    return groups, sent_mails, postponed, errors
+
+
+def generate_notifications_interactively(config, cur, directives, scripts, dry_run: bool = False, batch_size: int = 10,
+                                         read_cur=None):
     pending = directives[:]
     while pending:
         batch, pending = pending[:batch_size], pending[batch_size:]
@@ -302,13 +479,16 @@ def generate_notifications_interactively(config, cur, directives, scripts, dry_r
 
             print(f"Sending mails for {len(to_send)} entries... ")
             sent_mails, postponed, errors = send_notifications(config, to_send, cur,
-                                                               scripts, dry_run=dry_run)
+                                                               scripts, dry_run=dry_run, read_cur=read_cur)
             print(f"%s{sent_mails} mails sent, {postponed} postponed, {errors} errors." % ('Simulation: ' if dry_run else ''))
 
 
-def mailgen(config: dict, scripts: list, process_all: bool = False, template: Optional[str] = None, templates: Optional[Dict[str, str]] = None,
+def mailgen(config: dict, scripts: list, process_all: bool = False, template: Union[str, Template, None] = None,
+            templates: Optional[Dict[str, Union[str, Template]]] = None,
             dry_run: bool = False, get_preview: bool = False, conn: Optional[psycopg2_connection] = None,
-            additional_directive_where=Optional[str], default_format_spec: Optional[TableFormat] = None, batch_size: Optional[int] = None) -> str:
+            additional_directive_where=Optional[str], default_format_spec: Optional[TableFormat] = None, batch_size: Optional[int] = None,
+            replica_conn: Optional[psycopg2_connection] = None, close_conn: bool = True,
+            count_only: bool = False) -> str:
     """
     Run mailgen either interactively (process_all=False) or non-interactively (process_all=True)
 
@@ -316,16 +496,31 @@ def mailgen(config: dict, scripts: list, process_all: bool = False, template: Op
         config
         scripts
         process_all: See above
-        template: Fallback template as string, optional
-        templates: Dictionary of templates with items name: body, optional. Overrides any template files in the template directory
+        template: Fallback template as string or Template object, optional
+        templates: Dictionary of templates with items name: body, optional. Overrides any template files in the template directory.
+            The bodies may also be Template objects.
         dry_run: If true, rollbacks at the end
         get_preview: Returns the result of the first send_notifications call
         conn: Database connection, optional
+            If the configuration has a database.replica section, events are
+            loaded from a read-only connection to that replica. In preview
+            mode, the pending directives are also read from the replica.
         additional_directive_where: Additional WHERE selector for the directives. If not given, use the one from the config. Details see docs.
+        replica_conn: Connection to the database replica, optional.
+            If not given, it is opened if the configuration has a database.replica section.
+        close_conn: If true (the default), close the connections at the end.
+            The transactions are ended in any case.
+        count_only: If true, only count the notifications that would be sent for all
+            pending directives, as a dry run without locking the directives. The mails
+            created by mail_format_as_csv are not rendered and no ticket numbers drawn.
     """
-    if dry_run:
+    if count_only:
+        log.info("Only counting the notifications.")
+        process_all = dry_run = True
+    elif dry_run:
         log.info("Running dry-run mode. Not sending mails and not writing changes to the database. Simulation only.")
     cur = None
+    read_cur = None
     if not conn:
         log.debug("Opening database connection")
         conn = open_db_connection(config, connection_factory=RealDictConnection)
@@ -333,26 +528,85 @@ def mailgen(config: dict, scripts: list, process_all: bool = False, template: Op
         additional_directive_where = config['database'].get('additional_directive_where')
 
     result = None
-    if template:
+    if isinstance(template, str):
         # convert string template to Template object
-        template = template.strip()
-        subject = template[:template.find('\n')]  # first line
-        body = template[template.find('\n') + 1:] + '\n'  # rest plus trailing newline
-        template = Template.from_strings(subject, body)
+        template = template_from_string(template)
     if templates:
-        for template_name in templates:
-            # convert string template to Template object
-            template_strip = templates[template_name].strip()
-            subject = template_strip[:template_strip.find('\n')]  # first line
-            body = template_strip[template_strip.find('\n') + 1:] + '\n'  # rest plus trailing newline
-            templates[template_name] = Template.from_strings(subject, body)
+        # convert string templates to Template objects
+        templates = {template_name: template_from_string(body) if isinstance(body, str) else body
+                     for template_name, body in templates.items()}
 
     try:
+        # inside the try, so that conn is closed if this fails
+        if replica_conn is None:
+            replica_conn = open_replica_connection(config, connection_factory=RealDictConnection)
+        if config['database'].get('prepared_statements'):
+            enable_prepared_statements(conn)
+            if replica_conn is not None:
+                enable_prepared_statements(replica_conn)
+        if config['database'].get('sent_link_table'):
+            enable_sent_link_table(conn)
+            if replica_conn is not None:
+                enable_sent_link_table(replica_conn)
+        if config['database'].get('claim_mode') == 'lease':
+            enable_lease_claims(conn)
+
         cur = conn.cursor()
         cur.execute("SET TIME ZONE 'UTC';")
+        if replica_conn is not None:
+            log.debug("Using database replica for reading events")
+            read_cur = replica_conn.cursor()
+            read_cur.execute("SET TIME ZONE 'UTC';")
+        if config['database'].get('expand_directive_queue'):
+            log.info("Expanded %d queued directives", expand_queued_directives(cur))
+            if not (dry_run or get_preview):
+                # the directives are available to other workers even if
+                # this run fails
+                conn.commit()
+
+        commit_chunk_size = config['database'].get('commit_chunk_size')
+        worker = lease_seconds = None
+        claim_mode = config['database'].get('claim_mode')
+        if claim_mode == 'lease':
+            worker = config['database'].get('claim_worker') or f'{socket.gethostname()}:{os.getpid()}'
+            lease_seconds = config['database'].get('claim_lease_seconds', 900)
+        if claim_mode in ('lease', 'advisory'):
+            commit_chunk_size = commit_chunk_size or 100
+        if process_all and commit_chunk_size and not (get_preview or count_only):
+            log.debug("Processing pending directives in chunks of %d groups%s", commit_chunk_size,
+                      f' as worker {worker!r}' if worker else '')
+            chunk_result = send_notifications_in_chunks(config, cur, scripts, commit_chunk_size,
+                                                        template, templates, dry_run=dry_run,
+                                                        default_format_spec=default_format_spec,
+                                                        read_cur=read_cur,
+                                                        additional_directive_where=additional_directive_where,
+                                                        worker=worker, lease_seconds=lease_seconds,
+                                                        advisory_locks=claim_mode == 'advisory')
+            if chunk_result is None:
+                # This case has been logged by get_pending_notifications.
+                return "No directives"
+            groups, sent_mails, postponed, errors = chunk_result
+            if groups == 0:
+                log.info("No pending notifications to be sent")
+                return "No pending notifications to be sent"
+            result = f"%s{sent_mails} mails sent, {postponed} postponed, {errors} errors." % ('Simulation: ' if dry_run else '')
+            log.info(result)
+            return result
+
         log.debug("Fetching pending directives")
-        directives = get_pending_notifications(cur,
-                                               additional_directive_where=additional_directive_where)
+        if (get_preview or count_only) and read_cur is not None:
+            # Nothing will be marked as sent in preview mode, so there's
+            # no need to lock the directives on the primary.
+            directives = get_pending_notifications(read_cur,
+                                                   additional_directive_where=additional_directive_where,
+                                                   lock=False)
+        elif count_only:
+            directives = get_pending_notifications(cur,
+                                                   additional_directive_where=additional_directive_where,
+                                                   lock=False)
+        else:
+            directives = get_pending_notifications(cur,
+                                                   additional_directive_where=additional_directive_where)
         if directives is None:
             # This case has been logged by get_pending_notifications.
             return [] if get_preview else "No directives"
@@ -366,18 +620,28 @@ def mailgen(config: dict, scripts: list, process_all: bool = False, template: Op
             log.debug("Start processing directives")
             if get_preview:
                 return send_notifications(config, directives, cur, scripts, template, templates, dry_run=dry_run, get_preview=get_preview,
-                                          default_format_spec=default_format_spec)
+                                          default_format_spec=default_format_spec, read_cur=read_cur)
             sent_mails, postponed, errors = send_notifications(config, directives, cur,
                                                                scripts, template, templates, dry_run=dry_run,
-                                                               default_format_spec=default_format_spec)
-            result = f"%s{sent_mails} mails sent, {postponed} postponed, {errors} errors." % ('Simulation: ' if dry_run else '')
+                                                               default_format_spec=default_format_spec,
+                                                               read_cur=read_cur, count_only=count_only)
+            if count_only:
+                result = f"Count only: {sent_mails} notifications, {postponed} postponed, {errors} errors."
+            else:
+                result = f"%s{sent_mails} mails sent, {postponed} postponed, {errors} errors." % ('Simulation: ' if dry_run else '')
             log.info(result)
         else:
             generate_notifications_interactively(config, cur, directives,
-                                                 scripts, dry_run=dry_run, batch_size=batch_size)
+                                                 scripts, dry_run=dry_run, batch_size=batch_size,
+                                                 read_cur=read_cur)
     finally:
         if cur is not None:
             cur.close()
+        if replica_conn is not None:
+            # nothing to commit on the read-only replica
+            replica_conn.rollback()
+            if close_conn:
+                replica_conn.close()
 
         if dry_run or get_preview:
             conn.rollback()
@@ -387,7 +651,8 @@ def mailgen(config: dict, scripts: list, process_all: bool = False, template: Op
             # when errors occur, so we're calling commit in the finally
             # block.
             conn.commit()
-        conn.close()
+        if close_conn:
+            conn.close()
 
     if result:
         return result
@@ -414,6 +679,9 @@ def main():
                         help='Dry run. Simulate only.')
     parser.add_argument('-N', '--batch-size', default=10, type=int,
                         help='Size of the batches to process when run interactively')
+    parser.add_argument('--count-only', action='store_true',
+                        help='Only count the notifications for all pending directives, without rendering'
+                        ' or sending them. Implies --all and --dry-run.')
     args = parser.parse_args()
 
     config = read_configuration(conf_file_path=args.config)
@@ -427,33 +695,125 @@ def main():
         global debug_level
         debug_level = args.verbose
 
-    start(config, process_all=args.all, dry_run=args.dry_run, batch_size=args.batch_size)
+    try:
+        start(config, process_all=args.all, dry_run=args.dry_run, batch_size=args.batch_size,
+              count_only=args.count_only)
+    finally:
+        # stop the signing processes, if any
+        close_signers()
 
 
 def start(config: dict, process_all=False, template: Optional[str] = None, templates: Optional[Dict[str, str]] = None,
           dry_run: bool = False, get_preview: bool = False, conn: Optional[psycopg2_connection] = None,
           additional_directive_where: Optional[str] = None, default_format_spec: Optional[TableFormat] = None,
-          batch_size: Optional[int] = None) -> str:
+          batch_size: Optional[int] = None, count_only: bool = False) -> str:
     """
     Start mailgen
     can be used by other programs
+
+    Programs calling this repeatedly should consider using a Session instead.
+    """
+    scripts = check_config_and_load_scripts(config)
+
+    return mailgen(config, scripts, process_all=process_all, template=template, templates=templates, dry_run=dry_run,
+                   get_preview=get_preview, conn=conn, additional_directive_where=additional_directive_where,
+                   default_format_spec=default_format_spec, batch_size=batch_size, count_only=count_only)
+
+
+def check_config_and_load_scripts(config: dict) -> list:
+    """Check the configuration and load the scripts.
+    Exits if the configuration is incomplete or no scripts can be loaded.
     """
     # checking openpgp config
-    if "openpgp" not in config or {
+    if "openpgp" not in config or not {
             "always_sign", "gnupg_home", "signing_key"
-    } != config["openpgp"].keys():
+    } <= config["openpgp"].keys():
         log.critical("Config section openpgp missing or incomplete. Exiting.")
         sys.exit(1)
 
+    compression = config.get("compress_attachments", {}).get("compression")
+    if compression not in (None, "gzip", "zip"):
+        log.critical("Unknown compression %r in config section compress_attachments,"
+                     " expected \"gzip\" or \"zip\". Exiting.", compression)
+        sys.exit(1)
+
     scripts = load_script_entry_points(config)
     if not scripts:
         log.error("Could not load any scripts from %r",
                   config["script_directory"])
         sys.exit(1)
+    return scripts
 
-    return mailgen(config, scripts, process_all=process_all, template=template, templates=templates, dry_run=dry_run,
-                   get_preview=get_preview, conn=conn, additional_directive_where=additional_directive_where,
-                   default_format_spec=default_format_spec, batch_size=batch_size)
+
+class Session:
+    """Mailgen state that is reused across several runs.
+
+    Programs embedding mailgen that call start() repeatedly, e.g. IntelMQ
+    Webinput CSV for its previews, pay for loading the scripts and
+    connecting to the database on every call. A session loads the
+    scripts once and keeps a pool of database connections, and of
+    replica connections if a replica is configured. Templates are cached
+    by intelmqmail.templates in any case. Use the session's start
+    method instead of the start function.
+
+    Sessions can be shared between threads. Close the session with
+    close() or use it as a context manager.
+    """
+
+    def __init__(self, config: dict, min_connections: int = 1, max_connections: int = 4):
+        self.config = config
+        self.scripts = check_config_and_load_scripts(config)
+        self.pool = open_db_pool(config, min_connections, max_connections,
+                                 connection_factory=RealDictConnection)
+        self.replica_pool = None
+        if config['database'].get('replica'):
+            self.replica_pool = open_db_pool(config, min_connections, max_connections,
+                                             connection_factory=RealDictConnection,
+                                             section='replica')
+
+    def start(self, process_all=False, template: Union[str, Template, None] = None,
+              templates: Optional[Dict[str, Union[str, Template]]] = None,
+              dry_run: bool = False, get_preview: bool = False,
+              additional_directive_where: Optional[str] = None, default_format_spec: Optional[TableFormat] = None,
+              batch_size: Optional[int] = None, count_only: bool = False) -> str:
+        """Run mailgen with pooled connections. See the start function for the parameters."""
+        conn = self.pool.getconn()
+        replica_conn = None
+        try:
+            if self.replica_pool is not None:
+                replica_conn = self.replica_pool.getconn()
+                replica_conn.set_session(readonly=True)
+            return mailgen(self.config, self.scripts, process_all=process_all, template=template, templates=templates,
+                           dry_run=dry_run, get_preview=get_preview, conn=conn, replica_conn=replica_conn,
+                           additional_directive_where=additional_directive_where,
+                           default_format_spec=default_format_spec, batch_size=batch_size, close_conn=False,
+                           count_only=count_only)
+        finally:
+            self.pool.putconn(conn)
+            if replica_conn is not None:
+                self.replica_pool.putconn(replica_conn)
+
+    def close(self):
+        """Close all pooled connections and stop the signing processes.
+
+        The signing processes are shared with other sessions in the
+        process, which start new ones when they need them.
+        """
+        try:
+            self.pool.closeall()
+            if self.replica_pool is not None:
+                self.replica_pool.closeall()
+        finally:
+            close_signers()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return f'Session(scripts={self.scripts!r}, pool={self.pool!r}, replica_pool={self.replica_pool!r})'
 
 
 # to lower the chance of problems like
@@ -1,11 +1,16 @@
 """Access to the event/notification database."""
 
 import string
+import hashlib
 import logging
-from typing import Optional
+import weakref
+import collections
+from typing import List, Optional
 
 import psycopg2
 import psycopg2.errorcodes
+import psycopg2.extensions
+import psycopg2.pool
 
 from psycopg2.extensions import connection as psycopg2_connection
 
@@ -13,23 +18,171 @@ from psycopg2.extensions import connection as psycopg2_connection
 log = logging.getLogger(__name__)
 
 
-def open_db_connection(config, connection_factory=None) -> psycopg2_connection:
+def open_db_connection(config, connection_factory=None,
+                       section: str = 'event') -> psycopg2_connection:
     """Opens a psycopg2 database connection.
 
     Does not set autocommit, so using code must take
     care about transaction handling itself.
+
+    The connection parameters are read from the given section of the
+    database configuration, by default the primary event database.
+    """
+    return psycopg2.connect(connection_factory=connection_factory,
+                            **connection_parameters(config, section))
+
+
+def connection_parameters(config, section: str = 'event') -> dict:
+    """Return the psycopg2 connection parameters for a database section.
+    """
+    params = config['database'][section]
+    return dict(database=params['name'],
+                user=params['username'],
+                password=params['password'],
+                host=params['host'],
+                port=params['port'],
+                # sslmode=params['sslmode'],
+                )
+
+
+def open_db_pool(config, minconn: int, maxconn: int, connection_factory=None,
+                 section: str = 'event') -> psycopg2.pool.ThreadedConnectionPool:
+    """Create a thread-safe pool of psycopg2 database connections.
+
+    The pool opens minconn connections immediately and keeps up to that
+    many idle connections open. More connections, up to maxconn, are
+    opened on demand. The connections are subject to the same
+    transaction handling rules as the ones from open_db_connection.
+    """
+    return psycopg2.pool.ThreadedConnectionPool(minconn, maxconn,
+                                                connection_factory=connection_factory,
+                                                **connection_parameters(config, section))
+
+
+def open_replica_connection(config, connection_factory=None) -> Optional[psycopg2_connection]:
+    """Opens a read-only connection to the event database replica.
+
+    The replica is configured in the optional ``replica`` section of the
+    database configuration, which takes the same parameters as the
+    ``event`` section. If there is no such section, return None.
+    """
+    if not config['database'].get('replica'):
+        return None
+    conn = open_db_connection(config, connection_factory=connection_factory,
+                              section='replica')
+    conn.set_session(readonly=True)
+    return conn
+
+
+# Maps the connections on which server side prepared statements are used
+# to the set of names of the statements already prepared on them.
+_prepared_statements = weakref.WeakKeyDictionary()
+
+
+def enable_prepared_statements(conn: psycopg2_connection):
+    """Use prepared statements for the frequently run queries on conn.
+
+    The statements of load_events, new_ticket_number and mark_as_sent
+    are then prepared on the connection when they are first used, and
+    later only executed, saving the parsing and planning on the server.
+    Prepared statements are bound to the database session, so this must
+    not be used with a connection pooler that may switch sessions
+    between transactions.
+    """
+    _prepared_statements.setdefault(conn, set())
+
+
+def _execute(cur, name, statement, params=()):
+    """Execute statement with the given parameters.
+
+    The statement uses %s placeholders, like statements passed to
+    cur.execute. If prepared statements are enabled for the connection
+    of cur, the statement is prepared with the given name on first use.
+    """
+    prepared = _prepared_statements.get(cur.connection)
+    if prepared is None:
+        if params:
+            cur.execute(statement, params)
+        else:
+            cur.execute(statement)
+        return
+
+    if name not in prepared:
+        placeholders = tuple(f"${i}" for i in range(1, len(params) + 1))
+        cur.execute(f"PREPARE {name} AS {statement % placeholders}")
+        prepared.add(name)
+    if params:
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cur.execute(f"EXECUTE {name}")
+
+
+# Connections on which the sent state of the directives is recorded in
+# the insert-only table directive_sent instead of directives.sent_id.
+_sent_link_connections = weakref.WeakSet()
+
+
+def enable_sent_link_table(conn: psycopg2_connection):
+    """Record and look up the sent state of directives in directive_sent.
+
+    By default, mark_as_sent sets directives.sent_id, which leaves a dead
+    row version of the directive and new entries in all of its indexes
+    behind. With this, mark_as_sent only inserts into the link table
+    directive_sent, and the queries for the pending directives start
+    from the table directive_pending, which triggers keep up to date.
+    The tables and triggers have to be created and the tables filled as
+    described in sql/updates.md.
     """
-    params = config['database']['event']
-    return psycopg2.connect(database=params['name'],
-                            user=params['username'],
-                            password=params['password'],
-                            host=params['host'],
-                            port=params['port'],
-                            # sslmode=params['sslmode'],
-                            connection_factory=connection_factory)
+    _sent_link_connections.add(conn)
+
+
+def _uses_sent_link_table(cur) -> bool:
+    return cur.connection in _sent_link_connections
+
+
+# Connections of workers in the lease claim mode, on which the queries
+# for the pending directives leave out directives claimed by others.
+_lease_claim_connections = weakref.WeakSet()
+
+
+def enable_lease_claims(conn: psycopg2_connection):
+    """Respect the claims of claim_pending_notifications on conn.
+
+    With this, the queries for the pending directives leave out the
+    directives claimed by other workers until their lease has expired.
+    This requires the columns claimed_by and claimed_until of the
+    directives table, see sql/updates.md.
+    """
+    _lease_claim_connections.add(conn)
+
+
+def _uses_lease_claims(cur) -> bool:
+    return cur.connection in _lease_claim_connections
+
 
+# Conditions for directives (table alias d3) which have not been sent,
+# for the sent_id column and the directive_sent link table, with which
+# directive_pending holds the directives not sent yet.
+UNSENT_CONDITION = "sent_id IS NULL"
+UNSENT_LINK_CONDITION = ("d3.id = ANY (ARRAY(SELECT directive_id"
+                         " FROM directive_pending))")
 
+# The joins for the sent directives (alias d2) in the last_sent
+# subquery of PENDING_DIRECTIVES_QUERY, with and without the link table.
+SENT_JOIN = "JOIN sent s ON d2.sent_id = s.id"
+SENT_LINK_JOIN = """JOIN directive_sent ds ON ds.directive_id = d2.id
+             JOIN sent s ON ds.sent_id = s.id"""
+
+# The columns by which the pending directives are grouped. In chunked
+# mode, the groups are also ordered by these columns.
+PENDING_GROUP_COLUMNS = ("recipient_address", "template_name",
+                         "notification_format", "event_data_format",
+                         "aggregate_identifier")
+
+# Groups the directives given by the {directives} placeholder, which is
+# either PENDING_DIRECTIVES_SELECT or the name of a CTE in {ctes}.
 PENDING_DIRECTIVES_QUERY = """\
+{ctes}
    SELECT d.recipient_address AS recipient_address,
           d.template_name AS template_name,
           d.notification_format AS notification_format,
@@ -41,7 +194,7 @@ PENDING_DIRECTIVES_QUERY = """\
           max(d.notification_interval) AS notification_interval,
           (SELECT s.sent_at
              FROM directives AS d2
-             JOIN sent s ON d2.sent_id = s.id
+             {sent_join}
             WHERE d2.recipient_address = d.recipient_address
               AND d2.template_name = d.template_name
               AND d2.notification_format = d.notification_format
@@ -49,41 +202,210 @@ PENDING_DIRECTIVES_QUERY = """\
               AND d2.aggregate_identifier = d.aggregate_identifier
          ORDER BY d2.inserted_at DESC
             LIMIT 1) AS last_sent
-     FROM (SELECT d3.id, events_id, recipient_address, template_name,
+     FROM {directives} AS d
+ GROUP BY d.recipient_address, d.template_name, d.notification_format,
+          d.event_data_format, d.aggregate_identifier
+{order_clause};
+"""
+
+PENDING_DIRECTIVES_SELECT = """\
+(SELECT d3.id, events_id, recipient_address, template_name,
                   notification_format, event_data_format, notification_interval,
                   aggregate_identifier, inserted_at
              FROM directives AS d3
              {additional_directive_join}
-            WHERE sent_id IS NULL
+            WHERE {unsent_condition}
               AND medium = 'email'
               AND endpoint = 'source'
+              {claim_condition}
               {additional_directive_where}
-            FOR UPDATE NOWAIT) AS d
- GROUP BY d.recipient_address, d.template_name, d.notification_format,
-          d.event_data_format, d.aggregate_identifier;
-"""
+              {chunk_condition}
+            {lock_clause})"""
+
+# Selects the groups of the next chunk in get_pending_notifications.
+# Placeholders are the same as in PENDING_DIRECTIVES_SELECT and the
+# keyset condition for the groups after the previous chunk.
+PENDING_CHUNK_CTE = """\
+chunk AS (
+   SELECT recipient_address, template_name, notification_format,
+          event_data_format, aggregate_identifier
+     FROM directives AS d3
+     {additional_directive_join}
+    WHERE {unsent_condition}
+      AND medium = 'email'
+      AND endpoint = 'source'
+      {claim_condition}
+      {additional_directive_where}
+      {after_condition}
+ GROUP BY recipient_address, template_name, notification_format,
+          event_data_format, aggregate_identifier
+ ORDER BY recipient_address, template_name, notification_format,
+          event_data_format, aggregate_identifier
+    LIMIT {limit:d})"""
+
+# The hash of the grouping columns of a directive, which is used as the
+# key of the advisory locks in lock_pending_groups.
+GROUP_HASH = "hashtext(ROW({})::TEXT)".format(", ".join(PENDING_GROUP_COLUMNS))
+
+# The first argument of pg_try_advisory_xact_lock, to keep the advisory
+# locks of mailgen apart from those of other applications.
+ADVISORY_LOCK_NAMESPACE = 0x6d61696c  # "mail"
+
+# Locks the groups of pending directives with advisory locks, see
+# lock_pending_groups. The inner query is ordered but not limited, and
+# the OFFSET 0 prevents the lock condition from being pushed into it, so
+# that groups are tried in order only until enough have been locked.
+LOCK_PENDING_GROUPS_QUERY = """\
+   SELECT *
+     FROM (SELECT {group_hash} AS group_hash, {group_columns}
+             FROM directives AS d3
+             {additional_directive_join}
+            WHERE {unsent_condition}
+              AND medium = 'email'
+              AND endpoint = 'source'
+              {claim_condition}
+              {additional_directive_where}
+              {after_condition}
+         GROUP BY {group_columns}
+         ORDER BY {group_columns}
+           OFFSET 0) AS groups
+    WHERE pg_try_advisory_xact_lock({namespace:d}, group_hash)
+{limit_clause};"""
+
+# Claims the directives of PENDING_DIRECTIVES_SELECT for a worker, see
+# claim_pending_notifications.
+CLAIM_CTES = """\
+candidates AS {candidates},
+claimed AS (
+   UPDATE directives
+      SET claimed_by = {worker},
+          claimed_until = now() + {lease_seconds:d} * interval '1 second'
+     FROM candidates
+    WHERE directives.id = candidates.id
+RETURNING directives.*)"""
+
+
+def _literal(cur, value):
+    """Return value as an SQL literal.
+    The queries for the pending directives embed values this way instead
+    of passing them as parameters because additional_directive_where may
+    contain percent signs.
+    """
+    return (cur.mogrify("%s", (value,))
+            .decode(psycopg2.extensions.encodings[cur.connection.encoding]))
 
 
-def get_pending_notifications(cur, additional_directive_where: Optional[str] = None):
+def _directive_filters(cur, additional_directive_where: Optional[str] = None,
+                       worker: Optional[str] = None) -> dict:
+    """Return the parts of the queries for the pending directives that
+    select the directives, as keyword arguments for str.format.
+    """
+    additional_directive_join = ""
+    if additional_directive_where:
+        if 'events.' in additional_directive_where:
+            additional_directive_join = "JOIN events ON d3.events_id = events.id"
+        additional_directive_where = f"AND {additional_directive_where}"
+    else:
+        additional_directive_where = ""
+
+    # directives claimed by a worker whose lease has not expired are
+    # left to that worker
+    claim_condition = ""
+    if worker is not None or _uses_lease_claims(cur):
+        claim_condition = "AND (claimed_until IS NULL OR claimed_until < now()"
+        if worker is not None:
+            claim_condition += f" OR claimed_by = {_literal(cur, worker)}"
+        claim_condition += ")"
+
+    if _uses_sent_link_table(cur):
+        unsent_condition, sent_join = UNSENT_LINK_CONDITION, SENT_LINK_JOIN
+    else:
+        unsent_condition, sent_join = UNSENT_CONDITION, SENT_JOIN
+
+    return dict(additional_directive_where=additional_directive_where,
+                additional_directive_join=additional_directive_join,
+                claim_condition=claim_condition,
+                unsent_condition=unsent_condition,
+                sent_join=sent_join)
+
+
+def _after_condition(cur, after: Optional[dict]) -> str:
+    """Return the keyset condition for the groups following after."""
+    if after is None:
+        return ""
+    return "AND ({}) > ({}::TEXT[])".format(
+        ", ".join(PENDING_GROUP_COLUMNS),
+        ", ".join(_literal(cur, after[column]) for column in PENDING_GROUP_COLUMNS))
+
+
+def _pending_directives_query(cur, additional_directive_where: Optional[str] = None,
+                              lock_clause: str = "", limit: Optional[int] = None,
+                              after: Optional[dict] = None, worker: Optional[str] = None,
+                              lease_seconds: int = 0, group_hashes: Optional[list] = None):
+    """Build the query for get_pending_notifications and
+    claim_pending_notifications.
+    """
+    filters = _directive_filters(cur, additional_directive_where, worker)
+
+    ctes = []
+    chunk_condition = order_clause = ""
+    if limit is not None:
+        ctes.append(PENDING_CHUNK_CTE.format(after_condition=_after_condition(cur, after),
+                                             limit=limit, **filters))
+        chunk_condition = f"AND ({', '.join(PENDING_GROUP_COLUMNS)}) IN (SELECT * FROM chunk)"
+    if group_hashes is not None:
+        chunk_condition = f"AND {GROUP_HASH} = ANY ({_literal(cur, group_hashes)}::INTEGER[])"
+    if limit is not None or group_hashes is not None:
+        order_clause = "ORDER BY " + ", ".join(f"d.{column}" for column in PENDING_GROUP_COLUMNS)
+
+    directives = PENDING_DIRECTIVES_SELECT.format(chunk_condition=chunk_condition,
+                                                  lock_clause=lock_clause, **filters)
+    if worker is not None:
+        ctes.append(CLAIM_CTES.format(candidates=directives,
+                                      worker=_literal(cur, worker),
+                                      lease_seconds=lease_seconds))
+        directives = "claimed"
+
+    return PENDING_DIRECTIVES_QUERY.format(ctes="WITH " + ",\n".join(ctes) if ctes else "",
+                                           directives=directives,
+                                           sent_join=filters["sent_join"],
+                                           order_clause=order_clause)
+
+
+def get_pending_notifications(cur, additional_directive_where: Optional[str] = None,
+                              lock: bool = True, limit: Optional[int] = None,
+                              after: Optional[dict] = None,
+                              group_hashes: Optional[List[int]] = None):
     """Retrieve all pending directives from the database.
     Directives are pending if the notification they describe hasn't been
     sent yet and the last time a similar notification has been sent was
     long enough ago that the notification interval has been exceeded.
     The directives are grouped according to the aggregation identifier.
+    Directives claimed by a worker (see claim_pending_notifications)
+    whose lease has not yet expired are left out.
+
+    Unless lock is false, the directives are locked with ``FOR UPDATE
+    NOWAIT``. Without the lock the query can also be run on a read-only
+    replica, which is useful if the directives are not going to be
+    marked as sent, e.g. for previews.
+
+    If limit is given, only the first limit groups are retrieved, in
+    the order of the grouping columns (see PENDING_GROUP_COLUMNS) and
+    only the directives of those groups are locked. With after, one of
+    the groups returned by an earlier call, the groups following it are
+    retrieved. This allows processing the directives in chunks.
+
+    With group_hashes, only the groups with these hashes are retrieved,
+    see lock_pending_groups.
 
     :returns: list of aggregated directives
     :rtype: list
     """
     try:
-        additional_directive_join = ""
-        if additional_directive_where:
-            if 'events.' in additional_directive_where:
-                additional_directive_join = "JOIN events ON d3.events_id = events.id"
-            additional_directive_where = f"AND {additional_directive_where}"
-        else:
-            additional_directive_where = ""
-        cur.execute(PENDING_DIRECTIVES_QUERY.format(additional_directive_where=additional_directive_where,
-                                                    additional_directive_join=additional_directive_join))
+        cur.execute(_pending_directives_query(cur, additional_directive_where,
+                                              lock_clause="FOR UPDATE NOWAIT" if lock else "",
+                                              limit=limit, after=after,
+                                              group_hashes=group_hashes))
     except psycopg2.OperationalError as exc:
         if exc.pgcode == psycopg2.errorcodes.LOCK_NOT_AVAILABLE:
             log.info("Could not get db lock for pending notifications. "
@@ -95,6 +417,94 @@ def get_pending_notifications(cur, additional_directive_where: Optional[str] = N
     return cur.fetchall()
 
 
+def claim_pending_notifications(cur, worker: str, lease_seconds: int,
+                                additional_directive_where: Optional[str] = None,
+                                limit: Optional[int] = None, after: Optional[dict] = None):
+    """Claim pending directives for a worker and return them.
+    This is an alternative to the row locks of get_pending_notifications
+    that allows several workers to process the directives concurrently.
+    The directives are marked with the name of the worker and the time
+    until which the claim is valid (the lease). The claim becomes
+    visible to the other workers when the transaction is committed,
+    which the caller should do right away. Directives locked by other
+    transactions are skipped and directives claimed by another worker
+    are left out until the lease expires. The lease should therefore be
+    long enough to process a chunk of directives.
+
+    The parameters additional_directive_where, limit and after and the
+    return value are the same as for get_pending_notifications. A
+    worker can reclaim its own directives.
+    """
+    cur.execute(_pending_directives_query(cur, additional_directive_where,
+                                          lock_clause="FOR UPDATE OF d3 SKIP LOCKED",
+                                          limit=limit, after=after,
+                                          worker=worker, lease_seconds=lease_seconds))
+    return cur.fetchall()
+
+
+def expand_queued_directives(cur) -> int:
+    """Expand the directives of the events queued in directive_queue.
+    This is only needed if the directives are extracted from the events
+    in mailgen's run instead of when the events are inserted (see
+    sql/updates.md).
+
+    :returns: the number of new directives
+    """
+    cur.execute("SELECT expand_queued_directives() AS directives;")
+    return cur.fetchone()["directives"]
+
+
+def lock_pending_groups(cur, additional_directive_where: Optional[str] = None,
+                        limit: Optional[int] = None, after: Optional[dict] = None):
+    """Lock groups of pending directives with advisory locks.
+    This is an alternative to the row locks of get_pending_notifications
+    whose cost depends on the number of groups instead of the number of
+    directives. Groups are tried in the order of the grouping columns,
+    skipping the ones locked by other transactions, until limit groups
+    have been locked. The locks are held until the end of the
+    transaction. All processes working on the directives concurrently
+    have to use these locks.
+
+    The directives of the locked groups are then retrieved with
+    get_pending_notifications(cur, lock=False, group_hashes=...) in a
+    separate statement. Its snapshot is taken after the locks were
+    acquired, so it does not contain directives that another
+    transaction, which held the lock before, has already sent.
+
+    The parameters are the same as for get_pending_notifications.
+
+    :returns: list of the locked groups with the columns group_hash and
+        the grouping columns, ordered by the latter
+    """
+    group_columns = ", ".join(PENDING_GROUP_COLUMNS)
+    cur.execute(LOCK_PENDING_GROUPS_QUERY.format(
+        group_hash=GROUP_HASH, group_columns=group_columns,
+        after_condition=_after_condition(cur, after),
+        namespace=ADVISORY_LOCK_NAMESPACE,
+        limit_clause=f"    LIMIT {limit:d}" if limit is not None else "",
+        **_directive_filters(cur, additional_directive_where)))
+    return cur.fetchall()
+
+
+def release_claims(cur, worker: str, directive_ids):
+    """Release the claims of the worker on the directives not sent yet.
+    This makes postponed directives and the directives of failed
+    notifications available to other workers before the lease expires.
+    """
+    if _uses_sent_link_table(cur):
+        name, unsent_condition = ("intelmqmail_release_claims_link",
+                                  UNSENT_LINK_CONDITION.replace("d3.", "directives."))
+    else:
+        name, unsent_condition = "intelmqmail_release_claims", UNSENT_CONDITION
+    _execute(cur, name, f"""\
+             UPDATE directives
+                SET claimed_by = NULL, claimed_until = NULL
+              WHERE id = ANY (%s)
+                AND claimed_by = %s
+                AND {unsent_condition};""",
+             (directive_ids, worker))
+
+
 # characters allowed in identifiers in escape_sql_identifier. There are
 # just the characters that are used in IntelMQ for identifiers in the
 # events table.
@@ -123,12 +533,41 @@ def load_events(cur, event_ids, columns=None):
         sql_columns = ", ".join(escape_sql_identifier(col) for col in columns)
     else:
         sql_columns = "*"
-    cur.execute("SELECT {} FROM events WHERE id = ANY (%s)".format(sql_columns),
-                (event_ids,))
+    # the prepared statement depends on the columns, so derive its name
+    # from them
+    statement_name = "intelmqmail_load_events_" + hashlib.sha256(sql_columns.encode()).hexdigest()[:32]
+    _execute(cur, statement_name,
+             "SELECT {} FROM events WHERE id = ANY (%s)".format(sql_columns),
+             (event_ids,))
 
     return cur.fetchall()
 
 
+# Connections for which we know whether the database function
+# intelmq_new_ticket exists, see new_ticket_number.
+_ticket_function = weakref.WeakKeyDictionary()
+
+
+def _has_ticket_function(cur) -> bool:
+    conn = cur.connection
+    if conn not in _ticket_function:
+        cur.execute("SELECT to_regprocedure('intelmq_new_ticket()') IS NOT NULL"
+                    " AS present;")
+        _ticket_function[conn] = cur.fetchone()["present"]
+    return _ticket_function[conn]
+
+
+def _future_ticket_day_error(cur) -> RuntimeError:
+    cur.execute("SELECT to_char(initialized_for_day, 'YYYYMMDD') AS init_date,"
+                " (SELECT last_value FROM intelmq_ticket_day_seq) AS reset_day"
+                " FROM ticket_day;")
+    result = cur.fetchone()
+    return RuntimeError(
+        f"initialized_for_day='{result['init_date']}' or the last reset of the"
+        f" ticket counter ({result['reset_day']}) is in the future from now(). "
+        "Stopping to avoid reusing ticket numbers.")
+
+
 def new_ticket_number(cur):
     """Draw a new unique ticket number.
 
@@ -137,29 +576,31 @@ def new_ticket_number(cur):
     Raise RuntimeError if last initialisation is in the future, because
     we may potentially reuse ticket numbers if we get to this day.
 
+    If the database has the function intelmq_new_ticket (see
+    sql/updates.md), it does all of this in a single statement.
+
     :returns: a unique ticket-number string in format YYYYMMDD-XXXXXXXX
     :rtype: string
     """
+    if _has_ticket_function(cur):
+        _execute(cur, "intelmqmail_new_ticket",
+                 "SELECT intelmq_new_ticket() AS ticket;")
+        ticket = cur.fetchone()["ticket"]
+        if ticket is None:
+            raise _future_ticket_day_error(cur)
+        log.debug('New ticket number %r.', ticket)
+        return ticket
+
     sqlQuery = """SELECT to_char(now(), 'YYYYMMDD') AS date,
                          (SELECT to_char(initialized_for_day, 'YYYYMMDD')
                               FROM ticket_day) AS init_date,
                          nextval('intelmq_ticket_seq');"""
-    cur.execute(sqlQuery)
+    _execute(cur, "intelmqmail_new_ticket_number", sqlQuery)
     result = cur.fetchall()
 
     date_str = result[0]["date"]
-    if date_str != result[0]["init_date"]:
-        if date_str < result[0]["init_date"]:
-            raise RuntimeError(
-                f"initialized_for_day='{result[0]['init_date']}' is in the future from now(). "
-                "Stopping to avoid reusing ticket numbers.")
-
-        log.debug("We have a new day, resetting the ticket generator.")
-        cur.execute("ALTER SEQUENCE intelmq_ticket_seq RESTART;")
-        cur.execute("UPDATE ticket_day SET initialized_for_day=%s;",
-                    (date_str,))
-
-        cur.execute(sqlQuery)
+    if _reset_ticket_day_if_needed(cur, date_str, result[0]["init_date"]):
+        _execute(cur, "intelmqmail_new_ticket_number", sqlQuery)
         result = cur.fetchall()
 
     ticket = _format_ticket(date_str, result[0]["nextval"])
@@ -168,6 +609,100 @@ def new_ticket_number(cur):
     return ticket
 
 
+def _reset_ticket_day_if_needed(cur, date_str, init_date) -> bool:
+    """Reset the ticket counter if date_str is past the initialisation day.
+    Return whether the counter was reset.
+    """
+    if date_str == init_date:
+        return False
+    if date_str < init_date:
+        raise RuntimeError(
+            f"initialized_for_day='{init_date}' is in the future from now(). "
+            "Stopping to avoid reusing ticket numbers.")
+
+    log.debug("We have a new day, resetting the ticket generator.")
+    cur.execute("ALTER SEQUENCE intelmq_ticket_seq RESTART;")
+    cur.execute("UPDATE ticket_day SET initialized_for_day=%s;",
+                (date_str,))
+    return True
+
+
+class TicketAllocator:
+
+    """Draw ticket numbers in blocks.
+
+    new_ticket_number needs a round trip to the database for every
+    ticket number. The allocator draws block_size numbers at once and
+    hands them out one by one.
+
+    The rules for the daily reset are the same as for new_ticket_number.
+    The day of the tickets is that of now(), which is the start of the
+    transaction, so an allocator must only be used in one transaction.
+    mailgen uses a new one for every call of send_notifications.
+
+    A block drawn after savepoint() may have reset the ticket counter,
+    which a rollback to that savepoint can undo. The caller therefore
+    has to call rollback_to_savepoint() then, which discards the block.
+    Numbers that are discarded or left over at the end are never used,
+    so there will be gaps in the ticket numbers.
+    """
+
+    function_query = """SELECT ARRAY(SELECT intelmq_new_ticket()
+                                       FROM generate_series(1, %s::INTEGER)) AS tickets;"""
+
+    reserve_query = """SELECT to_char(now(), 'YYYYMMDD') AS date,
+                              (SELECT to_char(initialized_for_day, 'YYYYMMDD')
+                                 FROM ticket_day) AS init_date,
+                              ARRAY(SELECT nextval('intelmq_ticket_seq')
+                                      FROM generate_series(1, %s::INTEGER)) AS numbers;"""
+
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self._tickets = collections.deque()
+        # whether the current block was drawn after the last savepoint
+        self._reserved_in_savepoint = False
+
+    def new_ticket_number(self, cur) -> str:
+        """Return a unique ticket-number string in format YYYYMMDD-XXXXXXXX.
+        """
+        if not self._tickets:
+            self._reserve(cur)
+            self._reserved_in_savepoint = True
+
+        ticket = self._tickets.popleft()
+        log.debug('New ticket number %r.', ticket)
+        return ticket
+
+    def _reserve(self, cur):
+        if _has_ticket_function(cur):
+            _execute(cur, "intelmqmail_new_tickets", self.function_query, (self.block_size,))
+            tickets = cur.fetchone()["tickets"]
+            if None in tickets:
+                raise _future_ticket_day_error(cur)
+        else:
+            _execute(cur, "intelmqmail_reserve_tickets", self.reserve_query, (self.block_size,))
+            result = cur.fetchone()
+            if _reset_ticket_day_if_needed(cur, result["date"], result["init_date"]):
+                _execute(cur, "intelmqmail_reserve_tickets", self.reserve_query,
+                         (self.block_size,))
+                result = cur.fetchone()
+            tickets = [_format_ticket(result["date"], number) for number in result["numbers"]]
+
+        self._tickets = collections.deque(tickets)
+        log.debug("Reserved %d ticket numbers.", len(self._tickets))
+
+    def savepoint(self):
+        self._reserved_in_savepoint = False
+
+    def rollback_to_savepoint(self):
+        if self._reserved_in_savepoint:
+            self._tickets.clear()
+            self._reserved_in_savepoint = False
+
+    def __repr__(self):
+        return f'TicketAllocator(block_size={self.block_size!r})'
+
+
 def _format_ticket(date_str, sequence_number: int) -> str:
     # num_str from integer: fill with 0s and cut out 8 chars from the right
     num_str = "{:08d}".format(sequence_number)[-8:]
@@ -202,11 +737,72 @@ def mark_as_sent(cur, directive_ids, ticket, sent_at):
             used in the Date header of the mail.
     """
     log.debug("Marking directive ids %r as sent.", directive_ids)
-    cur.execute("""\
+    if _uses_sent_link_table(cur):
+        _execute(cur, "intelmqmail_mark_as_sent_link", """\
+                  WITH sent_row AS (INSERT INTO sent (intelmq_ticket, sent_at)
+                                         VALUES (%s, %s)
+                                      RETURNING id)
+                INSERT INTO directive_sent (directive_id, sent_id)
+                SELECT unnest(%s::BIGINT[]), id FROM sent_row;""",
+                 (ticket, sent_at, directive_ids,))
+        return
+    _execute(cur, "intelmqmail_mark_as_sent", """\
                   WITH sent_row AS (INSERT INTO sent (intelmq_ticket, sent_at)
                                          VALUES (%s, %s)
                                       RETURNING id)
                 UPDATE directives
                    SET sent_id = (SELECT id FROM sent_row)
                  WHERE id = ANY (%s);""",
-                (ticket, sent_at, directive_ids,))
+             (ticket, sent_at, directive_ids,))
+
+
+def mark_many_as_sent(cur, sent_records):
+    """Mark the directives of several notifications as sent.
+    This does the same as calling mark_as_sent for every record, but
+    with a single statement.
+    Args:
+        sent_records (list of tuples): The (directive_ids, ticket,
+            sent_at) tuples of the notifications, with the same meaning
+            as the parameters of mark_as_sent.
+    """
+    tickets = [ticket for directive_ids, ticket, sent_at in sent_records]
+    sent_ats = [sent_at for directive_ids, ticket, sent_at in sent_records]
+    # The directive ids are passed together with the (1-based) index of
+    # their record as two arrays of the same length, because the numbers
+    # of directives per notification differ. The index is used instead
+    # of the ticket because the tickets of the records need not be
+    # unique.
+    all_directive_ids = []
+    record_numbers = []
+    for number, (directive_ids, ticket, sent_at) in enumerate(sent_records, 1):
+        all_directive_ids.extend(directive_ids)
+        record_numbers.extend([number] * len(directive_ids))
+
+    log.debug("Marking directive ids %r as sent.", all_directive_ids)
+    insert_sent = """\
+                  WITH new_sent AS (SELECT nextval('sent_id_seq') AS id,
+                                           number, intelmq_ticket, sent_at
+                                      FROM unnest(%s::VARCHAR[],
+                                                  %s::TIMESTAMP WITH TIME ZONE[])
+                                           WITH ORDINALITY
+                                           AS s (intelmq_ticket, sent_at, number)),
+                       sent_rows AS (INSERT INTO sent (id, intelmq_ticket, sent_at)
+                                     SELECT id, intelmq_ticket, sent_at FROM new_sent)"""
+    params = (tickets, sent_ats, all_directive_ids, record_numbers)
+    if _uses_sent_link_table(cur):
+        _execute(cur, "intelmqmail_mark_many_as_sent_link", insert_sent + """
+                INSERT INTO directive_sent (directive_id, sent_id)
+                SELECT sent_directives.directive_id, new_sent.id
+                  FROM unnest(%s::BIGINT[], %s::BIGINT[])
+                           AS sent_directives (directive_id, number)
+                  JOIN new_sent USING (number);""",
+                 params)
+        return
+    _execute(cur, "intelmqmail_mark_many_as_sent", insert_sent + """
+                UPDATE directives
+                   SET sent_id = new_sent.id
+                  FROM unnest(%s::BIGINT[], %s::BIGINT[])
+                           AS sent_directives (directive_id, number)
+                  JOIN new_sent USING (number)
+                 WHERE directives.id = sent_directives.directive_id;""",
+             params)
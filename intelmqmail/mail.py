@@ -7,11 +7,30 @@ Authors:
  * 2016-2019 Bernhard Herzog <bernhard.herzog@intevation.de>
 """
 
+import base64
+import collections
+import copy
+import hashlib
+import io
+import itertools
 import logging
-from email.message import EmailMessage
+import multiprocessing
+import os
+import re
+import smtplib
+import tempfile
+import threading
+import time
+import weakref
+import zipfile
+import zlib
+from concurrent.futures import Future, ProcessPoolExecutor
+from email.message import EmailMessage, MIMEPart
+from email import quoprimime
 from email.contentmanager import ContentManager, raw_data_manager
+from email.generator import BytesGenerator
 from email.policy import SMTP
-from email.utils import formatdate, make_msgid, parseaddr
+from email.utils import formatdate, getaddresses, make_msgid, parseaddr
 
 import gpg
 
@@ -74,6 +93,10 @@ class MailgenContentManager(ContentManager):
        enforcing quoted-printable for all text content, we can simply
        replace "From " with "From=20" in the quoted printable encoded
        text.
+
+    Text is encoded by encode_quoted_printable, which gives the same
+    result as the raw_data_manager but needs less time and memory for
+    large texts.
     """
 
     def get_content(self, msg, *args, **kw):
@@ -81,7 +104,14 @@ class MailgenContentManager(ContentManager):
 
     def set_content(self, msg, obj, *args, **kw):
         if isinstance(obj, str):
+            # Let the raw_data_manager set the headers and parameters
+            # and replace its payload with the faster encoded one.
             kw["cte"] = "quoted-printable"
+            raw_data_manager.set_content(msg, "", *args, **kw)
+            charset = kw.get("charset", args[1] if len(args) > 1 else "utf-8")
+            msg.set_payload(encode_quoted_printable(
+                obj, charset, msg.policy.max_line_length))
+            return
 
         raw_data_manager.set_content(msg, obj, *args, **kw)
 
@@ -91,12 +121,117 @@ class MailgenContentManager(ContentManager):
             msg.set_payload(from_escaped)
 
 
+# Mapping for str.translate to encode the characters that
+# quoted-printable encodes in bodies, except for the line breaks.
+_QP_ENCODE_MAP = ["=%02X" % c if quoprimime.body_check(c) and c not in b"\r\n"
+                  else chr(c)
+                  for c in range(256)]
+
+
+def encode_quoted_printable(string, charset, max_line_length):
+    """Encode string with quoted-printable and escape "From ".
+
+    The result is the same as that of the raw_data_manager of the email
+    package with the quoted-printable transfer encoding followed by the
+    replacement of "From " with "From=20". The characters are encoded
+    for the whole text at once with str.translate instead of one by one,
+    and the text is then handled line by line: only the lines that are
+    too long or end with whitespace are wrapped, and "From " is escaped
+    in the lines that contain it.
+    """
+    data = string.encode(charset)
+    # Normalize the line breaks to "\n" and end with one, like the email
+    # package does.
+    if b"\r" in data:
+        data = b"\n".join(data.splitlines()) + b"\n"
+    elif not data.endswith(b"\n"):
+        data += b"\n"
+    encoded = []
+    for line in data.decode("latin-1").translate(_QP_ENCODE_MAP).split("\n"):
+        if len(line) > max_line_length or line.endswith((" ", "\t")):
+            line = _wrap_qp_line(line, max_line_length)
+        if "From " in line:
+            line = line.replace("From ", "From=20")
+        encoded.append(line)
+    return "\n".join(encoded)
+
+
+def _wrap_qp_line(line, maxlinelen):
+    """Wrap an encoded line like email.quoprimime.body_encode does."""
+    soft_break = "=\n"
+    # leave space for the '=' at the end of a line
+    maxlinelen1 = maxlinelen - 1
+
+    if "=" not in line and line[-1] not in " \t":
+        # Without escape sequences, the line is simply cut into pieces of
+        # maxlinelen1 characters as long as more than maxlinelen
+        # characters are left.
+        cut = maxlinelen1
+        wrapped = line[:cut]
+        while len(line) - cut > maxlinelen:
+            wrapped += soft_break + line[cut:cut + maxlinelen1]
+            cut += maxlinelen1
+        return wrapped + soft_break + line[cut:]
+
+    encoded = []
+    append = encoded.append
+
+    # break up the line into pieces no longer than maxlinelen - 1
+    start = 0
+    laststart = len(line) - 1 - maxlinelen
+    while start <= laststart:
+        stop = start + maxlinelen1
+        # make sure we don't break up an escape sequence
+        if line[stop - 2] == "=":
+            append(line[start:stop - 1])
+            start = stop - 2
+        elif line[stop - 1] == "=":
+            append(line[start:stop])
+            start = stop - 1
+        else:
+            append(line[start:stop] + "=")
+            start = stop
+
+    # handle rest of line, special case if line ends in whitespace
+    if line[-1] in " \t":
+        room = start - laststart
+        if room >= 3:
+            # room for the three-character quoted encoding
+            q = "=%02X" % ord(line[-1])
+        elif room == 2:
+            # room for the whitespace character and a soft break
+            q = line[-1] + soft_break
+        else:
+            # room only for a soft break, the quoted whitespace will be
+            # the only content on the subsequent line
+            q = soft_break + "=%02X" % ord(line[-1])
+        append(line[start:-1] + q)
+    else:
+        append(line[start:])
+
+    return "\n".join(encoded)
+
+
 mailgen_policy = SMTP.clone(cte_type="7bit",
                             content_manager=MailgenContentManager())
 
 
 def create_mail(sender, recipient, subject, body, attachments, gpgme_ctx):
     """Create an email either as single or multi-part with attachments.
+
+    If gpgme_ctx is a SigningPool, the mail is signed in the background
+    and finish_mail has to be called to add the signature.
+    """
+    msg = _create_content(body, attachments, gpgme_ctx)
+    _add_headers(msg, sender, recipient, subject)
+    return msg
+
+
+def _create_content(body, attachments, gpgme_ctx, boundary=None):
+    """Create the mail for create_mail without the header fields.
+
+    If boundary is given, it's used as the boundary of the top-level
+    multipart, if any.
     """
     msg = EmailMessage(policy=mailgen_policy)
     msg.set_content(body)
@@ -104,33 +239,35 @@ def create_mail(sender, recipient, subject, body, attachments, gpgme_ctx):
     if gpgme_ctx is not None:
         msg.make_mixed()
         attachment_parent = next(msg.iter_parts())
+        if boundary is not None:
+            # kept when the mail becomes multipart/signed
+            msg.set_boundary(boundary)
 
     if attachments:
         for args, kw in attachments:
             attachment_parent.add_attachment(*args, **kw)
+        if gpgme_ctx is None and boundary is not None:
+            msg.set_boundary(boundary)
 
-    if gpgme_ctx is not None:
-        signed_bytes = attachment_parent.as_bytes()
-        hash_algo, signature = detached_signature(gpgme_ctx, signed_bytes)
-
-        msg.add_attachment(signature, "application", "pgp-signature",
-                           cte="8bit")
-        # the signature part should now be the last of two parts in the
-        # message, the first one being the signed part.
-        signature_part = list(msg.iter_parts())[1]
-        if "Content-Disposition" in signature_part:
-            del signature_part["Content-Disposition"]
+    if gpgme_ctx is not None and attachment_parent.is_multipart():
+        # With a boundary derived from the contents, the signed part is
+        # the same for the same contents, so that the signature cache
+        # can be used.
+        attachment_parent.set_boundary(_content_boundary(body, attachments))
 
-        msg.replace_header("Content-Type", "multipart/signed")
+    if isinstance(gpgme_ctx, SigningPool):
+        # The signature is added by finish_mail, so that the caller can
+        # go on rendering while the pool is signing.
+        _pending_signatures[msg] = gpgme_ctx.detached_signature(
+            attachment_parent.as_bytes())
+    elif gpgme_ctx is not None:
+        signed_bytes = attachment_parent.as_bytes()
+        _add_signature(msg, *detached_signature(gpgme_ctx, signed_bytes))
 
-        micalg = hash_algorithms.get(hash_algo)
-        if micalg is None:
-            raise RuntimeError("Unexpected hash algorithm %r from gpgme"
-                               % (signature[0].hash_algo,))
+    return msg
 
-        msg.set_param("protocol", "application/pgp-signature")
-        msg.set_param("micalg", micalg)
 
+def _add_headers(msg, sender, recipient, subject):
     msg.add_header("From", sender)
     msg.add_header("To", recipient)
     msg.add_header("Subject", subject)
@@ -139,13 +276,299 @@ def create_mail(sender, recipient, subject, body, attachments, gpgme_ctx):
     # take the domain part of sender as the domain part of the message ID.
     msg.add_header("Message-Id", make_msgid(domain=domain_from_sender(sender)))
 
+
+class MailFactory:
+    """Create mails from one sender, e.g. during one run of mailgen.
+
+    The methods create_mail and write_mail create the same mails as the
+    functions of the same name, but the work that is the same for all
+    mails is done only once: the sender is parsed into the From header
+    and its domain for the first mail, and the Date header is created
+    only once per second. Message-Ids are made of a prefix that is unique
+    to the factory, like the one make_msgid creates, and a counter. The
+    top-level multipart boundaries are created the same way, so that the
+    generator doesn't have to create them and check whether they occur
+    in the mail, which it does for every mail otherwise.
+    """
+
+    def __init__(self, sender):
+        self.sender = sender
+        self._domain = None
+        self._from = None
+        self._msgid_prefix = "%d.%d.%d" % (int(time.time() * 100), os.getpid(),
+                                           int.from_bytes(os.urandom(8), "big"))
+        self._boundary_prefix = "=" * 15 + os.urandom(8).hex()
+        self._counter = itertools.count()
+        self._date = (None, None)
+
+    @property
+    def domain(self):
+        """The domain of the sender, used for the Message-Ids."""
+        if self._domain is None:
+            self._domain = domain_from_sender(self.sender)
+        return self._domain
+
+    def create_mail(self, recipient, subject, body, attachments, gpgme_ctx):
+        """Like the function create_mail with the sender of the factory."""
+        msg = _create_content(body, attachments, gpgme_ctx,
+                              boundary="%s.%d" % (self._boundary_prefix, next(self._counter)))
+        self._add_headers(msg, recipient, subject)
+        return msg
+
+    def write_mail(self, recipient, subject, body, attachments, gpgme_ctx):
+        """Like the function write_mail with the sender of the factory."""
+        return _write_mail(body, attachments, gpgme_ctx,
+                           lambda msg: self._add_headers(msg, recipient, subject))
+
+    def _add_headers(self, msg, recipient, subject):
+        # Header objects are immutable, so the same From and Date
+        # headers can be used in all mails.
+        if self._from is None:
+            self._from = mailgen_policy.header_factory("From", self.sender)
+        msg["From"] = self._from
+        msg["To"] = recipient
+        msg["Subject"] = subject
+        msg["Date"] = self._date_header()
+        msg["Message-Id"] = "<%s.%d@%s>" % (self._msgid_prefix, next(self._counter),
+                                            self.domain)
+
+    def _date_header(self):
+        now = int(time.time())
+        second, header = self._date
+        if second != now:
+            header = mailgen_policy.header_factory(
+                "Date", formatdate(timeval=now, localtime=True))
+            self._date = (now, header)
+        return header
+
+    def __repr__(self):
+        return f'MailFactory(sender={self.sender!r})'
+
+
+def finish_mail(msg):
+    """Add the signature of a mail created with a SigningPool.
+
+    Waits until the pool has created the signature. Exceptions raised
+    while signing are raised here. Mails that were not signed by a pool,
+    or that have already been finished, are returned unchanged.
+    """
+    future = _pending_signatures.pop(msg, None)
+    if future is not None:
+        _add_signature(msg, *future.result())
     return msg
 
 
+def _add_signature(msg, hash_algo, signature):
+    """Turn msg into a multipart/signed message with the given signature.
+
+    The first and only part of msg must be the signed part.
+    """
+    msg.add_attachment(signature, "application", "pgp-signature",
+                       cte="8bit")
+    # the signature part should now be the last of two parts in the
+    # message, the first one being the signed part.
+    signature_part = list(msg.iter_parts())[1]
+    if "Content-Disposition" in signature_part:
+        del signature_part["Content-Disposition"]
+
+    # replace_header keeps the position of the header, so this also
+    # works for mails whose other headers have already been added.
+    boundary = msg.get_boundary()
+    msg.replace_header("Content-Type", "multipart/signed")
+    if boundary is not None:
+        msg.set_boundary(boundary)
+    msg.set_param("protocol", "application/pgp-signature")
+    msg.set_param("micalg", _micalg(hash_algo))
+
+
+def _micalg(hash_algo):
+    micalg = hash_algorithms.get(hash_algo)
+    if micalg is None:
+        raise RuntimeError("Unexpected hash algorithm %r from gpgme"
+                           % (hash_algo,))
+    return micalg
+
+
+def smtp_envelope(msg, to_addrs=None):
+    """Return the envelope sender and recipients for sending msg.
+
+    The addresses are taken from the headers of msg in the same way as
+    smtplib.SMTP.send_message does. If to_addrs is not None, it is used
+    as the recipients instead.
+
+    Return:
+        Tuple of (from_addr, to_addrs).
+    """
+    resent = msg.get_all("Resent-Date")
+    if resent is None:
+        header_prefix = ""
+    elif len(resent) == 1:
+        header_prefix = "Resent-"
+    else:
+        raise ValueError("message has more than one 'Resent-' header block")
+    if header_prefix + "Sender" in msg:
+        from_addr = msg[header_prefix + "Sender"]
+    else:
+        from_addr = msg[header_prefix + "From"]
+    from_addr = getaddresses([from_addr])[0][1]
+    if to_addrs is None:
+        addr_fields = [f for f in (msg[header_prefix + "To"],
+                                   msg[header_prefix + "Bcc"],
+                                   msg[header_prefix + "Cc"])
+                       if f is not None]
+        to_addrs = [a[1] for a in getaddresses(addr_fields)]
+    return from_addr, to_addrs
+
+
+def wire_bytes(msg):
+    """Serialize msg as smtplib.SMTP.send_message would send it.
+
+    Like send_message, the Bcc and Resent-Bcc headers are left out and
+    the lines end with CRLF whatever the policy of msg, e.g. for the
+    compat32 messages of create_xarf_mail.
+    """
+    if "Bcc" in msg or "Resent-Bcc" in msg:
+        msg = copy.copy(msg)
+        del msg["Bcc"]
+        del msg["Resent-Bcc"]
+    with io.BytesIO() as flat:
+        BytesGenerator(flat).flatten(msg, linesep="\r\n")
+        return flat.getvalue()
+
+
+# Size of the pieces of text that are encoded and compressed at a time
+# by compressed_attachment
+COMPRESSION_CHUNK_SIZE = 1 << 20
+
+
+def compressed_attachment(text, filename, compression):
+    """Return an attachment with the compressed text for create_mail.
+
+    The text is encoded as UTF-8 and compressed piece by piece, so that
+    neither the whole encoded text nor the compressor's output are held
+    in memory in addition to the result.
+
+    Args:
+        text (str): The contents of the attachment.
+        filename (str): The name of the uncompressed file, e.g. "events.csv".
+        compression (str): "gzip" for a gzip file named filename + ".gz"
+            or "zip" for a zip archive containing the file filename,
+            named like filename with the extension replaced by ".zip".
+
+    Return:
+        The attachment as a tuple of the positional and keyword
+        arguments for EmailMessage.add_attachment.
+    """
+    chunks = (text[start:start + COMPRESSION_CHUNK_SIZE].encode("utf-8")
+              for start in range(0, len(text), COMPRESSION_CHUNK_SIZE))
+    if compression == "gzip":
+        # wbits 16 + MAX_WBITS selects the gzip format
+        compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+        data = io.BytesIO()
+        for chunk in chunks:
+            data.write(compressor.compress(chunk))
+        data.write(compressor.flush())
+        return ((data.getvalue(), "application", "gzip"),
+                dict(filename=filename + ".gz"))
+    elif compression == "zip":
+        data = io.BytesIO()
+        with zipfile.ZipFile(data, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            info = zipfile.ZipInfo(filename, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with archive.open(info, "w") as member:
+                for chunk in chunks:
+                    member.write(chunk)
+        return ((data.getvalue(), "application", "zip"),
+                dict(filename=os.path.splitext(filename)[0] + ".zip"))
+    raise ValueError("Unknown compression %r" % (compression,))
+
+
+def _content_boundary(body, attachments):
+    """Return a MIME boundary derived from the contents of a mail."""
+    digest = hashlib.sha256()
+    for args, kw in [((body,), {})] + list(attachments or ()):
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            digest.update(len(data).to_bytes(8, "big"))
+            digest.update(data)
+        digest.update(repr(sorted(kw.items())).encode())
+    return "=" * 15 + digest.hexdigest()
+
+
+class SignatureCache:
+    """Bounded LRU cache of OpenPGP signatures.
+
+    The signatures are looked up by the signing keys, the signature mode
+    and a SHA-256 digest of the signed data, so that data signed again
+    with the same keys, e.g. when previewing the same notification
+    repeatedly, is not signed by gpg again. Signatures older than
+    max_age seconds are not used, to keep the creation times of the
+    signatures close to the time the mails are sent. A maxsize of 0
+    disables the cache.
+    """
+
+    def __init__(self, maxsize=256, max_age=3600):
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(signers, mode, data):
+        return (tuple(signers), mode, hashlib.sha256(data).digest())
+
+    def get(self, key):
+        """Return the cached signature for key or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            created, signature = entry
+            if time.monotonic() - created > self.max_age:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return signature
+
+    def put(self, key, signature):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), signature)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+signature_cache = SignatureCache()
+
+
+def _cached_signature(gpgme_ctx, mode, data, sign):
+    key = SignatureCache.key((key.fpr for key in gpgme_ctx.signers), mode, data)
+    signature = signature_cache.get(key)
+    if signature is None:
+        signature = sign(gpgme_ctx, data)
+        signature_cache.put(key, signature)
+    return signature
+
+
 def clearsign(gpgme_ctx, text):
+    if isinstance(gpgme_ctx, SigningPool):
+        return gpgme_ctx.clearsign(text).result()
+    return _cached_signature(gpgme_ctx, "clear", text.encode(), _clearsign)
+
+
+def _clearsign(gpgme_ctx, textbytes):
     try:
         signature, signResult = gpgme_ctx.sign(
-            text.encode(),
+            textbytes,
             mode=gpg.constants.sig.mode.CLEAR)
     except Exception:
         log.error("OpenPGP signing failed!")
@@ -159,6 +582,8 @@ def detached_signature(gpgme_ctx, plainbytes):
     The signature created by this function is asci armored because
     that's required for multipart/signed messages.
 
+    Signatures are cached in signature_cache.
+
     Args:
         gpgme_ctx (gpgme context): The gpgme context to use for signing.
             The signature is made with whatever keys are set as signing keys
@@ -170,6 +595,10 @@ def detached_signature(gpgme_ctx, plainbytes):
             relevant constants in gpgme. The signature is a bytestring
             with the signature.
     """
+    return _cached_signature(gpgme_ctx, "detach", plainbytes, _detached_signature)
+
+
+def _detached_signature(gpgme_ctx, plainbytes):
     try:
         gpgme_ctx.armor = True
         signature, signResult = gpgme_ctx.sign(
@@ -180,3 +609,564 @@ def detached_signature(gpgme_ctx, plainbytes):
         raise
 
     return (signResult.signatures[0].hash_algo, signature)
+
+
+def _detached_file_signature(gpgme_ctx, filename):
+    """Like detached_signature for the contents of a file.
+
+    The signature is not cached because the file is not read into memory.
+    """
+    with open(filename, "rb") as f:
+        return _detached_signature(gpgme_ctx, f)
+
+
+# Signatures of mails created by create_mail with a SigningPool, which
+# have not been added by finish_mail yet.
+_pending_signatures = weakref.WeakKeyDictionary()
+
+# The gpgme context of a signing process of a SigningPool
+_process_gpgme_ctx = None
+
+
+def _init_signing_process(gnupg_home, signing_key):
+    global _process_gpgme_ctx
+    _process_gpgme_ctx = gpg.Context(home_dir=gnupg_home)
+    _process_gpgme_ctx.signers = [_process_gpgme_ctx.get_key(signing_key)]
+
+
+def _check_signing_process(signing_key):
+    return _process_gpgme_ctx.get_key(signing_key, secret=True).fpr
+
+
+def _sign_in_process(func, data):
+    try:
+        return func(_process_gpgme_ctx, data)
+    except Exception as exc:
+        # gpgme's exceptions cannot always be pickled, so pass them on
+        # to the parent process as a plain RuntimeError
+        raise RuntimeError("OpenPGP signing failed in signing process: %s"
+                           % (exc,)) from None
+
+
+class SigningPool:
+    """Pool of processes creating OpenPGP signatures.
+
+    Each process has its own gpgme context with the signing key, so that
+    several signatures can be created at the same time and signing
+    overlaps with the rendering of the mails. Pass the pool instead of a
+    gpgme context to create_mail and clearsign. create_mail then only
+    submits the data to sign and finish_mail adds the signature when
+    the mail is needed.
+
+    Close the pool with close() or use it as a context manager.
+    """
+
+    def __init__(self, gnupg_home, signing_key, processes):
+        self.gnupg_home = gnupg_home
+        self.signing_key = signing_key
+        self.processes = processes
+        # gpgme is not fork safe, so the processes are started fresh
+        self.executor = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_signing_process,
+            initargs=(gnupg_home, signing_key))
+        # signing_key may be any key specification gpg understands, the
+        # signature cache needs the fingerprint like for gpgme contexts
+        self.fingerprint = None
+        try:
+            self.check()
+        except Exception:
+            self.executor.shutdown()
+            raise
+
+    def detached_signature(self, plainbytes):
+        """Submit plainbytes for a detached signature.
+
+        Returns a future for the result of detached_signature.
+        """
+        return self._submit(_detached_signature, "detach", plainbytes)
+
+    def detached_file_signature(self, filename):
+        """Submit the contents of a file for a detached signature.
+
+        The file is read by the signing process. Returns a future for
+        the result of detached_signature.
+        """
+        return self.executor.submit(_sign_in_process, _detached_file_signature, filename)
+
+    def clearsign(self, text):
+        """Submit text for a clear text signature.
+
+        Returns a future for the result of clearsign.
+        """
+        return self._submit(_clearsign, "clear", text.encode())
+
+    def _submit(self, func, mode, data):
+        # the signature cache is used in this process, so that it works
+        # independently of the process the data would be signed in.
+        key = SignatureCache.key([self.fingerprint], mode, data)
+        signature = signature_cache.get(key)
+        if signature is not None:
+            future = Future()
+            future.set_result(signature)
+            return future
+
+        def done(signed):
+            if not signed.cancelled() and signed.exception() is None:
+                signature_cache.put(key, signed.result())
+
+        signed = self.executor.submit(_sign_in_process, func, data)
+        signed.add_done_callback(done)
+        return signed
+
+    def check(self):
+        """Check that a signing process can still access the signing key
+        and update the fingerprint of the key.
+
+        Raises an exception if not.
+        """
+        self.fingerprint = self.executor.submit(_check_signing_process,
+                                                self.signing_key).result()
+
+    def close(self):
+        """Wait for pending signatures and stop the processes."""
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return (f'SigningPool(gnupg_home={self.gnupg_home!r}, signing_key={self.signing_key!r},'
+                f' processes={self.processes!r})')
+
+
+class Signer:
+    """Long-lived OpenPGP signing context.
+
+    The gpgme context with the signing key, or the SigningPool if
+    processes is greater than zero, is created on first use and then
+    reused. gpgme contexts must not be shared between threads, so every
+    thread gets its own context. The pool is shared by all threads.
+
+    When the context is requested again after more than
+    health_check_interval seconds, the signing key is looked up again. If
+    that fails, e.g. because the keyring changed or gpg-agent cannot be
+    reached, the context or pool is replaced by a new one.
+
+    Use get_signer to share a Signer for the same configuration.
+    """
+
+    health_check_interval = 300
+
+    def __init__(self, gnupg_home, signing_key, processes=0):
+        self.gnupg_home = gnupg_home
+        self.signing_key = signing_key
+        self.processes = processes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_checked = 0
+
+    def context(self):
+        """Return a gpgme context or SigningPool to sign with."""
+        if self.processes > 0:
+            with self._lock:
+                self._pool, self._pool_checked = self._checked(
+                    self._pool, self._pool_checked, self._new_pool)
+                return self._pool
+        self._local.ctx, self._local.checked = self._checked(
+            getattr(self._local, "ctx", None),
+            getattr(self._local, "checked", 0), self._new_context)
+        return self._local.ctx
+
+    def _checked(self, ctx, checked, new_context):
+        """Return ctx, or a new context if it is missing or fails the
+        health check, and the time of the last check.
+        """
+        now = time.monotonic()
+        if ctx is not None and now - checked >= self.health_check_interval:
+            checked = now
+            try:
+                if isinstance(ctx, SigningPool):
+                    ctx.check()
+                else:
+                    ctx.get_key(self.signing_key, secret=True)
+            except Exception:
+                log.warning("OpenPGP signing context is not usable anymore,"
+                            " creating a new one.", exc_info=True)
+                if isinstance(ctx, SigningPool):
+                    ctx.close()
+                # the key may have been replaced
+                signature_cache.clear()
+                ctx = None
+        if ctx is None:
+            ctx = new_context()
+            checked = now
+        return ctx, checked
+
+    def _new_context(self):
+        ctx = gpg.Context(home_dir=self.gnupg_home)
+        ctx.signers = [ctx.get_key(self.signing_key)]
+        return ctx
+
+    def _new_pool(self):
+        return SigningPool(self.gnupg_home, self.signing_key, self.processes)
+
+    def close(self):
+        """Stop the processes of the pool, if any.
+
+        The gpgme contexts of the threads are released with the Signer.
+        """
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+
+    def __repr__(self):
+        return (f'Signer(gnupg_home={self.gnupg_home!r}, signing_key={self.signing_key!r},'
+                f' processes={self.processes!r})')
+
+
+_signers = {}
+_signers_lock = threading.Lock()
+
+
+def get_signer(gnupg_home, signing_key, processes=0):
+    """Return the Signer for the given parameters.
+
+    The Signer is created on the first call and returned again by later
+    calls with the same parameters, so that all runs of mailgen in a
+    process share the signing context.
+    """
+    key = (gnupg_home, signing_key, processes)
+    with _signers_lock:
+        signer = _signers.get(key)
+        if signer is None:
+            signer = _signers[key] = Signer(gnupg_home, signing_key, processes)
+        return signer
+
+
+def close_signers():
+    """Close the Signers returned by get_signer.
+
+    This stops the processes of their signing pools. The Signers can
+    still be used afterwards and start new processes when needed.
+    """
+    with _signers_lock:
+        signers = list(_signers.values())
+    for signer in signers:
+        signer.close()
+
+
+# Size of the pieces in which write_mail reads the attachments and
+# StreamedMail.chunks reads the mail
+STREAM_CHUNK_SIZE = 1 << 20
+
+# Number of bytes base64 encoded per line, which gives lines of 76
+# characters like the email package writes them
+_BASE64_LINE_BYTES = 57
+
+
+class StreamedMail:
+    """A mail written to a spool file by write_mail.
+
+    The header fields are available as an EmailMessage without content
+    in the headers attribute and, as for an EmailMessage, by indexing
+    and get. The whole mail is only read from the spool file in pieces
+    by chunks, so that it is never in memory as a whole, unless as_bytes
+    or str is used.
+
+    The spool file is deleted when the StreamedMail is closed or garbage
+    collected.
+    """
+
+    def __init__(self, headers, spool):
+        self.headers = headers
+        self.spool = spool
+
+    def __getitem__(self, name):
+        return self.headers[name]
+
+    def get(self, name, failobj=None):
+        return self.headers.get(name, failobj)
+
+    @property
+    def size(self):
+        """The size of the mail in bytes."""
+        return os.fstat(self.spool.fileno()).st_size
+
+    def chunks(self, chunk_size=None):
+        """Yield the mail as bytes in pieces of at most chunk_size bytes.
+
+        The default chunk_size is STREAM_CHUNK_SIZE.
+        """
+        if chunk_size is None:
+            chunk_size = STREAM_CHUNK_SIZE
+        self.spool.seek(0)
+        while True:
+            chunk = self.spool.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def as_bytes(self):
+        return b"".join(self.chunks())
+
+    def __str__(self):
+        return self.as_bytes().decode("utf-8", "replace").replace("\r\n", "\n")
+
+    def close(self):
+        self.spool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return f'StreamedMail(headers={self.headers.items()!r}, spool={self.spool!r})'
+
+
+def write_mail(sender, recipient, subject, body, attachments, gpgme_ctx):
+    """Write an email like create_mail to a spool file.
+
+    The arguments are the same as for create_mail, except that the data
+    of an attachment may also be a file object, opened in text mode for
+    text attachments and in binary mode for all others. Attachments are
+    read, encoded and written in pieces of STREAM_CHUNK_SIZE. When
+    signing, the signed part is written to a temporary file first and
+    signed from there, so that the memory needed does not depend on the
+    size of the attachments. Signatures of streamed mails are not cached.
+
+    Use send_streamed to send the mail.
+
+    Return:
+        StreamedMail
+    """
+    return _write_mail(body, attachments, gpgme_ctx,
+                       lambda msg: _add_headers(msg, sender, recipient, subject))
+
+
+def _write_mail(body, attachments, gpgme_ctx, add_headers):
+    """Write the mail for write_mail.
+
+    add_headers is called with the EmailMessage of the header fields to
+    add From, To, Subject, Date and Message-Id.
+    """
+    headers = EmailMessage(policy=mailgen_policy)
+    headers["MIME-Version"] = "1.0"
+    content_headers, content = _mime_entity(body, attachments)
+    spool = tempfile.TemporaryFile()
+    try:
+        if gpgme_ctx is None:
+            for name, value in content_headers.items():
+                headers[name] = value
+            add_headers(headers)
+            spool.write(_header_bytes(headers))
+            _write_pieces(spool, content)
+        else:
+            with tempfile.NamedTemporaryFile() as signed:
+                signed.write(_header_bytes(content_headers))
+                _write_pieces(signed, content)
+                signed.flush()
+                if isinstance(gpgme_ctx, SigningPool):
+                    hash_algo, signature = gpgme_ctx.detached_file_signature(signed.name).result()
+                else:
+                    hash_algo, signature = _detached_file_signature(gpgme_ctx, signed.name)
+
+                boundary = _new_boundary()
+                headers.add_header("Content-Type", "multipart/signed", boundary=boundary,
+                                   protocol="application/pgp-signature",
+                                   micalg=_micalg(hash_algo))
+                add_headers(headers)
+                signature_part = MIMEPart(policy=mailgen_policy)
+                signature_part.set_content(signature, "application", "pgp-signature",
+                                           cte="8bit")
+                spool.write(_header_bytes(headers))
+                signed.seek(0)
+                _write_pieces(spool, _multipart_content(
+                    boundary, [_read_pieces(signed), [signature_part.as_bytes()]]))
+    except BaseException:
+        spool.close()
+        raise
+    return StreamedMail(headers, spool)
+
+
+def _mime_entity(body, attachments):
+    """Return the headers and the encoded content of the signed part.
+
+    The content is a generator of bytes which reads the attachments
+    only when it is consumed.
+    """
+    body_headers = MIMEPart(policy=mailgen_policy)
+    body_headers.set_content("")
+    body_content = _encoded_text(body, "utf-8")
+    if not attachments:
+        return body_headers, body_content
+
+    headers = MIMEPart(policy=mailgen_policy)
+    boundary = _new_boundary()
+    headers.add_header("Content-Type", "multipart/mixed", boundary=boundary)
+    parts = [itertools.chain([_header_bytes(body_headers)], body_content)]
+    for args, kw in attachments:
+        data = args[0]
+        attachment_headers = MIMEPart(policy=mailgen_policy)
+        if isinstance(data, (str, io.TextIOBase)):
+            attachment_headers.set_content("", *args[1:], **kw)
+            content = _encoded_text(data, attachment_headers.get_content_charset())
+        else:
+            attachment_headers.set_content(b"", *args[1:], **dict(kw, cte="base64"))
+            content = _encoded_binary(data)
+        parts.append(itertools.chain([_header_bytes(attachment_headers)], content))
+    return headers, _multipart_content(boundary, parts)
+
+
+def _multipart_content(boundary, parts):
+    """Yield the content of a multipart entity in pieces.
+
+    Each of the parts is an iterable of the bytes of the part, headers
+    included.
+    """
+    delimiter = b"--" + boundary.encode("ascii")
+    for i, part in enumerate(parts):
+        yield (b"" if i == 0 else b"\r\n") + delimiter + b"\r\n"
+        yield from part
+    yield b"\r\n" + delimiter + b"--\r\n"
+
+
+def _new_boundary():
+    return "=" * 15 + os.urandom(10).hex()
+
+
+def _header_bytes(msg):
+    """Return the header fields of msg followed by an empty line."""
+    return b"".join([msg.policy.fold_binary(name, value)
+                     for name, value in msg.items()]) + b"\r\n"
+
+
+def _read_pieces(data):
+    """Yield str, bytes or the contents of a file in pieces."""
+    if isinstance(data, (str, bytes)):
+        for start in range(0, len(data), STREAM_CHUNK_SIZE):
+            yield data[start:start + STREAM_CHUNK_SIZE]
+    else:
+        while True:
+            piece = data.read(STREAM_CHUNK_SIZE)
+            if not piece:
+                break
+            yield piece
+
+
+def _encoded_text(data, charset):
+    """Yield data encoded like MailgenContentManager encodes text.
+
+    Only complete lines are encoded at a time, so that the result is the
+    same as for the whole text.
+    """
+    max_line_length = mailgen_policy.max_line_length
+    rest = ""
+    empty = True
+    for piece in _read_pieces(data):
+        piece = rest + piece
+        end = piece.rfind("\n") + 1
+        rest = piece[end:]
+        if end:
+            empty = False
+            yield _crlf_bytes(encode_quoted_printable(piece[:end], charset, max_line_length))
+    if rest or empty:
+        yield _crlf_bytes(encode_quoted_printable(rest, charset, max_line_length))
+
+
+def _crlf_bytes(encoded):
+    return encoded.replace("\n", "\r\n").encode("ascii")
+
+
+def _encoded_binary(data):
+    """Yield data base64 encoded like the email package encodes it."""
+    rest = b""
+    for piece in _read_pieces(data):
+        piece = rest + piece
+        end = len(piece) - len(piece) % _BASE64_LINE_BYTES
+        rest = piece[end:]
+        yield base64.encodebytes(piece[:end]).replace(b"\n", b"\r\n")
+    if rest:
+        yield base64.encodebytes(rest).replace(b"\n", b"\r\n")
+
+
+def _write_pieces(out, pieces):
+    for piece in pieces:
+        out.write(piece)
+
+
+# Lines starting with a dot, which have to be escaped in SMTP's DATA
+_LINE_START_DOT = re.compile(rb"^\.", re.MULTILINE)
+
+
+def send_streamed(smtp, from_addr, to_addrs, mail, mail_options=()):
+    """Send a StreamedMail with smtplib.SMTP instance smtp.
+
+    This does the same as smtp.sendmail(from_addr, to_addrs,
+    mail.as_bytes(), mail_options), but the mail is read from the spool
+    file and passed on to the server in pieces, escaping lines starting
+    with a dot on the way.
+
+    Return:
+        Dictionary with the refused recipients, like sendmail. The same
+        exceptions as for sendmail are raised.
+    """
+    smtp.ehlo_or_helo_if_needed()
+    esmtp_opts = list(mail_options)
+    if smtp.does_esmtp and smtp.has_extn("size"):
+        esmtp_opts.append("size=%d" % mail.size)
+    code, resp = smtp.mail(from_addr, esmtp_opts)
+    if code != 250:
+        _abort_transaction(smtp, code)
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+
+    if isinstance(to_addrs, str):
+        to_addrs = [to_addrs]
+    refused = {}
+    for addr in to_addrs:
+        code, resp = smtp.rcpt(addr)
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+        if code == 421:
+            smtp.close()
+            raise smtplib.SMTPRecipientsRefused(refused)
+    if len(refused) == len(to_addrs):
+        _abort_transaction(smtp, code)
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    code, resp = smtp.docmd("data")
+    if code != 354:
+        _abort_transaction(smtp, code)
+        raise smtplib.SMTPDataError(code, resp)
+    at_line_start = True
+    for chunk in mail.chunks():
+        stuffed = _LINE_START_DOT.sub(b"..", chunk)
+        if not at_line_start and chunk.startswith(b"."):
+            # the dot is not at the start of a line
+            stuffed = stuffed[1:]
+        smtp.send(stuffed)
+        at_line_start = chunk.endswith(b"\n")
+    smtp.send(b".\r\n" if at_line_start else b"\r\n.\r\n")
+    code, resp = smtp.getreply()
+    if code != 250:
+        _abort_transaction(smtp, code)
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+def _abort_transaction(smtp, code):
+    if code == 421:
+        smtp.close()
+    else:
+        try:
+            smtp.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
@@ -24,6 +24,9 @@ Authors:
 import os
 import tempfile
 import datetime
+import functools
+import logging
+import smtplib
 
 from typing import Dict, Optional, List
 
@@ -33,10 +36,15 @@ try:
 except ModuleNotFoundError:
     pyxarf = None
 
-from intelmqmail.db import load_events, new_ticket_number, mark_as_sent
+from intelmqmail.db import load_events, new_ticket_number, mark_as_sent, \
+    mark_many_as_sent, TicketAllocator
 from intelmqmail.templates import read_template, Template
-from intelmqmail.tableformat import format_as_csv, TableFormat, build_table_format
-from intelmqmail.mail import create_mail, clearsign, domain_from_sender
+from intelmqmail.tableformat import format_as_csv_parts, TableFormat, build_table_format
+from intelmqmail.mail import finish_mail, clearsign, domain_from_sender, \
+    smtp_envelope, wire_bytes, compressed_attachment, send_streamed, MailFactory
+
+
+log = logging.getLogger(__name__)
 
 FALLBACK_FORMAT_SPEC = build_table_format(
     "Fallback",
@@ -197,6 +205,13 @@ class ScriptContext:
             produce a notification
         config: the mailgen configuration
         logger: the logger the script should use for logging
+        read_cursor: optional cursor on a read-only replica of the
+            event database used for loading the events
+        ticket_allocator: optional intelmqmail.db.TicketAllocator used
+            to draw ticket numbers
+        mail_factory: optional intelmqmail.mail.MailFactory for the
+            configured sender used to create the mails. If not given,
+            one is created when the first mail is created.
 
     Parameters:
      * See below
@@ -207,9 +222,14 @@ class ScriptContext:
     __doc__ += '\n         * '.join(map(lambda column: f'{column.title}: {column.field_name}', FALLBACK_FORMAT_SPEC.columns))
 
     def __init__(self, config, cur, gpgme_ctx, directive, logger, template: Optional[Template] = None, templates: Optional[Dict[str, Template]] = None,
-                 default_format_spec: Optional[TableFormat] = None):
+                 default_format_spec: Optional[TableFormat] = None, read_cursor=None,
+                 ticket_allocator: Optional[TicketAllocator] = None, render_lazily: bool = False,
+                 mail_factory: Optional[MailFactory] = None):
         self.config = config
         self.db_cursor = cur
+        self.read_cursor = read_cursor
+        self.ticket_allocator = ticket_allocator
+        self.mail_factory = mail_factory
         self.gpgme_ctx = gpgme_ctx
         self.directive = directive
         self.logger = logger
@@ -217,6 +237,8 @@ class ScriptContext:
         self.fallback_template: Optional[Template] = template
         self.templates: Optional[Dict[str, Template]] = templates
         self.default_format_spec: Optional[TableFormat] = default_format_spec if default_format_spec else FALLBACK_FORMAT_SPEC
+        # If true, mail_format_as_csv returns a LazyEmailNotification
+        self.render_lazily = render_lazily
 
     def notification_interval_exceeded(self):
         """Return whether the notification interval has been exceeded.
@@ -261,9 +283,19 @@ class ScriptContext:
         return None
 
     def new_ticket_number(self):
+        if self.ticket_allocator is not None:
+            return self.ticket_allocator.new_ticket_number(self.db_cursor)
         return new_ticket_number(self.db_cursor)
 
     def load_events(self, columns=None):
+        if self.read_cursor is not None:
+            events = load_events(self.read_cursor, self.directive.event_ids, columns)
+            # The replica may lag behind the primary, in which case some
+            # of the events may not be available there yet.
+            if len(events) == len(set(self.directive.event_ids)):
+                return events
+            self.logger.debug("Replica returned %d of %d events, loading from primary.",
+                              len(events), len(set(self.directive.event_ids)))
         return load_events(self.db_cursor, self.directive.event_ids, columns)
 
     def read_template(self, templates: Dict[str, Template]) -> Template:
@@ -289,7 +321,9 @@ class ScriptContext:
     def mail_format_as_csv(self, format_spec: Optional[TableFormat] = None, template=None,
                            substitutions=None, attach_event_data=False,
                            template_name=None, envelope_tos: Optional[List[str]] = None,
-                           ticket_number: Optional[int] = None, mark_as_sent: bool = True):
+                           ticket_number: Optional[int] = None, mark_as_sent: bool = True,
+                           max_rows: Optional[int] = None, max_size: Optional[int] = None,
+                           compression: Optional[str] = None, compression_min_size: Optional[int] = None):
         """Create an email with the event data formatted as CSV.
 
         The subject and body of the mail are taken from a template. The
@@ -298,6 +332,9 @@ class ScriptContext:
             ticket_number: The ticket number assigned by mailgen for the
                 notification.
             events_as_csv: The event data formatted as CSV
+            part_number, part_count: The number of the mail and the total
+                number of mails if the event data is split (see max_rows
+                and max_size). Both are 1 if the data is not split.
 
         If the notification directives specify special aggregation
         criteria, these are also available. Which these are precisely
@@ -326,18 +363,70 @@ class ScriptContext:
             ticket_number: Optional integer. Default: get a new ticket number
                 with self.new_ticket_number()
             mark_as_sent: Optional, boolean
+            max_rows: Optional. Maximum number of CSV rows per mail.
+                Default: the max_rows setting of the split_notifications
+                configuration section, if any.
+            max_size: Optional. Maximum number of characters of CSV data
+                per mail. Default: the max_size setting of the
+                split_notifications configuration section, if any.
+            compression: Optional. "gzip" or "zip" to attach the CSV data
+                compressed in that format. Only used with attach_event_data.
+                Default: the compression setting of the
+                compress_attachments configuration section, if any.
+            compression_min_size: Optional. Only compress CSV data of at
+                least this many characters. Default: the min_size setting
+                of the compress_attachments configuration section or 0.
+
+        If the configuration has a stream_attachments section with a
+        min_size setting, attachments of at least min_size characters
+        are written to a spool file and sent from there in pieces with a
+        StreamedEmailNotification, to keep the memory usage low for very
+        large event data.
+
+        If the event data exceeds max_rows or max_size, it is split into
+        several mails which share the ticket number. The subjects of the
+        mails get a suffix like " (1/3)". Only the last of the mails
+        marks the directives as sent, so that they are marked only once
+        and only if all mails have been sent.
+
+        If the context's render_lazily attribute is true, nothing is done
+        yet and a list with a single LazyEmailNotification is returned,
+        which calls this method when the mails are needed.
 
         Return:
             list of EmailNotification instances. The list has one
-            element. It's a list so that it can be used directly as a
-            return value of a notification script's create_notifications
-            function.
+            element unless the event data is split. It's a list so that
+            it can be used directly as a return value of a notification
+            script's create_notifications function.
         """
+        render = functools.partial(
+            self._render_mail_format_as_csv, format_spec, template, substitutions,
+            attach_event_data, template_name, envelope_tos, ticket_number, mark_as_sent,
+            max_rows, max_size, compression, compression_min_size)
+        if self.render_lazily:
+            return [LazyEmailNotification(self.directive, render)]
+        return render()
+
+    def _render_mail_format_as_csv(self, format_spec, template, substitutions, attach_event_data,
+                                   template_name, envelope_tos, ticket_number, mark_as_sent,
+                                   max_rows, max_size, compression, compression_min_size):
         if format_spec is None:
             format_spec = self.default_format_spec
         events = self.load_events(format_spec.event_table_columns())
 
-        events_as_csv = format_as_csv(format_spec, events)
+        split_config = self.config.get("split_notifications", {})
+        if max_rows is None:
+            max_rows = split_config.get("max_rows")
+        if max_size is None:
+            max_size = split_config.get("max_size")
+        csv_parts = format_as_csv_parts(format_spec, events, max_rows=max_rows, max_size=max_size)
+
+        compression_config = self.config.get("compress_attachments", {})
+        if compression is None:
+            compression = compression_config.get("compression")
+        if compression_min_size is None:
+            compression_min_size = compression_config.get("min_size", 0)
+        stream_min_size = self.config.get("stream_attachments", {}).get("min_size")
 
         # default: use parameter `template`
         if template is None and template_name:  # Use template name if given
@@ -356,26 +445,43 @@ class ScriptContext:
             substitutions = substitutions.copy()
 
         substitutions["ticket_number"] = ticket_number
-        substitutions["events_as_csv"] = (
-            events_as_csv if not attach_event_data else "")
+        substitutions["part_count"] = len(csv_parts)
 
         # Add the information on which the aggregation was based. These are
         # the same in all directives and events that led to this
         # notification, so it can be useful to refer to them in the message
         substitutions.update(self.directive.aggregate_identifier)
 
-        subject, body = template.substitute(substitutions)
-
-        attachments = []
-        if attach_event_data:
-            attachments.append(((events_as_csv,),
-                                dict(subtype="csv", filename="events.csv")))
-
-        mail = create_mail(sender=self.config["sender"],
-                           recipient=self.directive.recipient_address,
-                           subject=subject, body=body,
-                           attachments=attachments, gpgme_ctx=self.gpgme_ctx)
-        return [EmailNotification(self.directive, mail, ticket_number, envelope_tos=envelope_tos, mark_as_sent=mark_as_sent)]
+        notifications = []
+        for part_number, events_as_csv in enumerate(csv_parts, 1):
+            substitutions["part_number"] = part_number
+            substitutions["events_as_csv"] = (
+                events_as_csv if not attach_event_data else "")
+
+            subject, body = template.substitute(substitutions)
+            if len(csv_parts) > 1:
+                subject = f"{subject} ({part_number}/{len(csv_parts)})"
+
+            attachments = []
+            if attach_event_data and compression and len(events_as_csv) >= compression_min_size:
+                attachments.append(compressed_attachment(events_as_csv, "events.csv", compression))
+            elif attach_event_data:
+                attachments.append(((events_as_csv,),
+                                    dict(subtype="csv", filename="events.csv")))
+
+            streamed = attach_event_data and stream_min_size is not None \
+                and len(events_as_csv) >= stream_min_size
+            if self.mail_factory is None:
+                self.mail_factory = MailFactory(self.config["sender"])
+            factory = self.mail_factory
+            mail = (factory.write_mail if streamed else factory.create_mail)(
+                recipient=self.directive.recipient_address,
+                subject=subject, body=body,
+                attachments=attachments, gpgme_ctx=self.gpgme_ctx)
+            notification_class = StreamedEmailNotification if streamed else EmailNotification
+            notifications.append(notification_class(self.directive, mail, ticket_number, envelope_tos=envelope_tos,
+                                                    mark_as_sent=mark_as_sent and part_number == len(csv_parts)))
+        return notifications
 
     if pyxarf:
         def mail_format_as_xarf(self, xarf_schema):  # noqa
@@ -475,26 +581,90 @@ class ScriptContext:
     def __repr__(self):
         return (f'ScriptContext(config={self.config!r}, '
                 f'db_cursor={self.db_cursor!r}, '
+                f'read_cursor={self.read_cursor!r}, '
                 f'gpgme_ctx={self.gpgme_ctx!r}, '
                 f'directive={self.directive!r}, '
                 f'logger={self.logger!r}, '
                 f'now={self.now!r}, '
                 f'fallback_template={self.fallback_template!r}, '
                 f'templates={self.templates!r}, '
-                f'default_format_spec={self.default_format_spec!r})')
+                f'default_format_spec={self.default_format_spec!r}, '
+                f'ticket_allocator={self.ticket_allocator!r}, '
+                f'render_lazily={self.render_lazily!r}, '
+                f'mail_factory={self.mail_factory!r})')
+
+
+class SentBuffer:
+
+    """Collects sent notifications to mark them as sent in batches.
+
+    The records are written with db.mark_many_as_sent by flush, which
+    the caller does when is_full returns true and at the end. The
+    records of a directive whose savepoint is rolled back have to be
+    dropped with rollback_to_savepoint.
+    """
+
+    def __init__(self, cur, batch_size: int):
+        self.cur = cur
+        self.batch_size = batch_size
+        self.records = []
+        self._savepoint = 0
+
+    def add(self, directive_ids, ticket, sent_at):
+        self.records.append((directive_ids, ticket, sent_at))
+
+    def savepoint(self):
+        self._savepoint = len(self.records)
+
+    def rollback_to_savepoint(self):
+        del self.records[self._savepoint:]
+
+    def is_full(self) -> bool:
+        return len(self.records) >= self.batch_size
+
+    def flush(self):
+        """Write the buffered records to the database.
+        The statement runs in its own savepoint, so that a failure does
+        not abort the transaction. The notifications have already been
+        sent in that case, so the error is logged with their directive
+        ids and tickets, to allow an administrator to mark them manually.
+        """
+        records, self.records = self.records, []
+        self._savepoint = 0
+        if not records:
+            return
+        self.cur.execute("SAVEPOINT mark_as_sent;")
+        try:
+            mark_many_as_sent(self.cur, records)
+        except Exception:
+            self.cur.execute("ROLLBACK TO SAVEPOINT mark_as_sent;")
+            log.exception("Could not mark sent notifications as sent: %r",
+                          [(directive_ids, ticket)
+                           for directive_ids, ticket, sent_at in records])
+        else:
+            self.cur.execute("RELEASE SAVEPOINT mark_as_sent;")
+
+    def __repr__(self):
+        return (f'SentBuffer(cur={self.cur!r}, batch_size={self.batch_size!r},'
+                f' records={len(self.records)})')
 
 
 class SendContext:
 
-    def __init__(self, cur, smtp):
+    def __init__(self, cur, smtp, sent_buffer: Optional[SentBuffer] = None):
         self.cur = cur
         self.smtp = smtp
+        self.sent_buffer = sent_buffer
 
     def mark_as_sent(self, directive_ids, ticket, sent_at):
-        mark_as_sent(self.cur, directive_ids, ticket, sent_at)
+        if self.sent_buffer is not None:
+            self.sent_buffer.add(directive_ids, ticket, sent_at)
+        else:
+            mark_as_sent(self.cur, directive_ids, ticket, sent_at)
 
     def __repr__(self):
-        return f'SendContext(cur={self.cur!r}, smtp={self.smtp!r})'
+        return (f'SendContext(cur={self.cur!r}, smtp={self.smtp!r},'
+                f' sent_buffer={self.sent_buffer!r})')
 
 
 class Notification:
@@ -505,6 +675,14 @@ class Notification:
     def send(self, context):
         pass
 
+    def rendered(self):
+        """Return the list of notifications to send for this notification.
+
+        Notifications that are created lazily return the notifications
+        they render to, all others return a list with themselves.
+        """
+        return [self]
+
     def __repr__(self):
         return f'Notification(directive={self.directive!r})'
 
@@ -525,26 +703,137 @@ class EmailNotification(Notification):
           https://docs.python.org/3/library/smtplib.html#smtplib.SMTP.send_message
         * mark_as_sent: Optional, default: true. Mark the e-mail as sent in the database
         """
-        self.email = email
+        self._email = email
+        self._wire_bytes = None
         self.ticket = ticket
         self.envelope_tos = envelope_tos
         self.mark_as_sent = mark_as_sent
         super().__init__(directive)
 
+    @property
+    def email(self):
+        """The mail, with the signature if it was signed by a SigningPool."""
+        return finish_mail(self._email)
+
+    def as_bytes(self):
+        """Return the mail as it is sent.
+
+        The mail is serialized on the first call only. Later changes of
+        the email are therefore not reflected in the result.
+        """
+        if self._wire_bytes is None:
+            self._wire_bytes = wire_bytes(self.email)
+        return self._wire_bytes
+
     def send(self, send_context):
-        send_context.smtp.send_message(self.email, to_addrs=self.envelope_tos)
+        from_addr, to_addrs = smtp_envelope(self.email, self.envelope_tos)
+        if from_addr.isascii() and all(addr.isascii() for addr in to_addrs):
+            send_context.smtp.sendmail(from_addr, to_addrs, self.as_bytes())
+        else:
+            # internationalized addresses need SMTPUTF8, which
+            # send_message negotiates with the server
+            send_context.smtp.send_message(self.email, to_addrs=self.envelope_tos)
         if self.mark_as_sent:
             send_context.mark_as_sent(self.directive.directive_ids, self.ticket,
                                       self.email["Date"].datetime)
 
     def __repr__(self) -> str:
         return (f'EmailNotification(directive={self.directive!r}, '
-                f'email={self.email!r}, '
+                f'email={self._email!r}, '
                 f'ticket={self.ticket!r}, '
                 f'envelope_tos={self.envelope_tos!r}, '
                 f'mark_as_sent={self.mark_as_sent!r})')
 
 
+class StreamedEmailNotification(EmailNotification):
+    """Email notification for a mail written to a spool file by write_mail.
+
+    The email attribute is the StreamedMail. Its headers can be accessed
+    like those of an EmailMessage. When sent, the mail is read from the
+    spool file in pieces and the StreamedMail is closed afterwards.
+    """
+
+    @property
+    def email(self):
+        return self._email
+
+    def as_bytes(self):
+        """Return the mail as it is sent.
+
+        This reads the whole mail into memory.
+        """
+        return self._email.as_bytes()
+
+    def send(self, send_context):
+        from_addr, to_addrs = smtp_envelope(self.email.headers, self.envelope_tos)
+        mail_options = ()
+        if not (from_addr.isascii() and all(addr.isascii() for addr in to_addrs)):
+            # like send_message, require SMTPUTF8 for internationalized
+            # addresses
+            send_context.smtp.ehlo_or_helo_if_needed()
+            if not send_context.smtp.has_extn("smtputf8"):
+                raise smtplib.SMTPNotSupportedError(
+                    "One or more source or delivery addresses require"
+                    " internationalized email support, but the server"
+                    " does not advertise the required SMTPUTF8 capability")
+            mail_options = ("SMTPUTF8", "BODY=8BITMIME")
+        try:
+            send_streamed(send_context.smtp, from_addr, to_addrs, self.email, mail_options)
+        finally:
+            # delete the spool file, the headers are still available
+            self.email.close()
+        if self.mark_as_sent:
+            send_context.mark_as_sent(self.directive.directive_ids, self.ticket,
+                                      self.email["Date"].datetime)
+
+    def __repr__(self) -> str:
+        return (f'StreamedEmailNotification(directive={self.directive!r}, '
+                f'email={self._email!r}, '
+                f'ticket={self.ticket!r}, '
+                f'envelope_tos={self.envelope_tos!r}, '
+                f'mark_as_sent={self.mark_as_sent!r})')
+
+
+class LazyEmailNotification(Notification):
+    """Email notification that is rendered only when it is needed.
+
+    The render function is called without arguments when the
+    notification is sent or its mails are accessed in some other way,
+    and must return a list of EmailNotification instances, like
+    ScriptContext.mail_format_as_csv does. It's called at most once.
+    Until then, neither the event data is formatted nor a ticket number
+    drawn, so notifications that are only counted or dropped cost
+    little.
+    """
+
+    def __init__(self, directive, render):
+        self._render = render
+        self._notifications = None
+        super().__init__(directive)
+
+    def rendered(self):
+        if self._notifications is None:
+            self._notifications = self._render()
+        return self._notifications
+
+    @property
+    def email(self):
+        """The mail of the first rendered notification."""
+        return self.rendered()[0].email
+
+    @property
+    def ticket(self):
+        return self.rendered()[0].ticket
+
+    def send(self, send_context):
+        for notification in self.rendered():
+            notification.send(send_context)
+
+    def __repr__(self):
+        return (f'LazyEmailNotification(directive={self.directive!r}, '
+                f'notifications={self._notifications!r})')
+
+
 class _Postponed:
     """Represents a script result for postponed directives.
 
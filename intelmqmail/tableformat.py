@@ -22,16 +22,36 @@ import io
 import csv
 
 
+# Keys and titles of the columns added to collapsed rows, see TableFormat
+COLLAPSE_COLUMNS = (("count", "count"),
+                    ("first_seen", "first_seen"),
+                    ("last_seen", "last_seen"))
+
+
 class TableFormat:
 
     """Describe a table format.
+
+    Optionally, rows which are equal in a set of columns can be
+    collapsed into one row. Scanner feeds, for instance, often report
+    the same ip and port many times with only time.source differing.
+    Collapsing those rows keeps the values of the first of the rows and
+    adds the columns count, first_seen and last_seen, with the number
+    of rows collapsed and the minimum and maximum of the time column.
     """
 
-    def __init__(self, name, columns):
+    def __init__(self, name, columns, collapse_on=None,
+                 time_column="time.source"):
         """Initialize the format specification.
-        The columns parameter should be a list of Column instances."""
+        The columns parameter should be a list of Column instances.
+        The collapse_on parameter is a list of column keys. If given,
+        rows are collapsed if they are equal in these columns. The
+        first_seen and last_seen values of collapsed rows are taken from
+        the time_column of the event table."""
         self.name = name
         self.columns = columns
+        self.collapse_on = collapse_on
+        self.time_column = time_column
 
     def column_titles(self):
         """Return a dictionary with the column titles for use as a header.
@@ -39,20 +59,29 @@ class TableFormat:
         The keys of the dictionary are the same that row_from_event also
         uses.
         """
-        return dict((col.column_key, col.title) for col in self.columns)
+        titles = dict((col.column_key, col.title) for col in self.columns)
+        if self.collapse_on:
+            titles.update(COLLAPSE_COLUMNS)
+        return titles
 
     def event_table_columns(self):
         """Return a list with the columns to retrieve from the event table.
         """
-        return list(set(col.event_table_column for col in self.columns))
+        columns = set(col.event_table_column for col in self.columns)
+        if self.collapse_on:
+            columns.add(self.time_column)
+        return list(columns)
 
     def column_keys(self):
         """Return a list with the keys used for the rows.
         The list is intended to be used as the field names parameter for
         e.g. the csv.DictWriter class and matches the dictionaries
-        returned by the row_from_event method.
+        returned by the rows_from_events method.
         """
-        return [col.column_key for col in self.columns]
+        keys = [col.column_key for col in self.columns]
+        if self.collapse_on:
+            keys.extend(key for key, title in COLLAPSE_COLUMNS)
+        return keys
 
     def row_from_event(self, event):
         """Return the row for the given event as a dictionary.
@@ -60,6 +89,41 @@ class TableFormat:
         return dict((col.column_key, col.value_from_event(event))
                     for col in self.columns)
 
+    def rows_from_events(self, events):
+        """Return the rows for the given events as a list of dictionaries.
+        If the format collapses rows, this is done in a single pass over
+        the events, keeping the order in which the rows first occur.
+        """
+        if not self.collapse_on:
+            return [self.row_from_event(event) for event in events]
+
+        collapsed = {}
+        for event in events:
+            row = self.row_from_event(event)
+            key = tuple(_hashable(row[column_key])
+                        for column_key in self.collapse_on)
+            seen = event[self.time_column]
+            collapsed_row = collapsed.get(key)
+            if collapsed_row is None:
+                row.update(count=1, first_seen=seen, last_seen=seen)
+                collapsed[key] = row
+            else:
+                collapsed_row["count"] += 1
+                if seen is not None:
+                    if collapsed_row["first_seen"] is None or seen < collapsed_row["first_seen"]:
+                        collapsed_row["first_seen"] = seen
+                    if collapsed_row["last_seen"] is None or seen > collapsed_row["last_seen"]:
+                        collapsed_row["last_seen"] = seen
+        return list(collapsed.values())
+
+
+def _hashable(value):
+    """Return value in a form that can be used in a dictionary key.
+    Values of the extra field may be JSON objects or arrays."""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True, default=str)
+    return value
+
 
 class Column:
 
@@ -154,14 +218,16 @@ def build_table_formats(formats):
                 for name, columns in formats)
 
 
-def build_table_format(name, columns):
+def build_table_format(name, columns, collapse_on=None):
     """Build a TableFormat instance for name.
     The columns parameter should be a list of column specifications
     which are passed to build_table_column to create the list of columns
-    for the TableFormat instance.
+    for the TableFormat instance. The optional collapse_on parameter is
+    passed on to TableFormat.
     """
     return TableFormat(name, [build_table_column(col)
-                              for col in columns])
+                              for col in columns],
+                       collapse_on=collapse_on)
 
 
 def build_table_column(col):
@@ -192,15 +258,51 @@ def format_as_csv(table_format, events):
     :table_format: The table format, assumed to be a TableFormat instance.
     :events: list of event dictionaries
     """
-    contents = io.StringIO()
-    writer = csv.DictWriter(contents, table_format.column_keys(), delimiter=",",
-                            quotechar='"', quoting=csv.QUOTE_ALL)
-    writer.writerow(table_format.column_titles())
-
-    for event in events:
-        row = table_format.row_from_event(event)
-        if row.get('time.source'):
-            row['time.source'] = row['time.source'].replace(tzinfo=None, microsecond=0)
-        writer.writerow(row)
+    return format_as_csv_parts(table_format, events)[0]
 
-    return contents.getvalue()
+
+def format_as_csv_parts(table_format, events, max_rows=None, max_size=None):
+    """Return a list of event dictionaries as CSV formatted strings.
+    The CSV data is split into several parts, each with its own header
+    line, if it has more than max_rows rows or more than max_size
+    characters. A part may only be larger than max_size if it consists
+    of a single row. The return value is a list with at least one part.
+    :table_format: The table format, assumed to be a TableFormat instance.
+    :events: list of event dictionaries
+    :max_rows: maximum number of rows per part, optional
+    :max_size: maximum number of characters per part, optional
+    """
+    parts = []
+    contents = writer = None
+    rows_in_part = 0
+
+    def start_part():
+        nonlocal contents, writer, rows_in_part
+        if contents is not None:
+            parts.append(contents.getvalue())
+        contents = io.StringIO()
+        writer = csv.DictWriter(contents, table_format.column_keys(), delimiter=",",
+                                quotechar='"', quoting=csv.QUOTE_ALL)
+        writer.writerow(table_format.column_titles())
+        rows_in_part = 0
+
+    start_part()
+    for row in table_format.rows_from_events(events):
+        for key in ('time.source', 'first_seen', 'last_seen'):
+            if row.get(key):
+                row[key] = row[key].replace(tzinfo=None, microsecond=0)
+
+        if max_rows is not None and rows_in_part >= max_rows:
+            start_part()
+        position = contents.tell()
+        writer.writerow(row)
+        if max_size is not None and rows_in_part > 0 and contents.tell() > max_size:
+            # move the row to a new part
+            contents.seek(position)
+            contents.truncate()
+            start_part()
+            writer.writerow(row)
+        rows_in_part += 1
+
+    parts.append(contents.getvalue())
+    return parts
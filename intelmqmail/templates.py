@@ -19,6 +19,7 @@
 
 import os
 import string
+import functools
 
 
 def full_template_filename(template_dir, template_name):
@@ -62,13 +63,44 @@ def read_template(template_dir, template_name):
         the different formatter implementations for the substitutions they
         support.
 
+    The parsed templates are cached and only read again if the
+    modification time of the file changes.
+
     The return value is an instance of the Template class.
     """
-    with open(full_template_filename(template_dir, template_name)) as infile:
+    filename = full_template_filename(template_dir, template_name)
+    mtime = os.stat(filename).st_mtime_ns
+    cached = _template_file_cache.get(filename)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(filename) as infile:
         subject = None
         while not subject:
             subject = infile.readline().strip()
-        return Template.from_strings(subject, infile.read().strip() + "\n")
+        template = Template.from_strings(subject, infile.read().strip() + "\n")
+    _template_file_cache[filename] = (mtime, template)
+    return template
+
+
+# maps absolute template file names to (modification time, Template) pairs
+_template_file_cache = {}
+
+
+@functools.lru_cache(maxsize=256)
+def template_from_string(text):
+    """Create a template from a string in the format of a template file.
+
+    The first line of the stripped text is used as the subject, the rest
+    as the body, with a trailing newline added. Results are cached
+    because callers like IntelMQ Webinput CSV pass the same template
+    strings over and over again.
+
+    The return value is an instance of the Template class.
+    """
+    text = text.strip()
+    subject, sep, body = text.partition("\n")
+    return Template.from_strings(subject, body + "\n")
 
 
 class IntelMQStringTemplate(string.Template):
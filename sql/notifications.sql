@@ -38,6 +38,13 @@ END $$;
 CREATE SEQUENCE IF NOT EXISTS intelmq_ticket_seq MINVALUE 10000001;
 ALTER SEQUENCE intelmq_ticket_seq OWNER TO eventdb_send_notifications;
 
+-- The day of the last reset of intelmq_ticket_seq as YYYYMMDD, the same
+-- as the initial value of ticket_day. Unlike ticket_day, it is not
+-- transactional, so concurrent transactions see a reset at once and a
+-- rollback does not undo it.
+CREATE SEQUENCE IF NOT EXISTS intelmq_ticket_day_seq MINVALUE 0 START 20160101;
+ALTER SEQUENCE intelmq_ticket_day_seq OWNER TO eventdb_send_notifications;
+
 SET ROLE eventdb_owner;
 
 GRANT INSERT ON events TO eventdb_insert;
@@ -52,6 +59,62 @@ INSERT INTO ticket_day (initialized_for_day)
 SELECT '20160101' WHERE NOT EXISTS (SELECT 1 FROM ticket_day);
 GRANT SELECT, UPDATE ON ticket_day TO eventdb_send_notifications;
 
+-- Draw a new ticket number in the format YYYYMMDD-XXXXXXXX.
+--
+-- The day is that of now() in the session time zone. The ticket counter
+-- is reset with the first ticket of a new day. The transaction that gets
+-- the advisory lock for the day resets it with setval, the others only
+-- wait until intelmq_ticket_day_seq shows the reset and not for the end
+-- of that transaction. Neither the lock nor the row lock on ticket_day
+-- make other callers wait.
+--
+-- Returns NULL if the counter has been initialized for a day after
+-- today, in ticket_day or by a reset not yet committed.
+CREATE OR REPLACE FUNCTION intelmq_new_ticket()
+RETURNS TEXT
+AS $$
+DECLARE
+    today DATE := now() :: DATE;
+    today_num BIGINT := to_char(today, 'YYYYMMDD') :: BIGINT;
+    init_day DATE;
+BEGIN
+    SELECT initialized_for_day INTO init_day FROM ticket_day;
+    -- The reset by another transaction is visible in
+    -- intelmq_ticket_day_seq at once. A transaction whose now() is
+    -- still on the day before must not draw from the reset counter.
+    IF init_day > today
+       OR (SELECT last_value FROM intelmq_ticket_day_seq) > today_num THEN
+        RETURN NULL;
+    END IF;
+    IF init_day < today THEN
+        LOOP
+            EXIT WHEN (SELECT last_value FROM intelmq_ticket_day_seq) >= today_num;
+            IF pg_try_advisory_xact_lock(hashtext('intelmq_new_ticket'), today_num :: INTEGER) THEN
+                IF (SELECT last_value FROM intelmq_ticket_day_seq) < today_num THEN
+                    PERFORM setval('intelmq_ticket_seq',
+                                   (SELECT seqstart FROM pg_sequence
+                                     WHERE seqrelid = 'intelmq_ticket_seq' :: REGCLASS),
+                                   false);
+                    PERFORM setval('intelmq_ticket_day_seq', today_num);
+                END IF;
+                EXIT;
+            END IF;
+            PERFORM pg_sleep(0.001);
+        END LOOP;
+        -- skip the row if another transaction is updating it
+        UPDATE ticket_day SET initialized_for_day = today
+         WHERE ctid IN (SELECT ctid FROM ticket_day
+                         WHERE initialized_for_day < today
+                           FOR UPDATE SKIP LOCKED);
+    END IF;
+    RETURN to_char(today, 'YYYYMMDD') || '-'
+           || right('00000000' || nextval('intelmq_ticket_seq'), 8);
+END
+$$ LANGUAGE plpgsql VOLATILE;
+
+GRANT EXECUTE ON FUNCTION intelmq_new_ticket()
+TO eventdb_send_notifications;
+
 
 CREATE TABLE IF NOT EXISTS sent (
     id BIGSERIAL UNIQUE PRIMARY KEY,
@@ -80,6 +143,11 @@ CREATE TABLE IF NOT EXISTS directives (
 
     inserted_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
 
+    -- The mailgen worker that claimed the directive and until when the
+    -- claim is valid. Only used with the "lease" claim mode.
+    claimed_by TEXT,
+    claimed_until TIMESTAMP WITH TIME ZONE,
+
     FOREIGN KEY (events_id) REFERENCES events(id) ON DELETE CASCADE,
     FOREIGN KEY (sent_id) REFERENCES sent(id) ON DELETE CASCADE
 );
@@ -107,6 +175,65 @@ CREATE INDEX IF NOT EXISTS directives_recipient_group_idx
 GRANT SELECT, UPDATE ON directives TO eventdb_send_notifications;
 
 
+-- Optional insert-only alternative to directives.sent_id, see the
+-- sent_link_table setting of mailgen. Recording the sent state here
+-- avoids updating the directives.
+CREATE TABLE IF NOT EXISTS directive_sent (
+    directive_id BIGINT PRIMARY KEY,
+    sent_id BIGINT NOT NULL,
+
+    FOREIGN KEY (directive_id) REFERENCES directives(id) ON DELETE CASCADE,
+    FOREIGN KEY (sent_id) REFERENCES sent(id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS directive_sent_sent_id_idx
+          ON directive_sent (sent_id);
+
+GRANT SELECT, INSERT ON directive_sent TO eventdb_send_notifications;
+
+-- The directives not sent yet while the link table is used. Unlike
+-- with sent_id, nothing in directives tells whether a directive has
+-- been sent, so mailgen finds the pending directives through this
+-- table instead of looking at all directives. A trigger on directives
+-- adds the new directives and a trigger on directive_sent removes the
+-- sent ones. The triggers are only created when switching to the link
+-- table, see sql/updates.md.
+CREATE TABLE IF NOT EXISTS directive_pending (
+    directive_id BIGINT PRIMARY KEY,
+
+    FOREIGN KEY (directive_id) REFERENCES directives(id) ON DELETE CASCADE
+);
+
+GRANT SELECT ON directive_pending TO eventdb_send_notifications;
+
+
+CREATE OR REPLACE FUNCTION directives_add_pending_for_statement()
+RETURNS TRIGGER
+AS $$
+BEGIN
+    INSERT INTO directive_pending (directive_id) SELECT id FROM new_directives;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql VOLATILE EXTERNAL SECURITY DEFINER;
+
+GRANT EXECUTE ON FUNCTION directives_add_pending_for_statement()
+TO eventdb_insert, eventdb_send_notifications;
+
+
+CREATE OR REPLACE FUNCTION directive_sent_remove_pending_for_statement()
+RETURNS TRIGGER
+AS $$
+BEGIN
+    DELETE FROM directive_pending
+     WHERE directive_id IN (SELECT directive_id FROM new_directive_sent);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql VOLATILE EXTERNAL SECURITY DEFINER;
+
+GRANT EXECUTE ON FUNCTION directive_sent_remove_pending_for_statement()
+TO eventdb_send_notifications;
+
+
 -- Converts a JSON object used as aggregate identifier to a
 -- 2-dimensional TEXT array usable as a value in the database for
 -- grouping. Doing this properly is a bit tricky. Requirements:
@@ -142,22 +269,15 @@ GRANT SELECT, UPDATE ON directives TO eventdb_send_notifications;
 -- 16.4 LTS we go with json_each_text because in most cases the values
 -- will have come from IntelMQ events where the values have been
 -- validated and e.g. ASNs will always be numbers.
+--
+-- The pairs are collected with a single ordered array_agg, which
+-- builds the same 2-dimensional array as appending them one by one.
 CREATE OR REPLACE FUNCTION json_object_as_text_array(obj JSONB)
 RETURNS TEXT[][]
 AS $$
-DECLARE
-    arr TEXT[][] = '{}'::TEXT[][];
-    k TEXT;
-    v TEXT;
-BEGIN
-    FOR k, v IN
-        SELECT * FROM jsonb_each_text(obj) ORDER BY key
-    LOOP
-        arr := arr || ARRAY[ARRAY[k, v]];
-    END LOOP;
-    RETURN arr;
-END
-$$ LANGUAGE plpgsql IMMUTABLE;
+    SELECT coalesce(array_agg(ARRAY[key, value] ORDER BY key), '{}'::TEXT[][])
+      FROM jsonb_each_text(obj);
+$$ LANGUAGE sql IMMUTABLE;
 
 
 CREATE OR REPLACE FUNCTION insert_directive(
@@ -210,43 +330,164 @@ END
 $$ LANGUAGE plpgsql VOLATILE;
 
 
+-- Returns the valid directives of the source_directives in extra as
+-- rows for the directives table. This applies the same rules as
+-- insert_directive and can be inlined into the calling query, so that
+-- the directives of many events can be extracted in one statement.
+CREATE OR REPLACE FUNCTION directive_rows_from_extra(
+    event_id BIGINT,
+    extra JSONB
+) RETURNS TABLE (
+    events_id BIGINT,
+    medium TEXT,
+    recipient_address TEXT,
+    template_name TEXT,
+    notification_format TEXT,
+    event_data_format TEXT,
+    aggregate_identifier TEXT[][],
+    notification_interval INTERVAL,
+    endpoint ip_endpoint
+)
+AS $$
+    SELECT *
+      FROM (SELECT event_id,
+                   directive ->> 'medium' AS medium,
+                   directive ->> 'recipient_address' AS recipient_address,
+                   directive ->> 'template_name' AS template_name,
+                   directive ->> 'notification_format' AS notification_format,
+                   directive ->> 'event_data_format' AS event_data_format,
+                   json_object_as_text_array(directive -> 'aggregate_identifier'),
+                   coalesce(((directive ->> 'notification_interval') :: INT)
+                            * interval '1 second',
+                            interval '0 second') AS notification_interval,
+                   'source' :: ip_endpoint
+              FROM jsonb_array_elements(extra -> 'certbund' -> 'source_directives')
+                   AS t (directive)) AS d
+     WHERE d.medium IS NOT NULL
+       AND d.recipient_address IS NOT NULL
+       AND d.template_name IS NOT NULL
+       AND d.notification_format IS NOT NULL
+       AND d.event_data_format IS NOT NULL
+       AND d.notification_interval != interval '-1 second';
+$$ LANGUAGE sql STABLE;
+
+
 CREATE OR REPLACE FUNCTION directives_from_extra(
     event_id BIGINT,
     extra JSONB
 ) RETURNS VOID
 AS $$
-DECLARE
-    json_directives JSONB := extra -> 'certbund' -> 'source_directives';
-    directive JSONB;
 BEGIN
-    IF json_directives IS NOT NULL THEN
-        FOR directive
-         IN SELECT * FROM jsonb_array_elements(json_directives) LOOP
-            PERFORM insert_directive(event_id, directive, 'source');
-        END LOOP;
-    END IF;
+    INSERT INTO directives (events_id,
+                            medium,
+                            recipient_address,
+                            template_name,
+                            notification_format,
+                            event_data_format,
+                            aggregate_identifier,
+                            notification_interval,
+                            endpoint)
+    SELECT * FROM directive_rows_from_extra(event_id, extra);
 END
 $$ LANGUAGE plpgsql VOLATILE;
 
 
-CREATE OR REPLACE FUNCTION events_insert_directives_for_row()
+-- Statement level trigger function extracting the directives of all
+-- events inserted by the statement with a single INSERT. The new events
+-- are available in the transition table new_events.
+CREATE OR REPLACE FUNCTION events_insert_directives_for_statement()
+RETURNS TRIGGER
+AS $$
+BEGIN
+    INSERT INTO directives (events_id,
+                            medium,
+                            recipient_address,
+                            template_name,
+                            notification_format,
+                            event_data_format,
+                            aggregate_identifier,
+                            notification_interval,
+                            endpoint)
+    SELECT d.*
+      FROM new_events,
+           directive_rows_from_extra(new_events.id, new_events.extra) AS d;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql VOLATILE EXTERNAL SECURITY DEFINER;
+
+GRANT EXECUTE ON FUNCTION events_insert_directives_for_statement()
+TO eventdb_insert;
+
+
+-- Deferred expansion of the directives (optional). Instead of the
+-- trigger above, a trigger with events_enqueue_for_statement only
+-- records the ids of new events in directive_queue, and mailgen expands
+-- their directives with expand_queued_directives before it looks for
+-- pending directives. See sql/updates.md for switching the triggers.
+CREATE TABLE IF NOT EXISTS directive_queue (
+    events_id BIGINT NOT NULL,
+    queued_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+
+CREATE OR REPLACE FUNCTION events_enqueue_for_statement()
 RETURNS TRIGGER
 AS $$
 BEGIN
-    PERFORM directives_from_extra(NEW.id, NEW.extra);
-    RETURN NEW;
+    INSERT INTO directive_queue (events_id) SELECT id FROM new_events;
+    RETURN NULL;
 END
 $$ LANGUAGE plpgsql VOLATILE EXTERNAL SECURITY DEFINER;
 
-GRANT EXECUTE ON FUNCTION events_insert_directives_for_row()
+GRANT EXECUTE ON FUNCTION events_enqueue_for_statement()
 TO eventdb_insert;
 
 
+-- Expands the directives of the queued events and empties the queue.
+-- The directives get the time the event was queued as inserted_at.
+-- Returns the number of new directives.
+CREATE OR REPLACE FUNCTION expand_queued_directives()
+RETURNS BIGINT
+AS $$
+DECLARE
+    inserted BIGINT;
+BEGIN
+    WITH queued AS (DELETE FROM directive_queue
+                    RETURNING events_id, queued_at)
+    INSERT INTO directives (events_id,
+                            medium,
+                            recipient_address,
+                            template_name,
+                            notification_format,
+                            event_data_format,
+                            aggregate_identifier,
+                            notification_interval,
+                            endpoint,
+                            inserted_at)
+    SELECT d.*, queued.queued_at
+      FROM queued
+      JOIN events ON events.id = queued.events_id,
+           directive_rows_from_extra(events.id, events.extra) AS d;
+    GET DIAGNOSTICS inserted = ROW_COUNT;
+    RETURN inserted;
+END
+$$ LANGUAGE plpgsql VOLATILE EXTERNAL SECURITY DEFINER;
+
+GRANT EXECUTE ON FUNCTION expand_queued_directives()
+TO eventdb_send_notifications;
+
+
+-- The row level trigger of older versions is replaced by the statement
+-- level trigger
+DROP TRIGGER IF EXISTS events_insert_directive_trigger ON events;
+DROP FUNCTION IF EXISTS events_insert_directives_for_row();
+
 DO $$ BEGIN
-    CREATE TRIGGER events_insert_directive_trigger
+    CREATE TRIGGER events_insert_directives_statement_trigger
     AFTER INSERT ON events
-    FOR EACH ROW
-    EXECUTE PROCEDURE events_insert_directives_for_row();
+    REFERENCING NEW TABLE AS new_events
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE events_insert_directives_for_statement();
 EXCEPTION WHEN duplicate_object THEN NULL;
 END $$;
 
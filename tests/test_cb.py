@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""Test the intelmqmail.cb module.
+
+Dependencies:
+    (none)
+"""
+
+import unittest
+import unittest.mock
+
+from intelmqmail import cb
+
+
+class TestMailgen(unittest.TestCase):
+
+    def test_connection_closed_if_setup_fails(self):
+        """The connection opened by mailgen is closed if preparing it fails"""
+        config = {'database': {'prepared_statements': True}}
+        with unittest.mock.patch('intelmqmail.cb.open_db_connection') as open_db_connection, \
+                unittest.mock.patch('intelmqmail.cb.open_replica_connection', return_value=None), \
+                unittest.mock.patch('intelmqmail.cb.enable_prepared_statements',
+                                    side_effect=RuntimeError('prepare failed')):
+            with self.assertRaises(RuntimeError):
+                cb.mailgen(config, [], process_all=True)
+        conn = open_db_connection.return_value
+        conn.commit.assert_called_once_with()
+        conn.close.assert_called_once_with()
+
+
+class TestCheckConfig(unittest.TestCase):
+
+    def config(self, **sections):
+        return dict(openpgp=dict(always_sign=False, gnupg_home="", signing_key=""),
+                    **sections)
+
+    def test_compression(self):
+        """gzip and zip are accepted as compression of attachments"""
+        for compression in ("gzip", "zip"):
+            config = self.config(compress_attachments=dict(compression=compression))
+            with unittest.mock.patch('intelmqmail.cb.load_script_entry_points',
+                                     return_value=["script"]):
+                self.assertEqual(cb.check_config_and_load_scripts(config), ["script"])
+
+    def test_unknown_compression(self):
+        """Mailgen exits if the compression of attachments is unknown"""
+        config = self.config(compress_attachments=dict(compression="bzip2"))
+        with unittest.mock.patch('intelmqmail.cb.load_script_entry_points',
+                                 return_value=["script"]):
+            with self.assertRaises(SystemExit):
+                cb.check_config_and_load_scripts(config)
+
+
+class TestSession(unittest.TestCase):
+
+    database = dict(name='intelmq-events', username='intelmq_mailgen', password='secret',
+                    host='localhost', port=5432)
+
+    def session(self, replica=False):
+        """Return a session with mocked pools and scripts and the pools.
+
+        The pools are created in the order primary, replica.
+        """
+        config = {'database': {'event': self.database}}
+        if replica:
+            config['database']['replica'] = dict(self.database, host='replica')
+        with unittest.mock.patch('psycopg2.pool.ThreadedConnectionPool') as pool_class, \
+                unittest.mock.patch('intelmqmail.cb.check_config_and_load_scripts',
+                                    return_value=['script']) as load_scripts:
+            pool_class.side_effect = lambda *args, **kw: unittest.mock.MagicMock()
+            session = cb.Session(config)
+        load_scripts.assert_called_once_with(config)
+        return session
+
+    def test_scripts_loaded_once(self):
+        session = self.session()
+        with unittest.mock.patch('intelmqmail.cb.mailgen', return_value='result') as mailgen:
+            self.assertEqual(session.start(process_all=True), 'result')
+            self.assertEqual(session.start(process_all=True), 'result')
+        self.assertEqual([c.args[1] for c in mailgen.call_args_list], [['script'], ['script']])
+
+    def test_connection_returned(self):
+        session = self.session()
+        with unittest.mock.patch('intelmqmail.cb.mailgen') as mailgen:
+            session.start(process_all=True)
+        conn = session.pool.getconn.return_value
+        self.assertIs(mailgen.call_args.kwargs['conn'], conn)
+        self.assertIsNone(mailgen.call_args.kwargs['replica_conn'])
+        self.assertFalse(mailgen.call_args.kwargs['close_conn'])
+        session.pool.putconn.assert_called_once_with(conn)
+
+    def test_connection_returned_on_exception(self):
+        session = self.session()
+        with unittest.mock.patch('intelmqmail.cb.mailgen', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                session.start(process_all=True)
+        session.pool.putconn.assert_called_once_with(session.pool.getconn.return_value)
+
+    def test_replica_connection_returned(self):
+        session = self.session(replica=True)
+        with unittest.mock.patch('intelmqmail.cb.mailgen', side_effect=RuntimeError) as mailgen:
+            with self.assertRaises(RuntimeError):
+                session.start(get_preview=True)
+        replica_conn = session.replica_pool.getconn.return_value
+        self.assertIs(mailgen.call_args.kwargs['replica_conn'], replica_conn)
+        replica_conn.set_session.assert_called_once_with(readonly=True)
+        session.replica_pool.putconn.assert_called_once_with(replica_conn)
+        session.pool.putconn.assert_called_once_with(session.pool.getconn.return_value)
+
+    def test_close(self):
+        session = self.session(replica=True)
+        with unittest.mock.patch("intelmqmail.cb.close_signers") as close_signers:
+            with session:
+                pass
+        session.pool.closeall.assert_called_once_with()
+        session.replica_pool.closeall.assert_called_once_with()
+        close_signers.assert_called_once_with()
+
+
+class TestSendNotifications(unittest.TestCase):
+
+    config = {
+        "openpgp": {"always_sign": True, "gnupg_home": None, "signing_key": "key",
+                    "signing_processes": 2},
+        "database": {},
+        "smtp": {"host": "localhost", "port": 25},
+    }
+
+    def send(self, directives, fail_sending=()):
+        """Send notifications for directives with a mocked SigningPool.
+
+        Returns the log of the SQL statements, the creation of the
+        notifications and the sending of the mails, and the result.
+        """
+        events = []
+        cur = unittest.mock.MagicMock()
+        cur.execute.side_effect = lambda statement: events.append(statement)
+
+        def create_notifications(cur, directive, *args, **kw):
+            events.append(f"create {directive}")
+            notification = unittest.mock.MagicMock()
+            notification.rendered.return_value = [notification]
+
+            def send(context):
+                if directive in fail_sending:
+                    raise RuntimeError("SMTP error")
+                events.append(f"send {directive}")
+            notification.send.side_effect = send
+            return [notification]
+
+        pool = unittest.mock.MagicMock(spec=cb.SigningPool, processes=2)
+        with unittest.mock.patch("intelmqmail.cb.get_signer") as get_signer, \
+                unittest.mock.patch("intelmqmail.cb.create_notifications",
+                                    side_effect=create_notifications), \
+                unittest.mock.patch("smtplib.SMTP"):
+            get_signer.return_value.context.return_value = pool
+            result = cb.send_notifications(self.config, directives, cur, [])
+        return events, result
+
+    def test_lookahead(self):
+        """With a SigningPool, later directives are created before sending"""
+        events, result = self.send(["d1", "d2", "d3", "d4"])
+        self.assertEqual(result, (4, 0, 0))
+        self.assertEqual([e for e in events if not e.endswith("SAVEPOINT sendmail;")],
+                         ["create d1", "create d2", "create d3", "send d1",
+                          "create d4", "send d2", "send d3", "send d4"])
+
+    def test_lookahead_savepoints_not_nested(self):
+        """Each savepoint is released before the next one is set"""
+        events, result = self.send(["d1", "d2", "d3"], fail_sending=["d2"])
+        self.assertEqual(result, (2, 0, 1))
+        set_, release, rollback = ("SAVEPOINT sendmail;", "RELEASE SAVEPOINT sendmail;",
+                                   "ROLLBACK TO SAVEPOINT sendmail;")
+        self.assertEqual(events,
+                         [set_, "create d1", release, set_, "create d2", release,
+                          set_, "create d3", release, set_, "send d1", release,
+                          set_, rollback, release, set_, "send d3", release])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,6 +10,8 @@ Authors:
 """
 
 import unittest
+import unittest.mock
+from datetime import datetime
 
 
 from intelmqmail import db
@@ -23,3 +25,222 @@ class Tests(unittest.TestCase):
 
         self.assertRaises(ValueError, db.escape_sql_identifier, 'oh-no')
         self.assertRaises(ValueError, db.escape_sql_identifier, '%s \\")$')
+
+    def test_load_events_prepared(self):
+        """Prepared statements are prepared once per connection and column list"""
+        cur = unittest.mock.Mock()
+        db.enable_prepared_statements(cur.connection)
+        db.load_events(cur, [1, 2], ["source.ip"])
+        db.load_events(cur, [3], ["source.ip"])
+        db.load_events(cur, [3], ["source.asn"])
+
+        statements = [call.args[0] for call in cur.execute.call_args_list]
+        self.assertEqual(len(statements), 5)
+        self.assertRegex(statements[0], r'^PREPARE intelmqmail_load_events_\w+ AS'
+                         r' SELECT "source.ip" FROM events WHERE id = ANY \(\$1\)$')
+        name = statements[0].split()[1]
+        self.assertEqual(statements[1:3], [f"EXECUTE {name} (%s)"] * 2)
+        self.assertEqual(cur.execute.call_args_list[2].args[1], ([3],))
+        self.assertNotIn(name, statements[3])
+
+    def test_load_events_not_prepared(self):
+        cur = unittest.mock.Mock()
+        db.load_events(cur, [1, 2], ["source.ip"])
+        cur.execute.assert_called_once_with(
+            'SELECT "source.ip" FROM events WHERE id = ANY (%s)', ([1, 2],))
+
+    def test_mark_many_as_sent(self):
+        """Several notifications are marked as sent with one statement"""
+        cur = unittest.mock.Mock()
+        sent_at = datetime(2024, 1, 1, 12, 0, 0)
+        db.mark_many_as_sent(cur, [([1, 2], "20240101-10000001", sent_at),
+                                   ([3], "20240101-10000002", sent_at)])
+        cur.execute.assert_called_once()
+        self.assertEqual(cur.execute.call_args.args[1],
+                         (["20240101-10000001", "20240101-10000002"],
+                          [sent_at, sent_at], [1, 2, 3], [1, 1, 2]))
+
+    def test_mark_as_sent_link_table(self):
+        """With the link table, the directives are not updated"""
+        cur = unittest.mock.Mock()
+        db.enable_sent_link_table(cur.connection)
+        db.mark_as_sent(cur, [1, 2], "20240101-10000001", None)
+        db.mark_many_as_sent(cur, [([3], "20240101-10000002", None)])
+        for call in cur.execute.call_args_list:
+            self.assertIn("INSERT INTO directive_sent", call.args[0])
+            self.assertNotIn("UPDATE directives", call.args[0])
+
+    def test_expand_queued_directives(self):
+        cur = unittest.mock.Mock()
+        cur.fetchone.return_value = {"directives": 42}
+        self.assertEqual(db.expand_queued_directives(cur), 42)
+        cur.execute.assert_called_once_with("SELECT expand_queued_directives() AS directives;")
+
+
+class TestPendingNotifications(unittest.TestCase):
+
+    def test_unlimited(self):
+        cur = unittest.mock.Mock()
+        db.get_pending_notifications(cur)
+        query = cur.execute.call_args.args[0]
+        self.assertIn("FOR UPDATE NOWAIT", query)
+        self.assertNotIn("chunk", query)
+        self.assertNotIn("ORDER BY d.", query)
+
+    def test_chunk(self):
+        """Chunks are limited, ordered and continue after the previous one"""
+        cur = unittest.mock.Mock()
+        cur.connection.encoding = "UTF8"
+        cur.mogrify.side_effect = lambda query, args: repr(args[0]).encode()
+        previous = {"recipient_address": "a@example.com", "template_name": "t",
+                    "notification_format": "f", "event_data_format": "e",
+                    "aggregate_identifier": [["k", "v"]], "event_ids": [1]}
+        db.get_pending_notifications(cur, "events.\"source.asn\" = 1",
+                                     limit=10, after=previous)
+        query = cur.execute.call_args.args[0]
+        self.assertTrue(query.startswith("WITH chunk AS ("))
+        self.assertIn("LIMIT 10", query)
+        self.assertIn(" > ('a@example.com', 't', 'f', 'e', [['k', 'v']]::TEXT[])", query)
+        self.assertIn("IN (SELECT * FROM chunk)", query)
+        self.assertIn("ORDER BY d.recipient_address", query)
+        self.assertEqual(query.count("JOIN events"), 2)
+
+    def test_claim(self):
+        """Claiming skips locked rows and returns the claimed directives"""
+        cur = unittest.mock.Mock()
+        cur.connection.encoding = "UTF8"
+        cur.mogrify.side_effect = lambda query, args: repr(args[0]).encode()
+        db.claim_pending_notifications(cur, "worker-1", 600, limit=10)
+        query = cur.execute.call_args.args[0]
+        self.assertIn("FOR UPDATE OF d3 SKIP LOCKED", query)
+        self.assertNotIn("NOWAIT", query)
+        self.assertIn("SET claimed_by = 'worker-1'", query)
+        self.assertIn("now() + 600 * interval '1 second'", query)
+        self.assertIn("OR claimed_by = 'worker-1')", query)
+        self.assertIn("FROM claimed AS d", query)
+
+    def test_no_claims(self):
+        """Claims are only respected in the lease claim mode"""
+        cur = unittest.mock.Mock()
+        db.get_pending_notifications(cur)
+        self.assertNotIn("claimed_until", cur.execute.call_args.args[0])
+        db.enable_lease_claims(cur.connection)
+        db.get_pending_notifications(cur)
+        self.assertIn("AND (claimed_until IS NULL OR claimed_until < now())",
+                      cur.execute.call_args.args[0])
+
+    def test_lock_groups(self):
+        """Groups are locked in order until the limit is reached"""
+        cur = unittest.mock.Mock()
+        cur.connection.encoding = "UTF8"
+        db.lock_pending_groups(cur, limit=10)
+        query = cur.execute.call_args.args[0]
+        self.assertIn("OFFSET 0) AS groups", query)
+        self.assertIn(f"WHERE pg_try_advisory_xact_lock({db.ADVISORY_LOCK_NAMESPACE}, group_hash)", query)
+        self.assertTrue(query.endswith("LIMIT 10;"))
+
+    def test_group_hashes(self):
+        """The directives of locked groups are fetched without row locks"""
+        cur = unittest.mock.Mock()
+        cur.connection.encoding = "UTF8"
+        cur.mogrify.side_effect = lambda query, args: repr(args[0]).encode()
+        db.get_pending_notifications(cur, lock=False, group_hashes=[17, -4])
+        query = cur.execute.call_args.args[0]
+        self.assertIn(f"AND {db.GROUP_HASH} = ANY ([17, -4]::INTEGER[])", query)
+        self.assertNotIn("FOR UPDATE", query)
+
+    def test_link_table(self):
+        """With the link table, unsent directives are found in directive_pending"""
+        cur = unittest.mock.Mock()
+        db.enable_sent_link_table(cur.connection)
+        db.get_pending_notifications(cur)
+        query = cur.execute.call_args.args[0]
+        self.assertNotIn("sent_id IS NULL", query)
+        self.assertIn("d3.id = ANY (ARRAY(SELECT directive_id FROM directive_pending))", query)
+        self.assertIn("JOIN directive_sent ds ON ds.directive_id = d2.id", query)
+
+
+class TestTicketNumbers(unittest.TestCase):
+
+    def cursor(self, *results, function=True):
+        cur = unittest.mock.Mock()
+        cur.fetchone.side_effect = ({"present": function},) + results
+        return cur
+
+    def test_new_ticket_number(self):
+        """A ticket number is drawn with a single statement"""
+        cur = self.cursor({"ticket": "20240101-10000005"}, {"ticket": "20240101-10000006"})
+        self.assertEqual(db.new_ticket_number(cur), "20240101-10000005")
+        self.assertEqual(db.new_ticket_number(cur), "20240101-10000006")
+        # the check for the function is only done once per connection
+        self.assertEqual(cur.execute.call_count, 3)
+        cur.execute.assert_called_with("SELECT intelmq_new_ticket() AS ticket;")
+
+    def test_new_ticket_number_future(self):
+        """RuntimeError if the function finds the ticket day in the future"""
+        cur = self.cursor({"ticket": None}, {"init_date": "20990101", "reset_day": 20990101})
+        with self.assertRaisesRegex(RuntimeError, "initialized_for_day='20990101'"):
+            db.new_ticket_number(cur)
+
+    def test_new_ticket_number_without_function(self):
+        """Without the function, the counter is reset by mailgen"""
+        cur = self.cursor(function=False)
+        cur.fetchall.side_effect = [
+            [{"date": "20240102", "init_date": "20240101", "nextval": 10000042}],
+            [{"date": "20240102", "init_date": "20240102", "nextval": 10000001}],
+        ]
+        self.assertEqual(db.new_ticket_number(cur), "20240102-10000001")
+        cur.execute.assert_any_call("ALTER SEQUENCE intelmq_ticket_seq RESTART;")
+        cur.execute.assert_any_call("UPDATE ticket_day SET initialized_for_day=%s;",
+                                    ("20240102",))
+
+    def test_new_ticket_number_without_function_future(self):
+        """Without the function, RuntimeError if the ticket day is in the future"""
+        cur = self.cursor(function=False)
+        cur.fetchall.return_value = [{"date": "20240101", "init_date": "20240102",
+                                      "nextval": 10000042}]
+        with self.assertRaisesRegex(RuntimeError, "initialized_for_day='20240102'"):
+            db.new_ticket_number(cur)
+
+    def test_allocator_block(self):
+        """A block of numbers is drawn with one statement"""
+        cur = self.cursor({"tickets": ["20240101-10000005", "20240101-10000006"]},
+                          {"tickets": ["20240101-10000010", "20240101-10000011"]})
+        allocator = db.TicketAllocator(2)
+        self.assertEqual([allocator.new_ticket_number(cur) for i in range(3)],
+                         ["20240101-10000005", "20240101-10000006",
+                          "20240101-10000010"])
+        self.assertEqual(cur.execute.call_count, 3)
+        self.assertEqual(cur.execute.call_args.args[1], (2,))
+
+    def test_allocator_block_without_function(self):
+        """Without the function, the block is drawn from the sequence"""
+        cur = self.cursor({"date": "20240101", "init_date": "20240101",
+                           "numbers": [10000005, 10000006]},
+                          function=False)
+        allocator = db.TicketAllocator(2)
+        self.assertEqual([allocator.new_ticket_number(cur) for i in range(2)],
+                         ["20240101-10000005", "20240101-10000006"])
+
+    def test_allocator_future(self):
+        """RuntimeError if the ticket day is in the future"""
+        cur = self.cursor({"tickets": [None, None]}, {"init_date": "20990101", "reset_day": 20990101})
+        with self.assertRaises(RuntimeError):
+            db.TicketAllocator(2).new_ticket_number(cur)
+
+    def test_allocator_rollback_to_savepoint(self):
+        """A block drawn after the savepoint is discarded when rolling back to it"""
+        cur = self.cursor({"tickets": ["20240101-10000001", "20240101-10000002",
+                                       "20240101-10000003"]},
+                          {"tickets": ["20240101-10000004", "20240101-10000005",
+                                       "20240101-10000006"]})
+        allocator = db.TicketAllocator(3)
+        allocator.savepoint()
+        self.assertEqual(allocator.new_ticket_number(cur), "20240101-10000001")
+        allocator.rollback_to_savepoint()
+        self.assertEqual(allocator.new_ticket_number(cur), "20240101-10000004")
+        # a block drawn before the savepoint is kept
+        allocator.savepoint()
+        self.assertEqual(allocator.new_ticket_number(cur), "20240101-10000005")
+        allocator.rollback_to_savepoint()
+        self.assertEqual(allocator.new_ticket_number(cur), "20240101-10000006")
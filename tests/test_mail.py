@@ -8,13 +8,26 @@ Authors:
  * 2016,2019 Bernhard Herzog <bernhard.herzog@intevation.de>
 """
 
+import email
+import gzip
+import io
+import random
+import smtplib
+import zipfile
 import unittest
 import re
+from unittest import mock
 from datetime import datetime, timedelta, timezone
+from email.contentmanager import ContentManager, raw_data_manager
+from email.message import EmailMessage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
 
 import gpg
 
-from intelmqmail.mail import create_mail
+from intelmqmail.mail import create_mail, finish_mail, SigningPool, Signer, get_signer, \
+    SignatureCache, signature_cache, smtp_envelope, wire_bytes, mailgen_policy, \
+    compressed_attachment, write_mail, send_streamed, MailFactory
 
 from .util import GpgHomeTestCase
 
@@ -109,6 +122,298 @@ class TestCreateUnsignedMail(MailCreationTest, unittest.TestCase):
         self.assertRegex(msg["Message-ID"], r"@example\.com>$")
 
 
+class ReferenceContentManager(ContentManager):
+    """The former, straightforward implementation of MailgenContentManager."""
+
+    def set_content(self, msg, obj, *args, **kw):
+        if isinstance(obj, str):
+            kw["cte"] = "quoted-printable"
+
+        raw_data_manager.set_content(msg, obj, *args, **kw)
+
+        if msg.get("content-transfer-encoding") == "quoted-printable":
+            content = msg.get_payload(decode=False)
+            msg.set_payload(content.replace("From ", "From=20"))
+
+
+class TestQuotedPrintable(unittest.TestCase):
+
+    pieces = ["a", "From ", "From", "rom ", " ", "\t", "=", ".", "\x00",
+              "\r", "\n", "\r\n", "\x0b", "\x85", "\xe9", "\u20ac",
+              "x" * 70, "x" * 74, "x" * 76, "x" * 160]
+
+    def check_same_as_reference(self, text, max_line_length, *args, **kw):
+        msg = EmailMessage(policy=mailgen_policy.clone(max_line_length=max_line_length))
+        msg.set_content(text, *args, **kw)
+        reference = EmailMessage(policy=mailgen_policy.clone(max_line_length=max_line_length,
+                                                             content_manager=ReferenceContentManager()))
+        reference.set_content(text, *args, **kw)
+        self.assertEqual(msg.as_bytes(), reference.as_bytes(), repr(text))
+
+    def test_random_texts(self):
+        """The encoding is the same as with the email package."""
+        rnd = random.Random(4711)
+        for i in range(1000):
+            text = "".join(rnd.choice(self.pieces)
+                           for j in range(rnd.randrange(40)))
+            self.check_same_as_reference(text, rnd.choice([78, 76, 10, 4]))
+
+    def test_random_texts_with_parameters(self):
+        rnd = random.Random(4712)
+        for i in range(200):
+            text = "".join(rnd.choice(self.pieces[:-5])
+                           for j in range(rnd.randrange(40)))
+            self.check_same_as_reference(text, 78, "csv", "iso-8859-1",
+                                         filename="events.csv")
+            self.check_same_as_reference(text, 78, subtype="csv", charset="utf-8")
+
+    def test_from_escaped(self):
+        msg = EmailMessage(policy=mailgen_policy)
+        msg.set_content("From here\nto From there\n")
+        self.assertEqual(msg.get_payload(), "From=20here\nto From=20there\n")
+
+
+class TestCompressedAttachment(MailCreationTest, unittest.TestCase):
+
+    def create_mail_with_compressed_attachment(self, compression):
+        return create_mail("sender@example.com", "recipient@example.com",
+                           "Test compressed attachment", self.body_content,
+                           [compressed_attachment(self.csv_content * 1000,
+                                                  "events.csv", compression)],
+                           None)
+
+    def test_gzip(self):
+        msg = self.create_mail_with_compressed_attachment("gzip")
+        body, attachment = self.check_unpack_multipart(msg, "mixed")
+        self.check_body_part(body)
+        self.assertEqual(attachment.get_content_type(), "application/gzip")
+        self.assertEqual(attachment.get_filename(), "events.csv.gz")
+        self.assertEqual(attachment["content-transfer-encoding"], "base64")
+        self.assertEqual(gzip.decompress(attachment.get_content()).decode(),
+                         self.csv_content * 1000)
+
+    def test_zip(self):
+        msg = self.create_mail_with_compressed_attachment("zip")
+        body, attachment = self.check_unpack_multipart(msg, "mixed")
+        self.assertEqual(attachment.get_content_type(), "application/zip")
+        self.assertEqual(attachment.get_filename(), "events.zip")
+        with zipfile.ZipFile(io.BytesIO(attachment.get_content())) as archive:
+            self.assertEqual(archive.namelist(), ["events.csv"])
+            self.assertEqual(archive.read("events.csv").decode(),
+                             self.csv_content * 1000)
+
+    def test_chunks(self):
+        """Compressing in pieces works across character boundaries."""
+        text = "\u20ac" * 1000
+        with mock.patch("intelmqmail.mail.COMPRESSION_CHUNK_SIZE", 7):
+            (data, maintype, subtype), kw = compressed_attachment(text, "events.csv", "gzip")
+        self.assertEqual(gzip.decompress(data).decode(), text)
+
+    def test_unknown_compression(self):
+        with self.assertRaises(ValueError):
+            compressed_attachment("", "events.csv", "bzip2")
+
+
+class TestWireBytes(MailCreationTest, unittest.TestCase):
+
+    def send_message_args(self, msg, to_addrs=None):
+        """Return the arguments smtplib.SMTP.send_message passes to sendmail."""
+        smtp = mock.MagicMock()
+        smtplib.SMTP.send_message(smtp, msg, to_addrs=to_addrs)
+        from_addr, to_addrs, flatmsg = smtp.sendmail.call_args[0][:3]
+        return from_addr, to_addrs, flatmsg
+
+    def test_same_as_send_message(self):
+        msg = self.create_text_mail_with_attachment(None, sender="Real Name <rn@example.com>")
+        msg.add_header("Cc", "Other <other@example.com>, third@example.com")
+        msg.add_header("Bcc", "hidden@example.com")
+        # serializing sets the MIME boundary, which is random otherwise
+        msg.as_bytes()
+        from_addr, to_addrs, flatmsg = self.send_message_args(msg)
+        self.assertEqual(smtp_envelope(msg), (from_addr, to_addrs))
+        self.assertEqual(wire_bytes(msg), flatmsg)
+        self.assertNotIn(b"hidden@example.com", wire_bytes(msg))
+        self.assertEqual(msg["Bcc"], "hidden@example.com")
+
+    def test_crlf_for_other_policies(self):
+        """Messages with other policies are sent with CRLF line endings too"""
+        compat32 = MIMEMultipart()
+        compat32["From"] = "sender@example.com"
+        compat32["To"] = "recipient@example.com"
+        compat32.attach(MIMEText("line 1\nline 2\n"))
+        default = EmailMessage()
+        default["From"] = "sender@example.com"
+        default["To"] = "recipient@example.com"
+        default.set_content("line 1\nline 2\n")
+        for msg in (compat32, default):
+            flat = wire_bytes(msg)
+            self.assertIn(b"\r\n", flat)
+            self.assertNotIn(b"\n", flat.replace(b"\r\n", b""))
+            self.assertNotIn(b"\r", flat.replace(b"\r\n", b""))
+            self.assertEqual(flat, self.send_message_args(msg)[2])
+
+    def test_envelope_to(self):
+        msg = self.create_text_mail_with_attachment(None)
+        self.assertEqual(smtp_envelope(msg, ["contact@example.com"]),
+                         ("sender@example.com", ["contact@example.com"]))
+
+    def test_resent(self):
+        msg = self.create_text_mail_with_attachment(None)
+        msg.add_header("Resent-Date", "Mon, 01 Jan 2024 00:00:00 +0000")
+        msg.add_header("Resent-From", "resender@example.com")
+        msg.add_header("Resent-To", "new@example.com")
+        self.assertEqual(smtp_envelope(msg), self.send_message_args(msg)[:2])
+
+
+def parse_streamed(mail):
+    """Parse the bytes of mail with the line breaks of the email package."""
+    return email.message_from_bytes(mail.as_bytes().replace(b"\r\n", b"\n"),
+                                    policy=mailgen_policy)
+
+
+class TestWriteMail(MailCreationTest, unittest.TestCase):
+
+    def write_mail_with_attachments(self, attachments, gpg_context=None):
+        # small pieces, so that the data is read and encoded in several
+        with mock.patch("intelmqmail.mail.STREAM_CHUNK_SIZE", 100):
+            return write_mail("sender@example.com", "recipient@example.com",
+                              "Test streaming", self.body_content, attachments,
+                              gpg_context)
+
+    def check_same_parts(self, streamed, msg):
+        """Check that the streamed mail has the same parts as msg."""
+        streamed_parts = list(parse_streamed(streamed).walk())
+        parts = list(parse_streamed(msg).walk())
+        self.assertEqual(len(streamed_parts), len(parts))
+        for streamed_part, part in zip(streamed_parts, parts):
+            self.assertEqual(streamed_part.get_content_type(), part.get_content_type())
+            self.assertEqual(streamed_part.get_filename(), part.get_filename())
+            if not part.is_multipart():
+                self.assertEqual(streamed_part["Content-Transfer-Encoding"],
+                                 part["Content-Transfer-Encoding"])
+                self.assertEqual(streamed_part.get_payload(), part.get_payload())
+
+    def test_same_as_create_mail(self):
+        csv = self.csv_content * 100 + "From the last line without a line break \u20ac"
+        attachments = [((csv,), dict(subtype="csv", filename="events.csv")),
+                       compressed_attachment(csv, "events.csv", "gzip")]
+        streamed = self.write_mail_with_attachments(attachments)
+        msg = create_mail("sender@example.com", "recipient@example.com",
+                          "Test streaming", self.body_content, attachments, None)
+        self.check_no_from(streamed)
+        self.check_same_parts(streamed, msg)
+        self.assertEqual(streamed["To"], "recipient@example.com")
+        self.assertEqual(streamed.size, len(streamed.as_bytes()))
+
+    def test_file_attachments(self):
+        csv = self.csv_content * 100
+        data = bytes(range(256)) * 10
+        streamed = self.write_mail_with_attachments(
+            [((io.StringIO(csv),), dict(subtype="csv", filename="events.csv")),
+             ((io.BytesIO(data), "application", "octet-stream"), dict(filename="data.bin"))])
+        msg = parse_streamed(streamed)
+        body, csv_part, data_part = self.check_unpack_multipart(msg, "mixed")
+        self.check_body_part(body)
+        self.assertEqual(csv_part.get_content(), csv)
+        self.assertEqual(data_part.get_content(), data)
+
+    def test_without_attachments(self):
+        streamed = self.write_mail_with_attachments([])
+        msg = parse_streamed(streamed)
+        self.check_body_part(msg)
+
+
+class TestMailFactory(MailCreationTest, unittest.TestCase):
+
+    def create_mails(self, factory, count=2):
+        return [factory.create_mail("recipient@example.com", "Test factory",
+                                    self.body_content,
+                                    [((self.csv_content,),
+                                      dict(subtype="csv", filename="events.csv"))],
+                                    None)
+                for i in range(count)]
+
+    def test_same_as_create_mail(self):
+        factory = MailFactory("Real Name <rn@example.com>")
+        msg, = self.create_mails(factory, 1)
+        reference = create_mail("Real Name <rn@example.com>", "recipient@example.com",
+                                "Test factory", self.body_content,
+                                [((self.csv_content,),
+                                  dict(subtype="csv", filename="events.csv"))],
+                                None)
+        self.assertEqual([name for name, value in msg.items()],
+                         [name for name, value in reference.items()])
+        for name in ("From", "To", "Subject"):
+            self.assertEqual(msg[name], reference[name])
+        self.assertEqual(msg["From"].addresses[0].addr_spec, "rn@example.com")
+        body, csv = self.check_unpack_multipart(msg, "mixed")
+        self.check_body_part(body)
+        self.check_csv_attachment(csv)
+
+    def test_message_ids_and_boundaries(self):
+        msgs = self.create_mails(MailFactory("sender@example.com"), 3)
+        message_ids = [msg["Message-Id"] for msg in msgs]
+        self.assertEqual(len(set(message_ids)), 3)
+        for message_id in message_ids:
+            self.assertRegex(message_id, r"^<[0-9.]+@example\.com>$")
+        boundaries = [msg.get_boundary() for msg in msgs]
+        self.assertEqual(len(set(boundaries)), 3)
+        self.assertTrue(all(boundary.startswith("=" * 15) for boundary in boundaries))
+
+    def test_date_per_second(self):
+        factory = MailFactory("sender@example.com")
+        with mock.patch("time.time", return_value=1700000000.25):
+            first, second = self.create_mails(factory)
+        with mock.patch("time.time", return_value=1700000001.0):
+            third, = self.create_mails(factory, 1)
+        self.assertIs(first["Date"], second["Date"])
+        self.assertEqual(first["Date"].datetime.timestamp(), 1700000000)
+        self.assertEqual(third["Date"].datetime.timestamp(), 1700000001)
+
+    def test_write_mail(self):
+        factory = MailFactory("sender@example.com")
+        streamed = factory.write_mail("recipient@example.com", "Test factory",
+                                      self.body_content, [], None)
+        self.assertEqual(streamed["From"], "sender@example.com")
+        self.assertRegex(streamed["Message-Id"], r"@example\.com>$")
+        self.check_body_part(parse_streamed(streamed))
+
+
+class TestSendStreamed(MailCreationTest, unittest.TestCase):
+
+    def smtp(self):
+        smtp = mock.MagicMock()
+        smtp.does_esmtp = False
+        smtp.mail.return_value = (250, b"OK")
+        smtp.rcpt.return_value = (250, b"OK")
+        smtp.docmd.return_value = (354, b"Go ahead")
+        smtp.getreply.return_value = (250, b"OK")
+        return smtp
+
+    def test_dot_stuffing(self):
+        streamed = write_mail("sender@example.com", "recipient@example.com", "Dots",
+                              ".a\n..b\nc.d\n" * 100, [], None)
+        smtp = self.smtp()
+        # chunks that start within and at the beginning of lines
+        with mock.patch("intelmqmail.mail.STREAM_CHUNK_SIZE", 7):
+            self.assertEqual(send_streamed(smtp, "sender@example.com",
+                                           ["recipient@example.com"], streamed), {})
+        smtp.mail.assert_called_once_with("sender@example.com", [])
+        smtp.rcpt.assert_called_once_with("recipient@example.com")
+        sent = b"".join(args[0] for args, kw in smtp.send.call_args_list)
+        self.assertEqual(sent, re.sub(rb"(?m)^\.", b"..", streamed.as_bytes()) + b".\r\n")
+
+    def test_recipients_refused(self):
+        streamed = write_mail("sender@example.com", "recipient@example.com", "Refused",
+                              "Body\n", [], None)
+        smtp = self.smtp()
+        smtp.rcpt.return_value = (550, b"No such user")
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            send_streamed(smtp, "sender@example.com", ["recipient@example.com"], streamed)
+        smtp.rset.assert_called_once_with()
+        smtp.send.assert_not_called()
+
+
 class TestCreateSignedMail(MailCreationTest, GpgHomeTestCase):
 
     import_keys = ['test1.sec']
@@ -135,3 +440,168 @@ class TestCreateSignedMail(MailCreationTest, GpgHomeTestCase):
         body, csv = self.check_unpack_multipart(signed, "mixed")
         self.check_body_part(body)
         self.check_csv_attachment(csv)
+
+    def test_signature_cache(self):
+        """Test that the same contents are signed only once."""
+        signature_cache.clear()
+        ctx = gpg.Context()
+        ctx.signers = [ctx.get_key('5F503EFAC8C89323D54C252591B8CD7E15925678')]
+
+        first = self.create_text_mail_with_attachment(ctx)
+        with mock.patch.object(ctx, "sign") as sign:
+            second = self.create_text_mail_with_attachment(ctx)
+            sign.assert_not_called()
+        self.assertEqual(len(signature_cache), 1)
+        self.assertEqual([part.as_bytes() for part in first.iter_parts()],
+                         [part.as_bytes() for part in second.iter_parts()])
+        self.assertNotEqual(first["Message-Id"], second["Message-Id"])
+
+    def test_signed_text_mail_with_signing_pool(self):
+        """Test a signed notification message signed by a SigningPool."""
+        with SigningPool(self._gpghome,
+                         '5F503EFAC8C89323D54C252591B8CD7E15925678',
+                         processes=2) as pool:
+            msg = finish_mail(self.create_text_mail_with_attachment(pool))
+        self.check_no_from(msg)
+
+        signed, signature = self.check_unpack_multipart(msg, "signed")
+        self.assertEqual(signature.get_content_type(),
+                         "application/pgp-signature")
+        self.assertEqual(msg.get_param("micalg")[:4], "pgp-")
+
+        # the signature must be valid for the signed part as it is
+        # serialized in the final mail
+        delimiter = b"--" + msg.get_boundary().encode() + b"\r\n"
+        signed_bytes = msg.as_bytes().split(delimiter)[1][:-len(b"\r\n")]
+        ctx = gpg.Context()
+        data, result = ctx.verify(signed_bytes, signature.get_content())
+        self.assertEqual(result.signatures[0].fpr,
+                         '5F503EFAC8C89323D54C252591B8CD7E15925678')
+
+        body, csv = self.check_unpack_multipart(signed, "mixed")
+        self.check_body_part(body)
+        self.check_csv_attachment(csv)
+
+    def test_signing_pool_fingerprint(self):
+        """The signature cache of a SigningPool uses the key's fingerprint."""
+        with SigningPool(self._gpghome, '91B8CD7E15925678', processes=1) as pool:
+            self.assertEqual(pool.fingerprint,
+                             '5F503EFAC8C89323D54C252591B8CD7E15925678')
+
+    def test_signed_mail_from_factory(self):
+        """The boundary set by MailFactory is kept when signing."""
+        ctx = gpg.Context()
+        ctx.signers = [ctx.get_key('5F503EFAC8C89323D54C252591B8CD7E15925678')]
+        factory = MailFactory("sender@example.com")
+        msg = factory.create_mail("recipient@example.com", "Test factory",
+                                  self.body_content, [], ctx)
+        signed, signature = self.check_unpack_multipart(msg, "signed")
+        self.assertTrue(msg.get_boundary().startswith(factory._boundary_prefix))
+        self.assertEqual(msg.get_param("protocol"), "application/pgp-signature")
+        self.check_body_part(signed)
+
+    def test_write_signed_mail(self):
+        """Test a signed mail written by write_mail."""
+        ctx = gpg.Context()
+        ctx.signers = [ctx.get_key('5F503EFAC8C89323D54C252591B8CD7E15925678')]
+        streamed = write_mail("sender@example.com", "recipient@example.com",
+                              "Test streaming", self.body_content,
+                              [((io.StringIO(self.csv_content),),
+                                dict(subtype="csv", filename="events.csv"))],
+                              ctx)
+        msg = parse_streamed(streamed)
+        self.check_no_from(msg)
+
+        signed, signature = self.check_unpack_multipart(msg, "signed")
+        delimiter = b"--" + msg.get_boundary().encode() + b"\r\n"
+        signed_bytes = streamed.as_bytes().split(delimiter)[1][:-len(b"\r\n")]
+        data, result = ctx.verify(signed_bytes, signature.get_content())
+        self.assertEqual(result.signatures[0].fpr,
+                         '5F503EFAC8C89323D54C252591B8CD7E15925678')
+
+        body, csv = self.check_unpack_multipart(signed, "mixed")
+        self.check_body_part(body)
+        self.check_csv_attachment(csv)
+
+
+class TestSignatureCache(unittest.TestCase):
+
+    def test_lru(self):
+        cache = SignatureCache(maxsize=2)
+        keys = [SignatureCache.key(["fpr"], "detach", data)
+                for data in (b"a", b"b", b"c")]
+        cache.put(keys[0], "sig a")
+        cache.put(keys[1], "sig b")
+        self.assertEqual(cache.get(keys[0]), "sig a")
+        cache.put(keys[2], "sig c")
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertEqual(cache.get(keys[0]), "sig a")
+        self.assertEqual(cache.get(keys[2]), "sig c")
+
+    def test_key(self):
+        self.assertEqual(SignatureCache.key(["fpr"], "detach", b"data"),
+                         SignatureCache.key(iter(["fpr"]), "detach", b"data"))
+        self.assertNotEqual(SignatureCache.key(["fpr"], "detach", b"data"),
+                            SignatureCache.key(["other"], "detach", b"data"))
+        self.assertNotEqual(SignatureCache.key(["fpr"], "detach", b"data"),
+                            SignatureCache.key(["fpr"], "clear", b"data"))
+
+    def test_max_age(self):
+        cache = SignatureCache(max_age=0)
+        key = SignatureCache.key(["fpr"], "detach", b"data")
+        cache.put(key, "sig")
+        with mock.patch("time.monotonic", return_value=10 ** 9):
+            self.assertIsNone(cache.get(key))
+        self.assertEqual(len(cache), 0)
+
+    def test_disabled(self):
+        cache = SignatureCache(maxsize=0)
+        key = SignatureCache.key(["fpr"], "detach", b"data")
+        cache.put(key, "sig")
+        self.assertIsNone(cache.get(key))
+
+
+class TestSigner(GpgHomeTestCase):
+
+    import_keys = ['test1.sec']
+
+    fingerprint = '5F503EFAC8C89323D54C252591B8CD7E15925678'
+
+    def test_context_is_reused(self):
+        signer = Signer(self._gpghome, self.fingerprint)
+        ctx = signer.context()
+        self.assertEqual([key.fpr for key in ctx.signers], [self.fingerprint])
+        self.assertIs(signer.context(), ctx)
+
+    def test_context_is_replaced_after_failed_health_check(self):
+        signer = Signer(self._gpghome, self.fingerprint)
+        signer.health_check_interval = 0
+        ctx = signer.context()
+        self.assertIs(signer.context(), ctx)
+
+        # the key cannot be found anymore through the old context
+        ctx.set_engine_info(gpg.constants.protocol.OpenPGP,
+                            home_dir=self._gpghome + "-missing")
+        self.assertIsNot(signer.context(), ctx)
+
+    def test_health_check_interval(self):
+        """The key is checked at most once per health_check_interval"""
+        signer = Signer(self._gpghome, self.fingerprint)
+        with mock.patch("intelmqmail.mail.time.monotonic") as monotonic:
+            monotonic.return_value = 1000
+            ctx = signer.context()
+            with mock.patch.object(ctx, "get_key", wraps=ctx.get_key) as get_key:
+                # asking for the context more often than the interval
+                # does not postpone the check
+                for now in range(1060, 1300, 60):
+                    monotonic.return_value = now
+                    self.assertIs(signer.context(), ctx)
+                get_key.assert_not_called()
+                monotonic.return_value = 1300
+                self.assertIs(signer.context(), ctx)
+                get_key.assert_called_once_with(self.fingerprint, secret=True)
+
+    def test_get_signer(self):
+        signer = get_signer(self._gpghome, self.fingerprint)
+        self.assertIs(get_signer(self._gpghome, self.fingerprint), signer)
+        self.assertIsNot(get_signer(self._gpghome, self.fingerprint, 2), signer)
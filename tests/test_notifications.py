@@ -3,13 +3,17 @@
 Tests for intelmqmail.notifications.
 """
 
+import gzip
 import unittest
 import unittest.mock
 import smtplib
+import logging
 from datetime import datetime, timedelta, timezone
 
-from intelmqmail.notification import ScriptContext, Directive, SendContext
+from intelmqmail.notification import ScriptContext, Directive, SendContext, SentBuffer, \
+    LazyEmailNotification, StreamedEmailNotification, EmailNotification
 from intelmqmail.templates import Template
+from intelmqmail.tableformat import build_table_format
 
 
 class TestScriptContext(unittest.TestCase):
@@ -22,7 +26,7 @@ class TestScriptContext(unittest.TestCase):
                                event_ids=(100001, 100302),
                                directive_ids=(10, 11, 12), inserted_at=None,
                                last_sent=None, notification_interval=None,
-                               cur=None):
+                               cur=None, read_cursor=None, render_lazily=False):
         directive = Directive(recipient_address=recipient_address,
                               template_name=template_name,
                               notification_format=notification_format,
@@ -31,7 +35,9 @@ class TestScriptContext(unittest.TestCase):
                               event_ids=event_ids, directive_ids=directive_ids,
                               inserted_at=inserted_at, last_sent=last_sent,
                               notification_interval=notification_interval)
-        return ScriptContext(config={'sender': 'intelmqmail@intelmq.example'}, cur=cur, gpgme_ctx=None, directive=directive, logger=None)
+        return ScriptContext(config={'sender': 'intelmqmail@intelmq.example'}, cur=cur, gpgme_ctx=None, directive=directive,
+                             logger=logging.getLogger(__name__), read_cursor=read_cursor,
+                             render_lazily=render_lazily)
 
     def test_notification_interval_exceeded_no_last_sent(self):
         """Notification interval is exceeded if no mail has been sent before"""
@@ -72,7 +78,8 @@ class TestScriptContext(unittest.TestCase):
                 with unittest.mock.patch('intelmqmail.notification.SendContext.mark_as_sent') as markassent_context:
                     email_notifications[0].send(SendContext(cur=cursor, smtp=smtplib.SMTP()))
                     # check the envelope_to
-                    mock_smtp.return_value.send_message.assert_called_with(email_notifications[0].email, to_addrs=['contact@example.com'])
+                    mock_smtp.return_value.sendmail.assert_called_with('intelmqmail@intelmq.example', ['contact@example.com'],
+                                                                       email_notifications[0].as_bytes())
                     markassent_context.assert_called_once()
 
     def test_mail_format_as_csv_ticket_number(self):
@@ -106,9 +113,169 @@ class TestScriptContext(unittest.TestCase):
                 with unittest.mock.patch('intelmqmail.notification.SendContext.mark_as_sent') as markassent_context:
                     email_notifications[0].send(SendContext(cur=cursor, smtp=smtplib.SMTP()))
                     # check the envelope_to
-                    mock_smtp.return_value.send_message.assert_called_with(email_notifications[0].email, to_addrs=None)
+                    mock_smtp.return_value.sendmail.assert_called_with('intelmqmail@intelmq.example', ['admin@example.com'],
+                                                                       email_notifications[0].as_bytes())
                     markassent_context.assert_not_called()
 
+    def test_mail_format_as_csv_split(self):
+        """Large event data is split into several mails with the same ticket"""
+        script_context = self.context_with_directive(cur=unittest.mock.MagicMock())
+        events = [{'source.ip': f'192.0.2.{i}'} for i in range(5)]
+        with unittest.mock.patch('intelmqmail.notification.ScriptContext.load_events', return_value=events):
+            email_notifications = script_context.mail_format_as_csv(
+                format_spec=build_table_format("test", (("source.ip", "ip"),)),
+                template=Template.from_strings('Subject ${ticket_number}', '${part_number} of ${part_count}\n${events_as_csv}'),
+                ticket_number='20240101-10000001', max_rows=2)
+        self.assertEqual(len(email_notifications), 3)
+        self.assertEqual([n.email.get('Subject') for n in email_notifications],
+                         [f'Subject 20240101-10000001 ({i}/3)' for i in (1, 2, 3)])
+        self.assertEqual({n.ticket for n in email_notifications}, {'20240101-10000001'})
+        self.assertEqual([n.mark_as_sent for n in email_notifications], [False, False, True])
+        self.assertIn('3 of 3', email_notifications[2].email.get_content())
+        self.assertIn('192.0.2.4', email_notifications[2].email.get_content())
+
+    def test_load_events_from_replica(self):
+        """Events are loaded from the replica if it has all of them"""
+        primary, replica = unittest.mock.Mock(), unittest.mock.Mock()
+        context = self.context_with_directive(cur=primary, read_cursor=replica)
+        with unittest.mock.patch('intelmqmail.notification.load_events') as load_events:
+            load_events.return_value = [{'id': 100001}, {'id': 100302}]
+            self.assertEqual(context.load_events(['id']), [{'id': 100001}, {'id': 100302}])
+            load_events.assert_called_once_with(replica, (100001, 100302), ['id'])
+
+    def test_load_events_replica_lagging(self):
+        """Events are loaded from the primary if the replica lags behind"""
+        primary, replica = unittest.mock.Mock(), unittest.mock.Mock()
+        context = self.context_with_directive(cur=primary, read_cursor=replica)
+        with unittest.mock.patch('intelmqmail.notification.load_events') as load_events:
+            load_events.side_effect = [[{'id': 100001}], [{'id': 100001}, {'id': 100302}]]
+            self.assertEqual(context.load_events(['id']), [{'id': 100001}, {'id': 100302}])
+            self.assertEqual(load_events.call_args_list,
+                             [unittest.mock.call(replica, (100001, 100302), ['id']),
+                              unittest.mock.call(primary, (100001, 100302), ['id'])])
+
+    def test_mail_format_as_csv_compression(self):
+        """Event data of at least compression_min_size characters is compressed"""
+        script_context = self.context_with_directive(cur=unittest.mock.MagicMock())
+        script_context.config['compress_attachments'] = {'compression': 'gzip', 'min_size': 30}
+        events = [{'source.ip': f'192.0.2.{i}'} for i in range(5)]
+        with unittest.mock.patch('intelmqmail.notification.ScriptContext.load_events', return_value=events):
+            email_notifications = script_context.mail_format_as_csv(
+                format_spec=build_table_format("test", (("source.ip", "ip"),)),
+                template=Template.from_strings('Subject ${ticket_number}', 'Body\n'),
+                ticket_number='20240101-10000001', attach_event_data=True, max_rows=2)
+        attachments = [list(n.email.iter_attachments())[0] for n in email_notifications]
+        # the last mail has one row only
+        self.assertEqual([a.get_content_type() for a in attachments],
+                         ['application/gzip', 'application/gzip', 'text/csv'])
+        self.assertEqual(gzip.decompress(attachments[0].get_content()).decode(),
+                         '"ip"\r\n"192.0.2.0"\r\n"192.0.2.1"\r\n')
+
+    def test_mail_format_as_csv_streamed(self):
+        """Event data of at least the stream_attachments min_size is streamed"""
+        cursor = unittest.mock.MagicMock()
+        script_context = self.context_with_directive(cur=cursor)
+        script_context.config['stream_attachments'] = {'min_size': 30}
+        events = [{'source.ip': f'192.0.2.{i}'} for i in range(5)]
+        with unittest.mock.patch('intelmqmail.notification.ScriptContext.load_events', return_value=events):
+            email_notifications = script_context.mail_format_as_csv(
+                format_spec=build_table_format("test", (("source.ip", "ip"),)),
+                template=Template.from_strings('Subject ${ticket_number}', 'Body\n'),
+                ticket_number='20240101-10000001', attach_event_data=True, max_rows=2)
+        # the last mail has one row only
+        self.assertEqual([type(n) for n in email_notifications],
+                         [StreamedEmailNotification, StreamedEmailNotification, EmailNotification])
+        self.assertEqual(email_notifications[0].email['Subject'], 'Subject 20240101-10000001 (1/3)')
+
+        smtp = unittest.mock.MagicMock()
+        smtp.does_esmtp = False
+        smtp.mail.return_value = (250, b'OK')
+        smtp.rcpt.return_value = (250, b'OK')
+        smtp.docmd.return_value = (354, b'Go ahead')
+        smtp.getreply.return_value = (250, b'OK')
+        with unittest.mock.patch('intelmqmail.notification.SendContext.mark_as_sent') as mark_as_sent:
+            for notification in email_notifications[:2]:
+                notification.send(SendContext(cur=cursor, smtp=smtp))
+        smtp.mail.assert_called_with('intelmqmail@intelmq.example', [])
+        sent = b''.join(args[0] for args, kw in smtp.send.call_args_list)
+        self.assertEqual(sent.count(b'"192.0.2.0"\r\n"192.0.2.1"\r\n'), 1)
+        # the spool files are deleted once the mails are sent
+        self.assertTrue(all(n.email.spool.closed for n in email_notifications[:2]))
+        # only the last of the split mails marks the directives as sent
+        mark_as_sent.assert_not_called()
+
+    def test_mail_format_as_csv_lazily(self):
+        """With render_lazily, the mails are only rendered when needed"""
+        script_context = self.context_with_directive(cur=unittest.mock.MagicMock(), render_lazily=True)
+        events = [{'source.ip': f'192.0.2.{i}'} for i in range(5)]
+        with unittest.mock.patch('intelmqmail.notification.ScriptContext.load_events',
+                                 return_value=events) as load_events, \
+                unittest.mock.patch('intelmqmail.notification.ScriptContext.new_ticket_number',
+                                    return_value='20240101-10000001') as new_ticket_number:
+            notifications = script_context.mail_format_as_csv(
+                format_spec=build_table_format("test", (("source.ip", "ip"),)),
+                template=Template.from_strings('Subject ${ticket_number}', '${events_as_csv}'),
+                max_rows=2)
+            self.assertEqual(len(notifications), 1)
+            self.assertIsInstance(notifications[0], LazyEmailNotification)
+            load_events.assert_not_called()
+            new_ticket_number.assert_not_called()
+
+            rendered = notifications[0].rendered()
+            self.assertEqual(len(rendered), 3)
+            self.assertIs(notifications[0].rendered(), rendered)
+            new_ticket_number.assert_called_once()
+        self.assertEqual(notifications[0].ticket, '20240101-10000001')
+        self.assertEqual(notifications[0].email.get('Subject'), 'Subject 20240101-10000001 (1/3)')
+
+        smtp = unittest.mock.MagicMock()
+        with unittest.mock.patch('intelmqmail.notification.SendContext.mark_as_sent') as mark_as_sent:
+            notifications[0].send(SendContext(cur=None, smtp=smtp))
+        self.assertEqual(smtp.sendmail.call_count, 3)
+        mark_as_sent.assert_called_once()
+
+
+class TestSentBuffer(unittest.TestCase):
+
+    def test_send_context_buffers(self):
+        cur = unittest.mock.Mock()
+        sent_buffer = SentBuffer(cur, 2)
+        context = SendContext(cur, unittest.mock.Mock(), sent_buffer=sent_buffer)
+        context.mark_as_sent([1, 2], "20240101-10000001", None)
+        cur.execute.assert_not_called()
+        self.assertFalse(sent_buffer.is_full())
+        context.mark_as_sent([3], "20240101-10000002", None)
+        self.assertTrue(sent_buffer.is_full())
+
+        with unittest.mock.patch('intelmqmail.notification.mark_many_as_sent') as mark_many_as_sent:
+            sent_buffer.flush()
+        mark_many_as_sent.assert_called_once_with(
+            cur, [([1, 2], "20240101-10000001", None), ([3], "20240101-10000002", None)])
+        self.assertEqual(sent_buffer.records, [])
+
+    def test_rollback_to_savepoint(self):
+        """Records of a rolled back directive are dropped"""
+        sent_buffer = SentBuffer(unittest.mock.Mock(), 10)
+        sent_buffer.savepoint()
+        sent_buffer.add([1], "20240101-10000001", None)
+        sent_buffer.savepoint()
+        sent_buffer.add([2], "20240101-10000002", None)
+        sent_buffer.rollback_to_savepoint()
+        self.assertEqual(sent_buffer.records, [([1], "20240101-10000001", None)])
+
+    def test_flush_error(self):
+        """A failing flush does not abort the transaction"""
+        cur = unittest.mock.Mock()
+        sent_buffer = SentBuffer(cur, 10)
+        sent_buffer.add([1], "20240101-10000001", None)
+        with unittest.mock.patch('intelmqmail.notification.mark_many_as_sent',
+                                 side_effect=RuntimeError), \
+                self.assertLogs('intelmqmail.notification', logging.ERROR):
+            sent_buffer.flush()
+        self.assertEqual([call.args[0] for call in cur.execute.call_args_list],
+                         ["SAVEPOINT mark_as_sent;",
+                          "ROLLBACK TO SAVEPOINT mark_as_sent;"])
+
 
 if __name__ == '__main__':  # pragma: nocover
     unittest.main()
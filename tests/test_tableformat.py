@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Test the intelmqmail.tableformat module.
+
+Dependencies:
+    (none)
+"""
+
+import unittest
+from datetime import datetime, timezone
+
+from intelmqmail.tableformat import build_table_format, format_as_csv, \
+    format_as_csv_parts
+
+
+def event(ip, port, hour, extra=None):
+    return {"source.ip": ip, "source.port": port,
+            "time.source": datetime(2024, 1, 1, hour, 30, 5, 123, tzinfo=timezone.utc),
+            "extra": extra if extra is not None else {"tag": "a"}}
+
+
+class TestCollapseRows(unittest.TestCase):
+
+    columns = (("source.ip", "ip"),
+               ("source.port", "port"),
+               ("time.source", "timestamp"),
+               ("extra.tag", "tag"))
+
+    def test_no_collapse(self):
+        table_format = build_table_format("test", self.columns)
+        rows = table_format.rows_from_events([event("192.0.2.1", 80, 10),
+                                              event("192.0.2.1", 80, 11)])
+        self.assertEqual(len(rows), 2)
+        self.assertNotIn("count", table_format.column_keys())
+
+    def test_collapse(self):
+        table_format = build_table_format("test", self.columns,
+                                          collapse_on=["source.ip", "source.port", "extra:tag"])
+        self.assertEqual(table_format.column_keys()[-3:],
+                         ["count", "first_seen", "last_seen"])
+        self.assertIn("time.source", table_format.event_table_columns())
+
+        events = [event("192.0.2.1", 80, 11),
+                  event("192.0.2.2", 80, 12),
+                  event("192.0.2.1", 80, 9),
+                  event("192.0.2.1", 80, 10),
+                  event("192.0.2.1", 80, 13, extra={"tag": "b"})]
+        rows = table_format.rows_from_events(events)
+        self.assertEqual([(row["source.ip"], row["extra:tag"], row["count"],
+                           row["first_seen"].hour, row["last_seen"].hour)
+                          for row in rows],
+                         [("192.0.2.1", "a", 3, 9, 11),
+                          ("192.0.2.2", "a", 1, 12, 12),
+                          ("192.0.2.1", "b", 1, 13, 13)])
+
+    def test_collapse_csv(self):
+        table_format = build_table_format("test", self.columns[:2],
+                                          collapse_on=["source.ip", "source.port"])
+        csv = format_as_csv(table_format, [event("192.0.2.1", 80, 10),
+                                           event("192.0.2.1", 80, 11)])
+        self.assertEqual(csv, ('"ip","port","count","first_seen","last_seen"\r\n'
+                               '"192.0.2.1","80","2","2024-01-01 10:30:05","2024-01-01 11:30:05"\r\n'))
+
+
+class TestCSVParts(unittest.TestCase):
+
+    table_format = build_table_format("test", (("source.ip", "ip"),))
+    events = [{"source.ip": f"192.0.2.{i}"} for i in range(10, 15)]
+
+    def test_no_limits(self):
+        self.assertEqual(format_as_csv_parts(self.table_format, self.events),
+                         [format_as_csv(self.table_format, self.events)])
+
+    def test_no_events(self):
+        self.assertEqual(format_as_csv_parts(self.table_format, [], max_rows=2),
+                         ['"ip"\r\n'])
+
+    def test_max_rows(self):
+        parts = format_as_csv_parts(self.table_format, self.events, max_rows=2)
+        self.assertEqual(parts, ['"ip"\r\n"192.0.2.10"\r\n"192.0.2.11"\r\n',
+                                 '"ip"\r\n"192.0.2.12"\r\n"192.0.2.13"\r\n',
+                                 '"ip"\r\n"192.0.2.14"\r\n'])
+
+    def test_max_size(self):
+        # header and two rows have 6 + 2 * 14 characters
+        parts = format_as_csv_parts(self.table_format, self.events, max_size=34)
+        self.assertEqual([len(part) for part in parts], [34, 34, 20])
+        self.assertEqual("".join(parts).count("192.0.2."), 5)
+        # a single row exceeding the size is not split any further
+        parts = format_as_csv_parts(self.table_format, self.events[:2], max_size=10)
+        self.assertEqual(parts, ['"ip"\r\n"192.0.2.10"\r\n',
+                                 '"ip"\r\n"192.0.2.11"\r\n'])
+
+
+if __name__ == '__main__':  # pragma: nocover
+    unittest.main()
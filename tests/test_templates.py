@@ -77,6 +77,26 @@ ${events}"""
         self.assertEqual(body, ("Body of report #8172 for AS 3269. Events:\n"
                                 "<CSV formatted events>\n"))
 
+    def test_read_template_cached(self):
+        """Templates are only parsed again if the file has changed"""
+        filename = os.path.join(self.template_dir, "cached-template")
+        with open(filename, "wt") as f:
+            f.write("First subject\n\nFirst body")
+        tmpl = templates.read_template(self.template_dir, "cached-template")
+        self.assertIs(templates.read_template(self.template_dir, "cached-template"), tmpl)
+
+        with open(filename, "wt") as f:
+            f.write("Second subject\n\nSecond body")
+        stat = os.stat(filename)
+        os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+        self.assertEqual(templates.read_template(self.template_dir, "cached-template").substitute({}),
+                         ("Second subject", "Second body\n"))
+
+    def test_template_from_string(self):
+        tmpl = templates.template_from_string("Subject ${ticket}\nBody ${ticket}\n\n")
+        self.assertEqual(tmpl.substitute({"ticket": "1"}), ("Subject 1", "Body 1\n"))
+        self.assertIs(templates.template_from_string("Subject ${ticket}\nBody ${ticket}\n\n"), tmpl)
+
     def test_template_from_parameter(self):
         "Tests usage of template given as parameter"
         directive = Directive(recipient_address="admin@example.com",